@@ -5,10 +5,14 @@ import numpy as np
 import pypose as pp
 from pathlib import Path
 from types import MethodType
+from dataclasses import dataclass
 
 from DataLoader import SequenceBase, StereoFrame, smart_transform
 from Evaluation.EvalSeq import EvaluateSequences
 from Odometry.MACVO import MACVO
+from Module.Map import PointNode
+from Module.Frontend.Matching import IMatcher
+from Module.Frontend.StereoDepth import IStereoDepth
 
 from Utility.Config import load_config, asNamespace
 from Utility.PrettyPrint import print_as_table, ColoredTqdm, Logger, save_as_csv
@@ -16,34 +20,126 @@ from Utility.Sandbox import Sandbox
 from Utility.Visualize import fig_plt, rr_plt
 from Utility.Timer import Timer
 from Utility.MetricsCollector import FrameMetricsCollector
+from Utility.Extensions import AsyncHookExecutor, AutoScalingTensor
 
-def VisualizeRerunCallback(frame: StereoFrame, system: MACVO, pb: ColoredTqdm):
-    rr.set_time_sequence("frame_idx", frame.frame_idx)
+@dataclass(frozen=True)
+class FrameSnapshot:
+    """
+    Immutable copy of everything the frame-finished hooks read from the system, so hooks can run
+    in background (see `--hook_mode`) while the system keeps updating its state.
+    """
+    frame          : StereoFrame
+    need_interp    : bool
+    version        : int                # Map version the snapshot is taken at
+    pose           : torch.Tensor       # Pose of the latest frame
+    pose_rows      : torch.Tensor       # Frames inserted / modified since the previous snapshot ...
+    pose_values    : torch.Tensor       # ... and their poses
+    pose_reset     : bool               # If true, pose_rows covers all frames and previous poses are stale
+    K              : torch.Tensor
+    map_points     : PointNode | None
+    vo_points      : PointNode | None
+    flow_data      : IMatcher.Output | None
+    stereo_data    : IStereoDepth.Output | None
+    point3d_covs   : torch.Tensor       # Covariance of points inserted since the previous snapshot (all points if pose_reset)
+    filtering_stats: dict[str, int] | None
+    graph_repr     : str
+    pb             : ColoredTqdm
+
+
+def TakeSnapshot(frame: StereoFrame, system: MACVO, pb: ColoredTqdm, with_points: bool, since_version: int) -> FrameSnapshot:
+    # NOTE: flow / depth outputs and frames are never modified after creation, so they are referenced instead of
+    # copied. Rows of stores may be moved by `VisualMap.compact`, only the rows changed since the previous
+    # snapshot are copied.
+    need_interp = bool(system.graph.frames.data["need_interp"][-1])
+    # Only poses changed since the previous snapshot are copied, see VisualMap.changes_since
+    delta       = system.graph.changes_since(since_version)
+    if delta.reset: pose_rows, point_rows = system.graph.frames.index.tensor.clone(), system.graph.points.index.tensor.clone()
+    else          : pose_rows, point_rows = torch.cat([delta.inserted["frames"], delta.modified["frames"]]), delta.inserted["points"]
+    if with_points and not need_interp:
+        map_points = system.graph.get_frame2map(system.graph.frames[-1:])
+        vo_points  = system.graph.get_match2point(system.graph.get_frame2match(system.graph.frames[-1:]))
+    else:
+        map_points, vo_points = None, None
     
-    # Non-key frame does not need visualization
-    if system.graph.frames.data["need_interp"][-1]: return
+    return FrameSnapshot(
+        frame           = frame,
+        need_interp     = need_interp,
+        version         = delta.version,
+        pose            = system.graph.frames.data["pose"][-1].clone(),
+        pose_rows       = pose_rows,
+        pose_values     = system.graph.frames.data["pose"][pose_rows].clone(),
+        pose_reset      = delta.reset,
+        K               = system.graph.frames.data["K"][-1].clone(),
+        map_points      = map_points,
+        vo_points       = vo_points,
+        flow_data       = system.current_flow,
+        stereo_data     = system.prev_keyframe[2] if system.prev_keyframe is not None else None,  # depth1 from prev_keyframe
+        point3d_covs    = system.graph.points.data["cov_Tw"].tensor[point_rows],    # Packed (Nx6) if enable_packed_cov
+        filtering_stats = None if system.filtering_stats is None else dict(system.filtering_stats),
+        graph_repr      = repr(system.graph),
+        pb              = pb,
+    )
+
+
+class ChunkedTrajectory:
+    """
+    Copy of the estimated trajectory on the visualization side. The trajectory is logged as chunks of
+    `chunk_size` frames and only chunks containing changed frames are re-logged, so each frame costs
+    O(#changed frame + chunk_size) instead of O(#frame).
+    """
+    def __init__(self, rerun_path: str, chunk_size: int = 256) -> None:
+        self.rerun_path = rerun_path
+        self.chunk_size = chunk_size
+        self.poses      = AutoScalingTensor((1024, 7), grow_on=0, dtype=torch.float32, init_val=0.)
     
-    if frame.frame_idx > 0:    
-        rr_plt.log_trajectory("/world/est", pp.SE3(system.graph.frames.data["pose"].tensor))
+    def update(self, rows: torch.Tensor, values: torch.Tensor, reset: bool) -> None:
+        if reset: self.poses.truncate(0)
+        if rows.numel() == 0: return
+        
+        num_frame = int(rows.max().item()) + 1
+        if num_frame > len(self.poses): self.poses.extend(num_frame - len(self.poses))
+        self.poses.tensor[rows] = values.float()
+        
+        # Consecutive chunks share one frame so the line is connected, the previous chunk is re-logged
+        # if its last frame changed.
+        chunks = torch.unique(torch.cat([rows // self.chunk_size, (rows - 1).clamp(min=0) // self.chunk_size]))
+        for chunk in chunks.tolist():
+            start, end = chunk * self.chunk_size, min((chunk + 1) * self.chunk_size + 1, len(self.poses))
+            if end - start < 2: continue
+            rr_plt.log_trajectory(f"{self.rerun_path}/{chunk:06d}", pp.SE3(self.poses.tensor[start:end]))
+
+
+est_trajectory = ChunkedTrajectory("/world/est")
+
+
+def VisualizeRerunCallback(snapshot: FrameSnapshot):
+    rr.set_time_sequence("frame_idx", snapshot.frame.frame_idx)
+    # Changed poses are applied even on non-key frame, so no delta is lost.
+    est_trajectory.update(snapshot.pose_rows, snapshot.pose_values, snapshot.pose_reset)
+    
+    # Non-key frame does not need visualization
+    if snapshot.need_interp: return
     
-    rr_plt.log_camera("/world/macvo/cam_left", pp.SE3(system.graph.frames.data["pose"][-1]), system.graph.frames.data["K"][-1])
-    rr_plt.log_image ("/world/macvo/cam_left", frame.stereo.imageL[0].permute(1, 2, 0))
+    rr_plt.log_camera("/world/macvo/cam_left", pp.SE3(snapshot.pose), snapshot.K)
+    rr_plt.log_image ("/world/macvo/cam_left", snapshot.frame.stereo.imageL[0].permute(1, 2, 0))
     
-    map_points = system.graph.get_frame2map(system.graph.frames[-1:])
-    rr_plt.log_points("/world/point_cloud", map_points.data["pos_Tw"], map_points.data["color"], map_points.data["cov_Tw"], "sphere")
+    if snapshot.map_points is not None:
+        map_points = snapshot.map_points
+        rr_plt.log_points("/world/point_cloud", map_points.data["pos_Tw"], map_points.data["color"], map_points.data["cov_Tw"], "sphere")
     
-    vo_points  = system.graph.get_match2point(system.graph.get_frame2match(system.graph.frames[-1:]))
-    rr_plt.log_points("/world/vo_tracking", vo_points.data["pos_Tw"], vo_points.data["color"], vo_points.data["cov_Tw"], "sphere")
+    if snapshot.vo_points is not None:
+        vo_points  = snapshot.vo_points
+        rr_plt.log_points("/world/vo_tracking", vo_points.data["pos_Tw"], vo_points.data["color"], vo_points.data["cov_Tw"], "sphere")
     
 
-def VisualizeVRAMUsage(frame: StereoFrame, system: MACVO, pb: ColoredTqdm):
+def VisualizeVRAMUsage(snapshot: FrameSnapshot):
     if torch.cuda.is_available():
         allocated_memory = torch.cuda.memory_reserved(0) / 1e9  # Convert to GB
         allocated_memory = f"{round(allocated_memory, 3)} GB"
     else:
         allocated_memory = "N/A"
     
-    pb.set_description(desc=f"{system.graph}, VRAM={allocated_memory}")
+    snapshot.pb.set_description(desc=f"{snapshot.graph_repr}, VRAM={allocated_memory}")
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -92,6 +188,61 @@ def get_args():
         action="store_true",
         help="Evaluate sequence after running odometry."
     )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=None,
+        help="Save full odometry state to <sandbox>/checkpoint.pth every N frames so a preempted run can be resumed."
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        help="Resume from checkpoint in an existing result sandbox folder. Must run with the same --odom and --data."
+    )
+    parser.add_argument(
+        "--hook_mode",
+        type=str,
+        choices=["sync", "block", "drop"],
+        default="sync",
+        help="How frame-finished hooks (visualization, metrics) are run. 'sync' runs them in the tracking loop, "
+             "'block' / 'drop' run them on a background thread and block / drop frames when it falls behind."
+    )
+    parser.add_argument(
+        "--hook_queue",
+        type=int,
+        default=8,
+        help="Maximum number of frame snapshots waiting for background hooks (for --hook_mode block / drop)."
+    )
+    parser.add_argument(
+        "--metrics_every",
+        type=int,
+        default=1,
+        help="Record frame metrics (frame_metrics.csv) every N frames."
+    )
+    parser.add_argument(
+        "--metrics_keyframe_only",
+        action="store_true",
+        help="Only record frame metrics on keyframes."
+    )
+    parser.add_argument(
+        "--profile_ranges",
+        type=str,
+        default=None,
+        help="Run torch profiler on frame ranges, e.g. '100-120,500-510'. Overrides Odometry.args.profile in config."
+    )
+    parser.add_argument(
+        "--profile_every",
+        type=int,
+        default=None,
+        help="Run torch profiler on every N-th frame. Overrides Odometry.args.profile in config."
+    )
+    parser.add_argument(
+        "--profile_slow_ms",
+        type=float,
+        default=None,
+        help="Run torch profiler on the frame after one slower than the threshold (ms). Overrides Odometry.args.profile in config."
+    )
     parser.add_argument(
         "--timing",
         action="store_true",
@@ -108,8 +259,17 @@ if __name__ == "__main__":
     odomcfg, odomcfg_dict = cfg.Odometry, cfg_dict["Odometry"]
     datacfg, datacfg_dict = load_config(Path(args.data))
     project_name = odomcfg.name + "@" + datacfg.name
+    
+    if (args.profile_ranges is not None) or (args.profile_every is not None) or (args.profile_slow_ms is not None):
+        profile_cfg = {
+            "ranges" : [[int(i) for i in r.split("-")] for r in args.profile_ranges.split(",")] if args.profile_ranges else [],
+            "every"  : args.profile_every,
+            "slow_ms": args.profile_slow_ms,
+        }
+        # NOTE: asNamespace turns None into empty namespace, so unset fields are dropped instead.
+        odomcfg_dict["args"]["profile"] = {k: v for k, v in profile_cfg.items() if v is not None}
 
-    exp_space = Sandbox.create(Path(args.resultRoot), project_name)
+    exp_space = Sandbox.create(Path(args.resultRoot), project_name) if args.resume is None else Sandbox.load(args.resume)
     if args.autoremove: exp_space.set_autoremove()
     exp_space.config = {
         "Project": project_name,
@@ -126,56 +286,50 @@ if __name__ == "__main__":
     fig_plt.default_mode = "image" if args.saveplt else "none"
     
     # Initialize metrics collector
-    metrics_collector = FrameMetricsCollector(exp_space.folder)
+    metrics_collector = FrameMetricsCollector(exp_space.folder, sample_every=args.metrics_every, keyframe_only=args.metrics_keyframe_only,
+                                              resume=args.resume is not None)
     
-    # Store frame metrics during processing
-    frame_metrics_buffer = {}
-
-    def onFrameFinished(frame: StereoFrame, system: MACVO, pb: ColoredTqdm):
-        VisualizeRerunCallback(frame, system, pb)
-        VisualizeVRAMUsage(frame, system, pb)
+    def consumeSnapshot(snapshot: FrameSnapshot):
+        VisualizeRerunCallback(snapshot)
+        VisualizeVRAMUsage(snapshot)
         
         # Collect metrics for the current frame
         try:
-            # Get the latest frame data
+            frame     = snapshot.frame
             frame_idx = frame.frame_idx
             timestamp = frame.timestamp if hasattr(frame, 'timestamp') else frame_idx
             
-            # Get data from the metrics buffer
-            frame_data = frame_metrics_buffer.get(frame_idx, {})
-            
-            # Get flow data if available
-            flow_data = None
-            if hasattr(system, 'current_flow') and system.current_flow is not None:
-                flow_data = system.current_flow
-            
-            # Get stereo data if available
-            stereo_data = None
-            if hasattr(system, 'prev_keyframe') and system.prev_keyframe is not None and len(system.prev_keyframe) > 2:
-                stereo_data = system.prev_keyframe[2]  # depth1 from prev_keyframe
-            
-            # Get point filtering statistics
-            filtering_stats = None
-            if hasattr(system, 'filtering_stats') and system.filtering_stats is not None:
-                filtering_stats = system.filtering_stats
-            
-            # Get 3D point covariances if available
-            point3d_covs = None
-            if system.graph and system.graph.points and 'cov_Tw' in system.graph.points.data:
-                point3d_covs = system.graph.points.data['cov_Tw'].tensor
-            
             # Record metrics
             metrics_collector.record_frame_metrics(
                 frame_idx=frame_idx,
                 timestamp=timestamp,
                 frame=frame,
-                flow_data=flow_data,
-                stereo_data=stereo_data,
-                point3d_covs=point3d_covs,
-                filtering_stats=filtering_stats
+                flow_data=snapshot.flow_data,
+                stereo_data=snapshot.stereo_data,
+                point3d_covs=snapshot.point3d_covs,
+                filtering_stats=snapshot.filtering_stats,
+                is_keyframe=not snapshot.need_interp,
+                point3d_reset=snapshot.pose_reset,
             )
         except Exception as e:
-            Logger.write("warn", f"Failed to collect metrics for frame {frame.frame_idx}: {str(e)}")
+            Logger.write("warn", f"Failed to collect metrics for frame {snapshot.frame.frame_idx}: {str(e)}")
+    
+    hook_executor = None if args.hook_mode == "sync" else \
+                    AsyncHookExecutor(consumeSnapshot, max_pending=args.hook_queue, policy=args.hook_mode)
+
+    snapshot_version = 0    # Map version of the last snapshot handed to hooks
+    def onFrameFinished(frame: StereoFrame, system: MACVO, pb: ColoredTqdm):
+        global snapshot_version
+        snapshot = TakeSnapshot(frame, system, pb, with_points=args.useRR, since_version=snapshot_version)
+        if hook_executor is None:
+            consumeSnapshot(snapshot)
+            accepted = True
+        else:
+            accepted = hook_executor.submit(snapshot)
+        # A dropped snapshot does not advance the version, so its changes are delivered with the next one.
+        if accepted:
+            snapshot_version = snapshot.version
+            system.graph.trim_changes(snapshot_version)
 
     # Initialize data source
     sequence = smart_transform(
@@ -187,24 +341,29 @@ if __name__ == "__main__":
         sequence = sequence.preload()
     
     system = MACVO[StereoFrame].from_config(asNamespace(exp_space.config))
+    snapshot_version = system.graph.track_changes()
     
-    system.receive_frames(sequence, exp_space, on_frame_finished=onFrameFinished)
+    system.receive_frames(sequence, exp_space, on_frame_finished=onFrameFinished,
+                          checkpoint_every=args.checkpoint_every, resume=args.resume is not None)
+    if hook_executor is not None: hook_executor.close()
     
     rr_plt.log_trajectory("/world/est"  , torch.tensor(np.load(exp_space.path("poses.npy"))[:, 1:]))
     try:
         rr_plt.log_points    ("/world/point_cloud", 
                                 system.get_map().map_points.data["pos_Tw"].tensor,
                                 system.get_map().map_points.data["color"].tensor,
-                                system.get_map().map_points.data["cov_Tw"].tensor,
+                                system.get_map().map_points.column("cov_Tw"),
                                 "color")
     except RuntimeError:
         Logger.write("warn", "Unable to log full pointcloud - is mapping mode on?")
     
     # Save the collected metrics
     metrics_collector.save_metrics()
+    metrics_collector.close()
     
     Timer.report()
     Timer.save_elapsed(exp_space.path("elapsed_time.json"))
+    Timer.export_chrome_trace(exp_space.path("timer_trace.json"))
 
     if not args.noeval:
         header, result = EvaluateSequences([str(exp_space.folder)], correct_scale=False)
@@ -4,17 +4,105 @@ Provide graph infrastructure (node with arbitrary features and edges)
 from __future__ import annotations
 
 import torch
+import functools
+import contextlib
 import numpy as np
 import typing as T
 from typing_extensions import LiteralString, Self
 
 from abc import ABC, abstractmethod
 from Utility.Extensions import AutoScalingTensor
+from Utility.Math import pack_symmetric, unpack_symmetric
 
 
 T_Fields = T.TypeVar("T_Fields", bound=LiteralString, covariant=True)
 
 
+class BundleListener(T.Protocol):
+    """
+    Auxiliary structures (e.g. spatial index) that need to stay in sync with rows pushed into an
+    `AutoScalingBundle`. Registered through `AutoScalingBundle.register_listener`.
+    """
+    def on_push(self, index: torch.Tensor, value: "TensorBundle") -> None: ...
+    def on_modify(self, index: torch.Tensor, fields: tuple[str, ...]) -> None: ...
+
+
+def guarded(method: T.Callable) -> T.Callable:
+    """
+    Run a mutating method inside `self.guard` (a context manager, e.g. seqlock of a shared-memory publisher
+    marking the storage as being written). Guards are re-entrant, nested calls are fine.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.guard: return method(self, *args, **kwargs)
+    return wrapper
+
+
+def tensor_memory(x: torch.Tensor | AutoScalingTensor) -> tuple[int, int]:
+    """
+    Returns (used, allocated) bytes of a tensor or AutoScalingTensor.
+    """
+    if isinstance(x, AutoScalingTensor): return x.memory_usage()
+    nbytes = x.numel() * x.element_size()
+    return nbytes, nbytes
+
+
+class OptionalColumn(T.NamedTuple):
+    shape: tuple[int, ...]      # Shape of each row
+    dtype: torch.dtype
+    fill : int | float          # Value of rows without data
+    
+    def filled(self, num: int) -> torch.Tensor:
+        return torch.full((num, *self.shape), self.fill, dtype=self.dtype)
+
+
+class PackedSymmetric(T.NamedTuple):
+    """
+    Store (N x dim x dim) symmetric matrices as (N x dim(dim+1)/2) upper-triangular entries in `dtype`,
+    expanded back to full matrices of `full_dtype` when read.
+    """
+    dim       : int
+    dtype     : torch.dtype
+    full_dtype: torch.dtype = torch.float64
+    
+    @property
+    def size(self) -> int: return self.dim * (self.dim + 1) // 2
+    
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        return pack_symmetric(x).to(self.dtype)
+    
+    def decode(self, x: torch.Tensor) -> torch.Tensor:
+        return unpack_symmetric(x.to(self.full_dtype), self.dim)
+
+
+def remap_index(index: torch.Tensor, old_to_new: torch.Tensor) -> torch.Tensor:
+    """
+    Translate row `index` (-1 as empty slot) through `old_to_new` mapping returned by `AutoScalingBundle.compact`.
+    """
+    if old_to_new.numel() == 0: return torch.full_like(index, -1)
+    return old_to_new[index.clamp(min=0)].masked_fill_(index < 0, -1)
+
+
+def remap_ranges(ranges: torch.Tensor, keep: torch.Tensor) -> torch.Tensor:
+    """
+    Translate (..., 2) [start, length] ranges (-1 as empty slot) over rows compacted by boolean mask `keep`.
+    Since compaction preserves order, kept rows of a contiguous range are still contiguous.
+    """
+    kept_before = torch.cat([torch.zeros((1,), dtype=torch.long), keep.long().cumsum(0)])
+    start, end  = ranges[..., 0].clamp(min=0), (ranges[..., 0] + ranges[..., 1]).clamp(min=0)
+    new_start   = kept_before[start]
+    remapped    = torch.stack([new_start, kept_before[end] - new_start], dim=-1)
+    return torch.where(ranges[..., :1] >= 0, remapped, ranges)
+
+
+def scaling_tensors(x: AutoScalingBundle | EdgeLike) -> dict[str, AutoScalingTensor]:
+    """
+    Returns {field or attribute: AutoScalingTensor} holding a scaling bundle or scaling edge.
+    """
+    if isinstance(x, AutoScalingBundle): return {"index": x.index} | dict(x.data)
+    return {k: v for k, v in vars(x).items() if isinstance(v, AutoScalingTensor)}
+
+
 @T.no_type_check    # Jaxtyping and typeguard does not support StringLiteral well.
 class TensorBundle(T.Generic[T_Fields]):
     """
@@ -38,8 +126,15 @@ class TensorBundle(T.Generic[T_Fields]):
         return cls(index, data)
 
     def __getitem__(self, index) -> TensorBundle[T_Fields]:
+        return self.select(index)
+    
+    def select(self, index, fields: T.Iterable[T_Fields] | None = None) -> TensorBundle[T_Fields]:
+        """
+        Gather rows at `index`. If `fields` is given, only these fields are gathered (and present in result).
+        """
+        keys = self.data.keys() if fields is None else fields
         selected_dict: dict[T_Fields, torch.Tensor] = {
-            k : v.__getitem__(index) for k, v in self.data.items()
+            k : self.data[k].__getitem__(index) for k in keys
         }
         return self.__class__(self.index.__getitem__(index), selected_dict)
 
@@ -63,16 +158,23 @@ class TensorBundle(T.Generic[T_Fields]):
             for k, v in self.data.items()
         }
     
+    def memory_usage(self) -> dict[str, tuple[int, int]]:
+        """
+        Returns {field: (used bytes, allocated bytes)} of all fields (and the index).
+        """
+        return {"index": tensor_memory(self.index)} | {k: tensor_memory(v) for k, v in self.data.items()}
+    
     @classmethod
     def deserialize(cls, prefix: str, value: dict[str, np.ndarray]) -> Self:
-        allowed_fields: T_Fields | None = T.get_args(cls.__orig_bases__[0].__args__[0])  # type: ignore
-        if not allowed_fields:
-            raise Exception("T_Fields must be specified with concrete string literal types.")
-        
+        # NOTE: fields are recovered from the serialized keys since type arguments (T_Fields) of 
+        # generic alias like `AutoScalingBundle[PointFeature]` are not available at runtime.
+        key_prefix = f"{prefix}/"
         data: dict[T_Fields, torch.Tensor] = T.cast(dict[T_Fields, torch.Tensor], {
-            k : torch.tensor(value[f"{prefix}/k"])
-            for k in allowed_fields
+            k[len(key_prefix):] : torch.tensor(v)
+            for k, v in value.items() if k.startswith(key_prefix)
         })
+        if len(data) == 0:
+            raise KeyError(f"No field with prefix '{key_prefix}' is found in serialized value.")
         return cls.init(data)
   
 
@@ -82,34 +184,198 @@ class AutoScalingBundle(TensorBundle[T_Fields]):
         self.index = index
         self.data  = data
         self.edges_from: list[Scaling_DenseEdge_Multi | Scaling_SparseEdge_Multi | Scaling_SingleEdge] = []
+        self.listeners : list[BundleListener] = []
+        # Optional columns not materialized in `data` yet, see `declare_optional`
+        self.optional  : dict[T_Fields, OptionalColumn] = dict()
+        # Columns stored in packed form, see `declare_packed`
+        self.packed    : dict[T_Fields, PackedSymmetric] = dict()
+        # Entered around every mutation, see `guarded`
+        self.guard     : contextlib.AbstractContextManager = contextlib.nullcontext()
     
-    def __getitem__(self, index) -> TensorBundle[T_Fields]:
-        selected_dict: dict[T_Fields, torch.Tensor] = {
-            k : v.__getitem__(index) for k, v in self.data.items()
-        }
-        return TensorBundle[T_Fields](self.index.__getitem__(index), selected_dict)
+    def declare_optional(self, field: T_Fields, shape: T.Sequence[int], dtype: torch.dtype, fill: int | float = -1) -> None:
+        """
+        Declare `field` as an optional column of shape (N, *shape). The column takes no storage (and is not in 
+        `data` nor serialized) until a pushed value contains it, then rows pushed before are back-filled with
+        `fill`. Once materialized, pushed values without the field are filled with `fill` as well.
+        
+        Selecting an absent optional column explicitly (`select(index, fields)`) returns `fill` values.
+        """
+        self.optional[field] = OptionalColumn(tuple(shape), dtype, fill)
+    
+    @guarded
+    def declare_packed(self, field: T_Fields, codec: PackedSymmetric) -> None:
+        """
+        Store symmetric matrix column `field` in packed form. Values are encoded on push and expanded by
+        `select` / `__getitem__` / `column`, `data[field]` (and serialized value) holds the packed storage.
+        Existing rows are converted if the column is not packed yet.
+        """
+        self.packed[field] = codec
+        column = self.data[field]
+        if tuple(column.shape[1:]) == (codec.size,): return     # Already packed (e.g. deserialized)
+        
+        packed = AutoScalingTensor((max(column._curr_max_size, 1), codec.size), grow_on=0, dtype=codec.dtype,
+                                   growth=column.growth, allocator=column.allocator)
+        packed.push(codec.encode(column.tensor))
+        self.data[field] = packed
+        column.release()
     
-    def push(self, value: TensorBundle[T_Fields]) -> torch.Tensor:
-        start_idx = self.index.size(0)
+    def column(self, field: T_Fields) -> torch.Tensor:
+        """
+        All rows of `field`, packed column is expanded (a copy), otherwise the live view.
+        """
+        if field in self.packed: return self.packed[field].decode(self.data[field].tensor)
+        return self.data[field].tensor
+    
+    @guarded
+    def write_column(self, field: T_Fields, index, value: torch.Tensor) -> None:
+        """
+        Write `value` to rows at `index` of `field`, value is encoded if the column is packed. Listeners are
+        notified through `on_modify`.
+        """
+        if field in self.packed: value = self.packed[field].encode(value)
+        self.data[field][index] = value.to(self.data[field].dtype)
+        if len(self.listeners) > 0:
+            rows = self.index.tensor[index]
+            for listener in self.listeners: listener.on_modify(rows, (field,))
+    
+    def select(self, index, fields: T.Iterable[T_Fields] | None = None) -> TensorBundle[T_Fields]:
+        keys = self.data.keys() if fields is None else fields
+        selected_index = self.index.tensor[index]
+        selected_dict: dict[T_Fields, torch.Tensor] = dict()
+        for k in keys:
+            if k not in self.data : selected_dict[k] = self.optional[k].filled(selected_index.numel())\
+                                                        .view(*selected_index.shape, *self.optional[k].shape)
+            elif k in self.packed : selected_dict[k] = self.packed[k].decode(self.data[k].tensor[index])
+            else                  : selected_dict[k] = self.data[k].tensor[index]
+        return TensorBundle(selected_index, selected_dict)
+    
+    def __len__(self) -> int:
+        return self.index.current_size
+    
+    def view(self, fields: T.Iterable[T_Fields] | None = None) -> TensorBundle[T_Fields]:
+        """
+        All rows as a plain TensorBundle with the same fields and shapes as `select(slice(None), fields)`.
+        Indexing and arithmetic on the view skip the AutoScalingTensor dispatch. Columns are live views (no copy,
+        writes are visible in the bundle), except packed columns (expanded copy) and absent optional columns.
+        
+        NOTE: the view is only valid until the next push (which may reallocate the storage).
+        """
+        keys = self.data.keys() if fields is None else fields
+        data: dict[T_Fields, torch.Tensor] = dict()
+        for k in keys:
+            if k not in self.data : data[k] = self.optional[k].filled(len(self))
+            elif k in self.packed : data[k] = self.packed[k].decode(self.data[k].tensor)
+            else                  : data[k] = self.data[k].tensor
+        return TensorBundle(self.index.tensor, data)
+    
+    @guarded
+    def push(self, value: TensorBundle[T_Fields], notify: bool = True) -> torch.Tensor:
+        """
+        Append rows of `value`, edges from this bundle are extended with empty rows. If `notify` is false,
+        the caller is responsible to call `notify_listeners` later (e.g. after a batch of push is committed).
+        """
+        for k in value.data:
+            if k not in self.data and k in self.optional: self.__materialize(k)
+        
+        start_idx = self.index.current_size
         new_index = torch.arange(start_idx, start_idx + len(value))
         self.index.push(new_index)
         for k in self.data:
-            self.data[k].push(value.data[k])
+            if k in value.data:
+                self.data[k].push(self.packed[k].encode(value.data[k]) if k in self.packed else value.data[k])
+            elif k in self.optional : self.data[k].extend(len(value))
+            else                    : raise KeyError(f"Pushed value does not contain required field '{k}'")
         
         for edge in self.edges_from:
-            if isinstance(edge, Scaling_SparseEdge_Multi):
-                edge.push(SparseEdge_Multi(len(value), edge.max_deg))
-            elif isinstance(edge, Scaling_DenseEdge_Multi):
-                edge.push(DenseEdge_Multi(len(value), edge.max_deg))
-            elif isinstance(edge, Scaling_SingleEdge):
-                edge.push(SingleEdge(len(value)))
-            else: raise Exception("Impossible")
+            for tensor in scaling_tensors(edge).values(): tensor.extend(len(value))
         
+        if notify: self.notify_listeners(new_index, value)
         return new_index
+    
+    def notify_listeners(self, index: torch.Tensor, value: TensorBundle[T_Fields]) -> None:
+        for listener in self.listeners:
+            listener.on_push(index, value)
+    
+    @guarded
+    def ensure_capacity(self, size: int) -> None:
+        """
+        Grow all fields (and edges from this bundle) so that `size` rows fit without further reallocation.
+        """
+        for tensor in self.__tensors_with_edges(): tensor.ensure_capacity(size)
+    
+    @guarded
+    def truncate(self, size: int) -> None:
+        """
+        Drop all rows (and rows of edges from this bundle) after the first `size` ones. Listeners are not notified.
+        """
+        for tensor in self.__tensors_with_edges(): tensor.truncate(size)
+
+    @guarded
+    def compact(self, keep: torch.Tensor) -> torch.Tensor:
+        """
+        Remove rows where boolean mask `keep` is false (with rows of edges from this bundle), remaining rows
+        are renumbered in order. Returns the old-to-new row index (-1 for removed rows).
+        
+        NOTE: content of edges *to* this bundle and listeners are not updated, the caller should remap them.
+        """
+        old_to_new = torch.full((len(self),), -1, dtype=torch.long)
+        old_to_new[keep] = torch.arange(int(keep.sum().item()))
+        for tensor in self.__tensors_with_edges(): tensor.compact(keep)
+        self.index.tensor.copy_(torch.arange(len(self)))
+        return old_to_new
+
+    @classmethod
+    def deserialize(cls, prefix: str, value: dict[str, np.ndarray]) -> Self:
+        tensor_bundle = super().deserialize(prefix, value)
+        
+        # Convert from torch.Tensor to AutoScalingTensor
+        tensor_bundle.index = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_bundle.index, init_size=tensor_bundle.index.size(0))
+        tensor_bundle.data  = {
+            k: AutoScalingTensor(None, grow_on=0, init_tensor=v, init_size=v.size(0))
+            for k, v in tensor_bundle.data.items()
+        }
+        return tensor_bundle
 
     def register_edge(self, edge: Scaling_SparseEdge_Multi | Scaling_DenseEdge_Multi | Scaling_SingleEdge):
         self.edges_from.append(edge)
     
+    @guarded
+    def reserve(self, capacity: int) -> None:
+        """
+        Preallocate all fields (and edges from this bundle) to hold `capacity` rows without reallocation.
+        """
+        for tensor in self.__tensors_with_edges(): tensor.reserve(capacity)
+    
+    @guarded
+    def shrink_to_fit(self) -> None:
+        """
+        Release capacity slack of all fields (and edges from this bundle).
+        """
+        for tensor in self.__tensors_with_edges(): tensor.shrink_to_fit()
+    
+    @guarded
+    def discard_optional(self, fields: T.Iterable[T_Fields]) -> None:
+        """
+        Drop materialized optional columns `fields`, they take no storage (and are not in `data`) again. Used to
+        roll back a failed push that materialized them.
+        """
+        for field in list(fields):
+            assert field in self.optional, f"{field} is not an optional column."
+            self.data.pop(field).release()
+    
+    def __materialize(self, field: T_Fields) -> None:
+        column = self.optional[field]
+        tensor = AutoScalingTensor((max(self.index._curr_max_size, 1), *column.shape), grow_on=0, dtype=column.dtype,
+                                   init_val=column.fill, growth=self.index.growth, allocator=self.index.allocator)
+        tensor.extend(len(self))
+        self.data[field] = tensor
+    
+    def __tensors_with_edges(self) -> list[AutoScalingTensor]:
+        return [*scaling_tensors(self).values(), *(t for edge in self.edges_from for t in scaling_tensors(edge).values())]
+    
+    def register_listener(self, listener: BundleListener):
+        self.listeners.append(listener)
+    
     def __repr__(self) -> str:
         return f"ScalingBundle(size={len(self)}, keys=[{', '.join(self.data.keys())}])"
 
@@ -128,6 +394,12 @@ class EdgeLike(ABC):
     @classmethod
     @abstractmethod
     def deserialize(cls, prefix: str, value: dict[str, np.ndarray]) -> Self: ...
+    
+    def memory_usage(self) -> dict[str, tuple[int, int]]:
+        """
+        Returns {attribute: (used bytes, allocated bytes)} of all tensors holding the edge.
+        """
+        return {k: tensor_memory(v) for k, v in vars(self).items() if isinstance(v, (torch.Tensor, AutoScalingTensor))}
 
 
 class SparseEdge_Multi(EdgeLike):
@@ -156,8 +428,8 @@ class SparseEdge_Multi(EdgeLike):
     
     @classmethod
     def deserialize(cls, prefix: str, value: dict[str, np.ndarray]) -> Self:
-        edges = torch.Tensor(value[f"{prefix}/edges"])
-        deg   = torch.Tensor(value[f"{prefix}/deg"])
+        edges = torch.tensor(value[f"{prefix}/edges"])
+        deg   = torch.tensor(value[f"{prefix}/deg"])
         num_from, max_deg = edges.shape[0], edges.shape[1]
         
         edge_instance = cls(num_from, max_deg)
@@ -257,8 +529,8 @@ class Scaling_SparseEdge_Multi(SparseEdge_Multi):
         tensor_edge = super().deserialize(prefix, value)
         
         # Convert from torch.Tensor to AutoScalingTensor
-        tensor_edge.out_deg = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.out_deg)
-        tensor_edge.edges   = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.edges)
+        tensor_edge.out_deg = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.out_deg, init_val=0, init_size=tensor_edge.out_deg.size(0))
+        tensor_edge.edges   = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.edges, init_val=-1, init_size=tensor_edge.edges.size(0))
         return tensor_edge
 
 
@@ -277,8 +549,8 @@ class Scaling_DenseEdge_Multi(DenseEdge_Multi):
         tensor_edge = super().deserialize(prefix, value)
         
         # Convert from torch.Tensor to AutoScalingTensor
-        tensor_edge.ranges     = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.ranges)
-        tensor_edge.num_ranges = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.num_ranges)
+        tensor_edge.ranges     = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.ranges, init_val=-1, init_size=tensor_edge.ranges.size(0))
+        tensor_edge.num_ranges = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.num_ranges, init_val=0, init_size=tensor_edge.num_ranges.size(0))
         return tensor_edge
 
 
@@ -294,5 +566,5 @@ class Scaling_SingleEdge(SingleEdge):
         tensor_edge = super().deserialize(prefix, value)
 
         # Convert from torch.Tensor to AutoScalingTensor
-        tensor_edge.mapping = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.mapping)
+        tensor_edge.mapping = AutoScalingTensor(None, grow_on=0, init_tensor=tensor_edge.mapping, init_val=-1, init_size=tensor_edge.mapping.size(0))
         return tensor_edge
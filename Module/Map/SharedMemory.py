@@ -0,0 +1,320 @@
+"""
+Place storage of `VisualMap` in named shared memory, so other processes (visualization, analysis) can watch
+a live run without waiting for `tensor_map.npz` or copying data across process boundaries.
+"""
+from __future__ import annotations
+
+import math
+import json
+import time
+import atexit
+import torch
+import numpy as np
+import typing as T
+from multiprocessing import shared_memory, resource_tracker
+
+from Utility.Extensions import TensorAllocator
+from .Graph import scaling_tensors
+
+if T.TYPE_CHECKING:
+    from .VisualMap import VisualMap
+
+
+# Header segment layout: int64 sequence number, descriptor length, map version, layout generation, then int64
+# length of every tensor (at its "slot" in the descriptor) and the JSON descriptor.
+HEADER_SIZE  : T.Final[int] = 1 << 20
+HEADER_SLOTS : T.Final[int] = 4
+MAX_TENSORS  : T.Final[int] = 1024
+HEADER_OFFSET: T.Final[int] = 8 * (HEADER_SLOTS + MAX_TENSORS)
+
+
+def attach_segment(name: str) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=name)
+    # The attaching process does not own the segment, keep resource tracker from unlinking it on exit.
+    resource_tracker.unregister(segment._name, "shared_memory")  # type: ignore
+    return segment
+
+
+def segment_tensor(segment: shared_memory.SharedMemory, shape: T.Sequence[int], dtype: torch.dtype) -> torch.Tensor:
+    assert segment.buf is not None
+    return torch.frombuffer(segment.buf, dtype=dtype, count=math.prod(shape)).view(*shape)
+
+
+class SharedMemoryAllocator(TensorAllocator):
+    """
+    Allocate every `AutoScalingTensor` storage as a new named shared memory segment `<prefix>_<id>`.
+    Released segments are unlinked immediately (attached readers keep their mapping) and closed once no
+    tensor view refers to them anymore. `generation` counts allocations and releases, i.e. layout changes.
+    """
+    def __init__(self, prefix: str) -> None:
+        self.prefix      = prefix
+        self.num_segment = 0
+        self.generation  = 0
+        self.segments: dict[int, shared_memory.SharedMemory] = dict()     # data_ptr -> segment
+        self.retired : list[shared_memory.SharedMemory] = []
+
+    def allocate(self, shape: T.Sequence[int], dtype: torch.dtype) -> torch.Tensor:
+        nbytes  = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+        assert nbytes > 0, "Shared memory storage can not be empty."
+        segment = shared_memory.SharedMemory(name=f"{self.prefix}_{self.num_segment}", create=True, size=nbytes)
+        self.num_segment += 1
+        self.generation  += 1
+
+        tensor = segment_tensor(segment, shape, dtype)
+        self.segments[tensor.data_ptr()] = segment
+        return tensor
+
+    def release(self, tensor: torch.Tensor) -> None:
+        segment = self.segments.pop(tensor.data_ptr(), None)
+        if segment is None: return
+        self.__retire(segment)
+        self.__close_retired()
+
+    def retain(self, data_ptrs: set[int]) -> None:
+        """
+        Release all segments except the ones holding storages at `data_ptrs`.
+        """
+        for data_ptr in [ptr for ptr in self.segments if ptr not in data_ptrs]:
+            self.__retire(self.segments.pop(data_ptr))
+        self.__close_retired()
+
+    def segment_name(self, tensor: torch.Tensor) -> str | None:
+        segment = self.segments.get(tensor.data_ptr())
+        return None if segment is None else segment.name
+
+    def unlink_all(self) -> None:
+        """
+        Remove names of all segments. Memory stays mapped for this process (and attached readers).
+        """
+        for segment in self.segments.values(): self.__unlink(segment)
+        self.__close_retired()
+
+    def __retire(self, segment: shared_memory.SharedMemory) -> None:
+        self.generation += 1
+        self.__unlink(segment)
+        self.retired.append(segment)
+
+    def __close_retired(self) -> None:
+        alive = []
+        for segment in self.retired:
+            try:
+                segment.close()
+            except BufferError:     # Still referenced by some tensor view, try again on next release.
+                alive.append(segment)
+        self.retired = alive
+
+    @staticmethod
+    def __unlink(segment: shared_memory.SharedMemory) -> None:
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedMapPublisher:
+    """
+    Writer side of a shared-memory `VisualMap`, see `VisualMap.enable_shared_memory`.
+
+    All storage (stores and edges) of the map is moved to segments of `SharedMemoryAllocator`. A header
+    segment `<name>` describes every tensor as {"<component>/<field>": segment, dtype, shape, slot}, the
+    map version and the length of every tensor (at its slot) are plain int64 in the header. The header is
+    guarded by a seqlock: the sequence number is odd while the map is being mutated (the publisher is
+    installed as `guard` of the map and its stores) and the header is updated before it becomes even again.
+    The JSON descriptor is only rewritten when the storage layout changed (reallocation, new column), other
+    mutations only cost a few integer writes.
+    """
+    def __init__(self, gmap: "VisualMap", name: str) -> None:
+        self.name      = name
+        self.allocator = SharedMemoryAllocator(name)
+        self.header    = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE)
+        assert self.header.buf is not None
+        self.sequence  = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=self.header.buf)
+        self.lengths   = np.ndarray((MAX_TENSORS,), dtype=np.int64, buffer=self.header.buf, offset=8 * HEADER_SLOTS)
+        self.sequence[:] = 0
+        self.depth     = 0
+        self.closed    = False
+        # Tensors at each slot of the last written descriptor and the allocator generation it describes
+        self.published: list[T.Any] = []
+        self.generation = -1
+
+        self.attach(gmap)
+        atexit.register(self.close)
+
+    def attach(self, gmap: "VisualMap") -> None:
+        """
+        Publish `gmap` (again, e.g. after its stores are replaced by `load_state_dict`).
+        """
+        self.map = gmap
+        with self:
+            gmap.guard = self
+            for store in gmap._stores().values(): store.guard = self
+            alive = set()
+            for component in gmap._components().values():
+                for tensor in scaling_tensors(component).values():
+                    tensor.set_allocator(self.allocator)
+                    alive.add(tensor._tensor.data_ptr())
+            # Storage of a previously attached map is no longer published.
+            self.allocator.retain(alive)
+            self.generation = -1
+
+    def __enter__(self) -> None:
+        if self.depth == 0: self.sequence[0] += 1
+        self.depth += 1
+
+    def __exit__(self, *_) -> bool:
+        self.depth -= 1
+        if self.depth == 0:
+            self.publish()
+            self.sequence[0] += 1
+        return False
+
+    def publish(self) -> None:
+        if self.closed: return
+        if self.generation != self.allocator.generation: self.__publish_layout()
+        for slot, tensor in enumerate(self.published): self.lengths[slot] = tensor.current_size
+        self.sequence[2] = self.map.version
+
+    def __publish_layout(self) -> None:
+        tensors, self.published = dict(), []
+        for component_name, component in self.map._components().items():
+            for field, tensor in scaling_tensors(component).items():
+                segment = self.allocator.segment_name(tensor._tensor)
+                if segment is None: continue
+                tensors[f"{component_name}/{field}"] = {
+                    "segment": segment,
+                    "dtype"  : str(tensor._tensor.dtype).removeprefix("torch."),
+                    "shape"  : list(tensor._tensor.shape),
+                    "grow_on": tensor.grow_on,
+                    "slot"   : len(self.published),
+                }
+                self.published.append(tensor)
+        assert len(self.published) <= MAX_TENSORS, "Shared map has more tensors than header slots."
+        packed  = {
+            f"{store_name}/{field}": codec.dim
+            for store_name, store in self.map._stores().items() for field, codec in store.packed.items()
+        }
+        payload = json.dumps({"tensors": tensors, "packed": packed}).encode()
+        assert HEADER_OFFSET + len(payload) <= HEADER_SIZE, "Shared map descriptor exceeds header size."
+        assert self.header.buf is not None
+        self.header.buf[HEADER_OFFSET:HEADER_OFFSET + len(payload)] = payload
+        self.sequence[1] = len(payload)
+        self.generation  = self.allocator.generation
+        self.sequence[3] = self.generation
+
+    def close(self) -> None:
+        """
+        Remove names of header and all segments, the map keeps working on its (now private) storage.
+        """
+        if self.closed: return
+        self.closed = True
+        self.allocator.unlink_all()
+        try:
+            self.header.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedMapReader:
+    """
+    Read-only access to a map published by `SharedMapPublisher`, from any process on the same host.
+
+    * `snapshot` - consistent copy of the requested tensors (retries while the map is being mutated).
+    * `views`    - zero-copy views of the requested tensors. Rows of `points` / `match` are never modified
+                   after push, so their views are stable until the next compaction of the map.
+
+    Packed covariance columns (listed in `packed`) can be expanded with `Utility.Math.unpack_symmetric`.
+    """
+    def __init__(self, name: str) -> None:
+        self.header   = attach_segment(name)
+        assert self.header.buf is not None
+        self.sequence = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=self.header.buf)
+        self.lengths  = np.ndarray((MAX_TENSORS,), dtype=np.int64, buffer=self.header.buf, offset=8 * HEADER_SLOTS)
+        self.segments: dict[str, shared_memory.SharedMemory] = dict()
+        # Segments no longer in the descriptor but still referenced by views handed out, closed once released.
+        self.retired : list[shared_memory.SharedMemory] = []
+        self.packed  : dict[str, int] = dict()
+        # Parsed descriptor and the layout generation it describes, reparsed only when the layout changed.
+        self.tensors : dict[str, dict] = dict()
+        self.generation = -1
+
+    def snapshot(self, fields: T.Iterable[str] | None = None, timeout: float = 1.) -> tuple[int, dict[str, torch.Tensor]]:
+        """
+        Returns (map version, {"<component>/<field>": copied tensor}) for all (or the given) fields.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = int(self.sequence[0])
+            if sequence % 2 == 0:
+                try:
+                    version, views = self.__read(fields)
+                    copied = {k: v.clone() for k, v in views.items()}
+                    if int(self.sequence[0]) == sequence: return version, copied
+                except (FileNotFoundError, ValueError):     # Storage replaced while reading
+                    pass
+                self.generation = -1
+            if time.monotonic() > deadline: raise TimeoutError(f"Unable to read a consistent snapshot of {self.header.name}")
+            time.sleep(1e-4)
+
+    def views(self, fields: T.Iterable[str] | None = None, timeout: float = 1.) -> tuple[int, dict[str, torch.Tensor]]:
+        """
+        Returns (map version, {"<component>/<field>": zero-copy view}) for all (or the given) fields.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = int(self.sequence[0])
+            if sequence % 2 == 0:
+                try:
+                    result = self.__read(fields)
+                    if int(self.sequence[0]) == sequence: return result
+                except (FileNotFoundError, ValueError):
+                    pass
+                self.generation = -1
+            if time.monotonic() > deadline: raise TimeoutError(f"Unable to read a consistent view of {self.header.name}")
+            time.sleep(1e-4)
+
+    def close(self) -> None:
+        for segment in [*self.segments.values(), *self.retired, self.header]:
+            try:
+                segment.close()
+            except BufferError:
+                pass
+        self.segments.clear()
+        self.retired.clear()
+
+    def __release_unreferenced(self) -> None:
+        """
+        Close segments retired by the publisher (storage reallocated or replaced), so a long run does not keep
+        a mapping of every past storage.
+        """
+        referenced = {desc["segment"] for desc in self.tensors.values()}
+        for name in [name for name in self.segments if name not in referenced]:
+            self.retired.append(self.segments.pop(name))
+        alive = []
+        for segment in self.retired:
+            try:
+                segment.close()
+            except BufferError:     # Still referenced by a view, try again on next layout change.
+                alive.append(segment)
+        self.retired = alive
+
+    def __read(self, fields: T.Iterable[str] | None) -> tuple[int, dict[str, torch.Tensor]]:
+        assert self.header.buf is not None
+        generation = int(self.sequence[3])
+        if generation != self.generation:
+            length     = int(self.sequence[1])
+            descriptor = json.loads(bytes(self.header.buf[HEADER_OFFSET:HEADER_OFFSET + length]))
+            self.tensors, self.packed, self.generation = descriptor["tensors"], descriptor["packed"], generation
+            self.__release_unreferenced()
+
+        version = int(self.sequence[2])
+        keys    = self.tensors.keys() if fields is None else fields
+        result  = dict()
+        for key in keys:
+            desc    = self.tensors[key]
+            segment = self.segments.get(desc["segment"])
+            if segment is None:
+                segment = attach_segment(desc["segment"])
+                self.segments[desc["segment"]] = segment
+            storage     = segment_tensor(segment, desc["shape"], getattr(torch, desc["dtype"]))
+            result[key] = storage.narrow(desc["grow_on"], 0, int(self.lengths[desc["slot"]]))
+        return version, result
@@ -0,0 +1,293 @@
+"""
+Provide incrementally maintained spatial index over the 3D points stored in `VisualMap`.
+"""
+from __future__ import annotations
+
+import math
+import torch
+import pypose as pp
+import typing as T
+
+from Utility.Extensions import AutoScalingTensor
+from .Graph import TensorBundle
+
+
+class VoxelHashIndex:
+    """
+    A voxel hash over the `pos_Tw` field of a point store.
+
+    Each occupied voxel holds the (global) row indices of points that fall in it. The index is updated
+    on every `AutoScalingBundle.push` (see `AutoScalingBundle.register_listener`), so all queries below
+    only touch the voxels near the query instead of scanning the whole store.
+
+    * `query_radius` - all points within `radius` of each center, returned as (query_idx, point_idx) pairs.
+    * `query_knn`    - k nearest points of each center, returned as (M, k) index / distance tensors.
+    * `query_frustum`- all points visible by a (NED) pinhole camera, returned as (query_idx, point_idx) pairs.
+    """
+    # Voxel coordinates are packed into a single int64 key with 21 bits per axis.
+    COORD_BITS  : T.Final[int] = 21
+    COORD_OFFSET: T.Final[int] = 1 << (COORD_BITS - 1)
+
+    def __init__(self, positions: AutoScalingTensor, voxel_size: float) -> None:
+        assert voxel_size > 0., f"voxel_size must be positive, get {voxel_size}"
+        self.positions  = positions
+        self.voxel_size = voxel_size
+
+        self.buckets: dict[int, list[torch.Tensor]] = dict()
+        # Coordinate of every occupied voxel, used by frustum query to cull voxels before touching points.
+        self.voxel_coords = AutoScalingTensor((1024, 3), grow_on=0, dtype=torch.long)
+        self.num_indexed  = 0
+
+    def __len__(self) -> int:
+        return self.num_indexed
+
+    def __repr__(self) -> str:
+        return f"VoxelHashIndex(voxel_size={self.voxel_size}, #voxel={len(self.buckets)}, #point={self.num_indexed})"
+
+    ### Key computation
+    def voxel_coord(self, pos: torch.Tensor) -> torch.Tensor:
+        return torch.floor(pos.double() / self.voxel_size).long()
+
+    @classmethod
+    def voxel_key(cls, coord: torch.Tensor) -> torch.Tensor:
+        shifted = coord + cls.COORD_OFFSET
+        return (shifted[..., 0] << (2 * cls.COORD_BITS)) | (shifted[..., 1] << cls.COORD_BITS) | shifted[..., 2]
+
+    @classmethod
+    def key_to_coord(cls, key: torch.Tensor) -> torch.Tensor:
+        mask = (1 << cls.COORD_BITS) - 1
+        return torch.stack([
+            (key >> (2 * cls.COORD_BITS)) & mask,
+            (key >> cls.COORD_BITS) & mask,
+            key & mask
+        ], dim=-1) - cls.COORD_OFFSET
+
+    ### Maintenance
+    def on_push(self, index: torch.Tensor, value: TensorBundle) -> None:
+        self.insert(index, value.data["pos_Tw"])
+
+    def on_modify(self, index: torch.Tensor, fields: tuple[str, ...]) -> None:
+        # Rows modified in-place (e.g. fused map points) stay in the voxel they are inserted to.
+        pass
+
+    def insert(self, index: torch.Tensor, pos: torch.Tensor, keys: torch.Tensor | None = None) -> None:
+        """
+        Index rows `index` by their position. If `keys` is provided, rows are indexed under the given voxel
+        keys instead (e.g. rows whose position is fused over time but should stay in its original voxel).
+        """
+        if index.numel() == 0: return
+        keys  = self.voxel_key(self.voxel_coord(pos.cpu())) if keys is None else keys.cpu()
+        order = torch.argsort(keys)
+        keys_sorted, index_sorted = keys[order], index.cpu()[order]
+        uniq_keys, counts = torch.unique_consecutive(keys_sorted, return_counts=True)
+
+        new_keys = []
+        for key, group in zip(uniq_keys.tolist(), torch.split(index_sorted, counts.tolist())):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = [group]
+                new_keys.append(key)
+            else:
+                bucket.append(group)
+
+        if len(new_keys) > 0:
+            self.voxel_coords.push(self.key_to_coord(torch.tensor(new_keys, dtype=torch.long)))
+        self.num_indexed += index.numel()
+
+    def rebuild(self, index: torch.Tensor, pos: torch.Tensor) -> None:
+        """
+        Drop all entries and re-index the given rows, used when rows of underlying store are remapped.
+        """
+        self.buckets.clear()
+        self.voxel_coords = AutoScalingTensor((1024, 3), grow_on=0, dtype=torch.long)
+        self.num_indexed  = 0
+        self.insert(index, pos)
+
+    def remap(self, old_to_new: torch.Tensor) -> None:
+        """
+        Renumber indexed rows after the underlying store is compacted, rows mapped to -1 are removed.
+        Unlike `rebuild`, rows stay in their current voxel (see `insert` with `keys`).
+        """
+        buckets: dict[int, list[torch.Tensor]] = dict()
+        for key, bucket in self.buckets.items():
+            rows = old_to_new[torch.cat(bucket)]
+            rows = rows[rows >= 0]
+            if rows.numel() > 0: buckets[key] = [rows]
+        
+        self.buckets      = buckets
+        self.voxel_coords = AutoScalingTensor((1024, 3), grow_on=0, dtype=torch.long)
+        if len(buckets) > 0:
+            self.voxel_coords.push(self.key_to_coord(torch.tensor(list(buckets.keys()), dtype=torch.long)))
+        self.num_indexed  = sum(bucket[0].numel() for bucket in buckets.values())
+
+    def state_dict(self) -> dict[str, torch.Tensor]:
+        """
+        Snapshot of the index (bucket content and order), used for checkpointing. Restore with `load_state_dict`.
+        """
+        groups  = [torch.cat(bucket) for bucket in self.buckets.values()]
+        return {
+            "keys"        : torch.tensor(list(self.buckets.keys()), dtype=torch.long),
+            "lengths"     : torch.tensor([g.size(0) for g in groups], dtype=torch.long),
+            "points"      : torch.cat(groups) if len(groups) > 0 else torch.zeros((0,), dtype=torch.long),
+            "voxel_coords": self.voxel_coords.tensor.clone(),
+        }
+
+    def load_state_dict(self, state: dict[str, torch.Tensor]) -> None:
+        self.buckets = {
+            key: [group]
+            for key, group in zip(state["keys"].tolist(), torch.split(state["points"], state["lengths"].tolist()))
+        }
+        self.voxel_coords = AutoScalingTensor((1024, 3), grow_on=0, dtype=torch.long)
+        self.voxel_coords.push(state["voxel_coords"])
+        self.num_indexed  = state["points"].numel()
+
+    def lookup(self, keys: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Given K voxel keys, returns (points, starts, lengths) where points[starts[i]:starts[i]+lengths[i]]
+        are row indices stored in voxel keys[i] (empty if the voxel is not occupied).
+        """
+        groups : list[torch.Tensor] = []
+        lengths: list[int] = []
+        for key in keys.tolist():
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                lengths.append(0)
+                continue
+            if len(bucket) > 1:
+                # Consolidate fragments so repeated queries do not pay for concatenation again.
+                bucket[:] = [torch.cat(bucket)]
+            groups.append(bucket[0])
+            lengths.append(bucket[0].size(0))
+
+        points    = torch.cat(groups) if len(groups) > 0 else torch.zeros((0,), dtype=torch.long)
+        length_ts = torch.tensor(lengths, dtype=torch.long)
+        starts    = torch.cumsum(length_ts, dim=0) - length_ts
+        return points, starts, length_ts
+
+    ### Queries
+    def _candidates(self, centers: torch.Tensor, ring: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns (query_idx, point_idx) for all points in voxels within `ring` voxels of each center.
+        """
+        offset_range = torch.arange(-ring, ring + 1, dtype=torch.long)
+        offsets      = torch.cartesian_prod(offset_range, offset_range, offset_range)       # K x 3
+        cand_coords  = self.voxel_coord(centers).unsqueeze(1) + offsets.unsqueeze(0)        # M x K x 3
+        cand_keys    = self.voxel_key(cand_coords).flatten()                                # (M*K)
+
+        uniq_keys, inverse = torch.unique(cand_keys, return_inverse=True)
+        points, starts, lengths = self.lookup(uniq_keys)
+
+        pair_length = lengths[inverse]                                                      # (M*K)
+        pair_query  = torch.arange(centers.size(0)).repeat_interleave(offsets.size(0))      # (M*K)
+        total       = int(pair_length.sum().item())
+        if total == 0:
+            empty = torch.zeros((0,), dtype=torch.long)
+            return empty, empty
+
+        query_idx   = torch.repeat_interleave(pair_query, pair_length)
+        pair_start  = torch.repeat_interleave(starts[inverse], pair_length)
+        pair_base   = torch.repeat_interleave(torch.cumsum(pair_length, dim=0) - pair_length, pair_length)
+        point_idx   = points[pair_start + (torch.arange(total) - pair_base)]
+        return query_idx, point_idx
+
+    @torch.no_grad()
+    def query_radius(self, centers: torch.Tensor, radius: float) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Given M centers (Mx3), returns (query_idx, point_idx, ) of all points within `radius` to the center.
+        """
+        centers  = centers.cpu().reshape(-1, 3)
+        ring     = max(1, math.ceil(radius / self.voxel_size))
+        query_idx, point_idx = self._candidates(centers, ring)
+
+        dist     = (self.positions.tensor[point_idx].double() - centers[query_idx].double()).norm(dim=-1)
+        inside   = dist <= radius
+        return query_idx[inside], point_idx[inside]
+
+    @torch.no_grad()
+    def query_knn(self, centers: torch.Tensor, k: int, max_ring: int = 4) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Given M centers (Mx3), returns (index, distance) both with shape Mxk, sorted by ascending distance.
+        Searching expands ring-by-ring up to `max_ring` voxels from the center. If less than k points are
+        found, remaining slots are filled with index=-1 and distance=inf.
+        """
+        centers  = centers.cpu().reshape(-1, 3)
+        M        = centers.size(0)
+        out_idx  = torch.full((M, k), -1, dtype=torch.long)
+        out_dist = torch.full((M, k), math.inf, dtype=torch.float64)
+        pending  = torch.arange(M)
+
+        for ring in range(1, max_ring + 1):
+            if pending.numel() == 0: break
+            # Any point with distance <= ring * voxel_size is guaranteed to be among the candidates.
+            radius = ring * self.voxel_size
+            local_query, point_idx = self._candidates(centers[pending], ring)
+            dist   = (self.positions.tensor[point_idx].double() - centers[pending][local_query].double()).norm(dim=-1)
+
+            # Sort by (query, distance) and compute rank of each candidate within its query.
+            order  = torch.argsort(dist, stable=True)
+            order  = order[torch.argsort(local_query[order], stable=True)]
+            local_query, point_idx, dist = local_query[order], point_idx[order], dist[order]
+            counts = torch.bincount(local_query, minlength=pending.numel())
+            rank   = torch.arange(local_query.numel()) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+
+            resolved = torch.zeros((pending.numel(),), dtype=torch.bool)
+            resolved[local_query[(rank == k - 1) & (dist <= radius)]] = True
+            if ring == max_ring: resolved[:] = True
+
+            keep = (rank < k) & resolved[local_query]
+            out_idx [pending[local_query[keep]], rank[keep]] = point_idx[keep]
+            out_dist[pending[local_query[keep]], rank[keep]] = dist[keep]
+            pending = pending[~resolved]
+
+        return out_idx, out_dist
+
+    @torch.no_grad()
+    def query_frustum(self, poses: pp.LieTensor | torch.Tensor, K: torch.Tensor, width: int, height: int,
+                      max_depth: float, min_depth: float = 0.) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Given B camera poses (Bx7, sensor-to-world SE3 under NED convention) and intrinsic K (3x3 or Bx3x3),
+        returns (query_idx, point_idx, ) of all points that project into the image with depth in [min_depth, max_depth].
+        """
+        poses = pp.SE3(poses.cpu()).double().reshape(-1, 7)     # type: ignore
+        Ks    = K.cpu().double().reshape(-1, 3, 3).expand(poses.size(0), 3, 3)
+
+        if self.voxel_coords.current_size == 0:
+            empty = torch.zeros((0,), dtype=torch.long)
+            return empty, empty
+
+        voxel_center = (self.voxel_coords.tensor.double() + 0.5) * self.voxel_size
+        half_diag    = self.voxel_size * math.sqrt(3) / 2.
+        voxel_keys   = self.voxel_key(self.voxel_coords.tensor)
+
+        query_results, point_results = [], []
+        for b in range(poses.size(0)):
+            T_w2c    = poses[b].Inv()
+            fx, fy, cx, cy = Ks[b, 0, 0], Ks[b, 1, 1], Ks[b, 0, 2], Ks[b, 1, 2]
+
+            # Conservatively cull voxels whose bounding sphere is outside of the frustum.
+            center_c = T_w2c.Act(voxel_center)
+            x, y, z  = center_c[..., 0], center_c[..., 1], center_c[..., 2]
+            visible  = (x >= min_depth - half_diag) & (x <= max_depth + half_diag)
+            for slope, sign, axis in (((-cx) / fx, 1., y), ((width - cx) / fx, -1., y),
+                                      ((-cy) / fy, 1., z), ((height - cy) / fy, -1., z)):
+                # Signed distance to plane {sign * (axis - slope * x) = 0}
+                visible &= (sign * (axis - slope * x)) / math.sqrt(1. + float(slope) ** 2) >= -half_diag
+
+            points, _, _ = self.lookup(voxel_keys[visible])
+            if points.numel() == 0: continue
+
+            # Exact test on points of candidate voxels.
+            point_c = T_w2c.Act(self.positions.tensor[points].double())
+            depth   = point_c[..., 0]
+            u = fx * point_c[..., 1] / depth + cx
+            v = fy * point_c[..., 2] / depth + cy
+            inside  = (depth >= min_depth) & (depth <= max_depth) & (depth > 0.) \
+                    & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+
+            point_results.append(points[inside])
+            query_results.append(torch.full((int(inside.sum().item()),), b, dtype=torch.long))
+
+        if len(point_results) == 0:
+            empty = torch.zeros((0,), dtype=torch.long)
+            return empty, empty
+        return torch.cat(query_results), torch.cat(point_results)
@@ -10,19 +10,20 @@ FrameFeature = T.Literal[
     "need_interp",  # Nx1   , dtype=bool
     "time_ns"       # Nx1   , dtype=long
 ]
+# Optional fields are absent (no storage) in the map unless produced by the pipeline, see VisualMap._declare_optional_columns
 MatchingFeature = T.Literal[
     "pixel1_uv",    # Nx2   , dtype=float32
     "pixel1_d",     # Nx1   , dtype=float32
     "pixel2_uv",    # Nx2   , dtype=float32
     "pixel2_d",     # Nx1   , dtype=float32
-    "pixel1_disp",  # Nx1   , dtype=float32
-    "pixel2_disp",  # Nx1   , dtype=float32
-    "pixel1_uv_cov",# Nx3   , dtype=float32, (\sigma_uu, \sigma_vv, \sigma_uv)
-    "pixel2_uv_cov",# Nx3   , dtype=float32, (\sigma_uu, \sigma_vv, \sigma_uv)
-    "pixel1_d_cov" ,# Nx1   , dtype=float32
-    "pixel2_d_cov" ,# Nx1   , dtype=float32
-    "pixel1_disp_cov",    # Nx1   , dtype=float32
-    "pixel2_disp_cov",    # Nx1   , dtype=float32
+    "pixel1_disp",  # Nx1   , dtype=float32, optional
+    "pixel2_disp",  # Nx1   , dtype=float32, optional
+    "pixel1_uv_cov",# Nx3   , dtype=float32, optional, (\sigma_uu, \sigma_vv, \sigma_uv)
+    "pixel2_uv_cov",# Nx3   , dtype=float32, optional, (\sigma_uu, \sigma_vv, \sigma_uv)
+    "pixel1_d_cov" ,# Nx1   , dtype=float32, optional
+    "pixel2_d_cov" ,# Nx1   , dtype=float32, optional
+    "pixel1_disp_cov",    # Nx1   , dtype=float32, optional
+    "pixel2_disp_cov",    # Nx1   , dtype=float32, optional
     "obs1_covTc",   # Nx3x3 , dtype=float64
     "obs2_covTc",   # Nx3x3 , dtype=float64
 ]
@@ -1,10 +1,16 @@
+import heapq
+import bisect
+import contextlib
 import typing as T
 import torch
 import numpy as np
 from typing_extensions import Self
 
-from Utility.Extensions import AutoScalingTensor
-from .Graph import Scaling_DenseEdge_Multi, Scaling_SparseEdge_Multi, Scaling_SingleEdge
+from Utility.Extensions import AutoScalingTensor, GrowthPolicy
+from .Graph import AutoScalingBundle, EdgeLike, PackedSymmetric, Scaling_DenseEdge_Multi, Scaling_SparseEdge_Multi, Scaling_SingleEdge
+from .Graph import guarded, remap_index, remap_ranges, scaling_tensors
+from .SharedMemory import SharedMapPublisher
+from .SpatialIndex import VoxelHashIndex
 
 # Define storage of interest
 from .Template   import (
@@ -12,8 +18,135 @@ from .Template   import (
     FrameNode , MatchObs, PointNode ,
 )
 
-class VisualMap:
+class FrameInsertion(T.NamedTuple):
+    """
+    Index of rows inserted by `VisualMap.push_frame`.
+    """
+    frame_idx: torch.Tensor
+    point_idx: torch.Tensor
+    match_idx: torch.Tensor
+    map_idx  : torch.Tensor | None
+
+
+class MapCompaction(T.NamedTuple):
+    """
+    Old-to-new row index (-1 for removed rows) of stores compacted by `VisualMap.compact`.
+    """
+    point_idx: torch.Tensor
+    match_idx: torch.Tensor
+    map_idx  : torch.Tensor
+
+
+class MapDelta(T.NamedTuple):
+    """
+    Rows changed after a version of the map, see `VisualMap.changes_since`.
+    * `inserted` - {store name: rows pushed after the version}
+    * `modified` - {store name: rows existing at the version and modified in-place after it}
+    * `reset`    - rows are renumbered (compaction) or history is trimmed after the version, the consumer
+                   should reload everything instead of applying the delta.
+    """
+    version : int
+    inserted: dict[str, torch.Tensor]
+    modified: dict[str, torch.Tensor]
+    reset   : bool
+
+
+class StoreChangeLog:
+    """
+    Listener recording rows inserted / modified in one store of `VisualMap`. Every change bumps the version
+    of the map, while rows are only recorded (tagged with the version, so records after any version are
+    located by binary search) once a consumer subscribed through `VisualMap.track_changes`.
+    """
+    def __init__(self, owner: "VisualMap") -> None:
+        self.owner    = owner
+        self.versions: list[int] = []
+        self.records : list[tuple[bool, torch.Tensor]] = []   # (is insertion, rows)
+    
+    def on_push(self, index: torch.Tensor, value) -> None:
+        self.__record(True, index)
+    
+    def on_modify(self, index: torch.Tensor, fields: tuple[str, ...]) -> None:
+        self.__record(False, index)
+    
+    def since(self, version: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns (inserted rows, modified rows) after `version`, rows inserted after `version` are reported
+        as inserted only.
+        """
+        start    = bisect.bisect_right(self.versions, version)
+        inserted = [rows for is_insert, rows in self.records[start:] if is_insert]
+        modified = [rows for is_insert, rows in self.records[start:] if not is_insert]
+        inserted_ts = torch.cat(inserted) if len(inserted) > 0 else torch.zeros((0,), dtype=torch.long)
+        modified_ts = torch.unique(torch.cat(modified)) if len(modified) > 0 else torch.zeros((0,), dtype=torch.long)
+        if inserted_ts.numel() > 0: modified_ts = modified_ts[modified_ts < inserted_ts.min()]
+        return inserted_ts, modified_ts
+    
+    def trim(self, version: int) -> None:
+        start = bisect.bisect_right(self.versions, version)
+        del self.versions[:start], self.records[:start]
+    
+    def __record(self, is_insert: bool, index: torch.Tensor) -> None:
+        self.owner.version += 1
+        if not self.owner.tracking: return
+        self.versions.append(self.owner.version)
+        self.records.append((is_insert, index.cpu()))
+
+
+class CovisibilityIndex:
+    """
+    Covisibility graph between frames, weight of (i, j) is the number of points observed by both frame i
+    and frame j. Kept as adjacency dict per frame, so updates cost O(#changed observation) and `top_k`
+    costs O(#covisible frame of the queried frame) regardless of the map size.
+    """
     def __init__(self) -> None:
+        self.neighbors: dict[int, dict[int, int]] = dict()
+    
+    def __len__(self) -> int:
+        return len(self.neighbors)
+    
+    def __repr__(self) -> str:
+        return f"CovisibilityIndex(#frame={len(self.neighbors)}, #edge={sum(len(n) for n in self.neighbors.values()) // 2})"
+    
+    def update(self, point_frames: torch.Tensor, sign: int) -> None:
+        """
+        Add (sign=1) or remove (sign=-1) the contribution of points to the covisibility weights. Each row of
+        `point_frames` (P x S) lists frames observing one point, padded with -1 (duplicates are allowed).
+        """
+        if point_frames.numel() == 0: return
+        frames, _ = torch.sort(point_frames, dim=1)
+        frames[:, 1:][frames[:, 1:] == frames[:, :-1]] = -1
+        
+        first, second = torch.triu_indices(frames.size(1), frames.size(1), offset=1)
+        pairs = torch.stack([frames[:, first], frames[:, second]], dim=-1).view(-1, 2)
+        pairs = pairs[(pairs >= 0).all(dim=1)]
+        if pairs.size(0) == 0: return
+        uniq_pairs, counts = torch.unique(pairs, dim=0, return_counts=True)
+        
+        for (a, b), count in zip(uniq_pairs.tolist(), counts.tolist()):
+            self.__add(a, b, sign * count)
+            self.__add(b, a, sign * count)
+    
+    def top_k(self, frame_idx: int, k: int, min_weight: int = 1) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns (frame index, weight) of (at most) k frames sharing most points with `frame_idx`, in descending
+        weight order.
+        """
+        neighbor = self.neighbors.get(frame_idx, dict())
+        best     = heapq.nlargest(k, ((w, f) for f, w in neighbor.items() if w >= min_weight))
+        return torch.tensor([f for _, f in best], dtype=torch.long), torch.tensor([w for w, _ in best], dtype=torch.long)
+    
+    def weight(self, frame_a: int, frame_b: int) -> int:
+        return self.neighbors.get(frame_a, dict()).get(frame_b, 0)
+    
+    def __add(self, a: int, b: int, weight: int) -> None:
+        neighbor  = self.neighbors.setdefault(a, dict())
+        remaining = neighbor.get(b, 0) + weight
+        if remaining > 0: neighbor[b] = remaining
+        else:             neighbor.pop(b, None)
+
+
+class VisualMap:
+    def __init__(self, growth: GrowthPolicy | None = None) -> None:
         self.init_size: T.Final[int]  = 1024
         self.max_pt_obs: T.Final[int] = 5
         self.max_frame_range: T.Final[int] = 2
@@ -55,16 +188,8 @@ class VisualMap:
                 "pixel2_uv"      : AutoScalingTensor((self.init_size, 2   ), grow_on=0, dtype=torch.float32),
                 "pixel1_d"       : AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
                 "pixel2_d"       : AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
-                "pixel1_disp"    : AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
-                "pixel2_disp"    : AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
-                "pixel1_disp_cov": AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
-                "pixel2_disp_cov": AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
                 "obs1_covTc"     : AutoScalingTensor((self.init_size, 3, 3), grow_on=0, dtype=torch.float64),
-                "obs2_covTc"     : AutoScalingTensor((self.init_size, 3, 3), grow_on=0, dtype=torch.float64),
-                "pixel1_uv_cov"  : AutoScalingTensor((self.init_size, 3   ), grow_on=0, dtype=torch.float32),
-                "pixel2_uv_cov"  : AutoScalingTensor((self.init_size, 3   ), grow_on=0, dtype=torch.float32),
-                "pixel1_d_cov"   : AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32),
-                "pixel2_d_cov"   : AutoScalingTensor((self.init_size, 1   ), grow_on=0, dtype=torch.float32)
+                "obs2_covTc"     : AutoScalingTensor((self.init_size, 3, 3), grow_on=0, dtype=torch.float64)
             }
         )
 
@@ -75,36 +200,423 @@ class VisualMap:
         self.match2point  = Scaling_SingleEdge(self.init_size)
         self.point2match  = Scaling_SparseEdge_Multi(self.init_size, self.max_pt_obs)
         
+        self._register_edges()
+        self._declare_optional_columns()
+        
+        # Optional spatial index over points / map_points, see `enable_spatial_index`
+        self.point_index    : VoxelHashIndex | None = None
+        self.map_point_index: VoxelHashIndex | None = None
+        # Optional voxel fusion of map_points, see `enable_map_fusion`
+        self.map_fusion: bool = False
+        # Frames sharing observed points, maintained on every `push_frame`
+        self.covisibility = CovisibilityIndex()
+        # Version counter and change log of each store, see `changes_since`
+        self.version      : int = 0
+        self.history_start: int = 0
+        self.tracking     : bool = False
+        self.change_logs  : dict[str, StoreChangeLog] = dict()
+        self._register_change_logs()
+        # Matches to be removed by next `compact`, see `drop_matches`
+        self.dropped_match: list[torch.Tensor] = []
+        # Bumped whenever rows are removed (and renumbered), row index held outside the map are stale after it.
+        self.layout: int = 0
+        # Entered around every mutation of the map (see `guarded`), set by `enable_shared_memory`
+        self.guard    : contextlib.AbstractContextManager = contextlib.nullcontext()
+        self.publisher: SharedMapPublisher | None = None
+        # Growth policy of all stores and edges, power-of-two (GeometricGrowth(2)) if not set.
+        self.growth: GrowthPolicy | None = None
+        if growth is not None: self.set_growth(growth)
+
+    def _register_edges(self) -> None:
         self.frames.register_edge(self.frame2map)
         self.frames.register_edge(self.frame2match)
         self.points.register_edge(self.point2match)
         self.match.register_edge(self.match2point)
         self.match.register_edge(self.match2frame1)
         self.match.register_edge(self.match2frame2)
+
+    def _stores(self) -> dict[str, AutoScalingBundle]:
+        return {"frames": self.frames, "points": self.points, "map_points": self.map_points, "match": self.match}
+
+    def _register_change_logs(self) -> None:
+        for name, store in self._stores().items():
+            store.listeners = [l for l in store.listeners if not isinstance(l, StoreChangeLog)]
+            self.change_logs[name] = StoreChangeLog(self)
+            store.register_listener(self.change_logs[name])
+
+    def _reset_changes(self) -> None:
+        # Row index before this point are no longer valid, consumers must reload.
+        self.version += 1
+        self.history_start = self.version
+        for log in self.change_logs.values(): log.trim(self.version)
+
+    def _declare_optional_columns(self) -> None:
+        # Disparity and uncertainty of matches are only available with certain frontend / covariance model,
+        # these columns take no storage unless the pipeline produces them.
+        for field in ("pixel1_disp", "pixel2_disp", "pixel1_disp_cov", "pixel2_disp_cov", "pixel1_d_cov", "pixel2_d_cov"):
+            self.match.declare_optional(field, (1,), torch.float32, fill=-1)
+        for field in ("pixel1_uv_cov", "pixel2_uv_cov"):
+            self.match.declare_optional(field, (3,), torch.float32, fill=-1)
+
+    def set_growth(self, growth: GrowthPolicy) -> None:
+        """
+        Use `growth` policy when any store (or edge) of the map runs out of capacity.
+        """
+        self.growth = growth
+        for component in self._components().values():
+            for tensor in scaling_tensors(component).values(): tensor.growth = growth
+
+    def reserve_frames(self, num_frames: int) -> None:
+        """
+        Preallocate frame store (and edges from frames) when the sequence length is known in advance.
+        
+        NOTE: points / match / map_points are not reserved since their final size depends on the
+        tracking result, a loose upper bound (#frame x #keypoint) would waste more memory than slack.
+        """
+        self.frames.reserve(num_frames)
+
+    def shrink_to_fit(self) -> None:
+        """
+        Release capacity slack of all stores and edges, e.g. when the map is finished and about to be serialized.
+        """
+        for store in (self.frames, self.points, self.map_points, self.match): store.shrink_to_fit()
+
+    def track_changes(self) -> int:
+        """
+        Start recording changed rows for `changes_since`. Opt-in since records are kept until `trim_changes`,
+        consumers should trim regularly. Returns the current version, i.e. the first version to query with.
+        """
+        if not self.tracking:
+            self.tracking      = True
+            self.history_start = self.version
+        return self.version
+
+    def changes_since(self, version: int) -> MapDelta:
+        """
+        Rows inserted (`push`) or modified (`write_column`, e.g. optimizer write-back and map fusion) after
+        `version` of the map. Consumers keep the returned `version` and ask for the next delta with it, so
+        each call costs O(#changed row) instead of O(map size).
+        
+        NOTE: in-place writes that bypass `AutoScalingBundle.write_column` are not tracked.
+        """
+        assert self.tracking, "Call track_changes() before asking for changes."
+        reset    = version < self.history_start
+        changes  = {name: log.since(version) for name, log in self.change_logs.items()}
+        return MapDelta(
+            version  = self.version,
+            inserted = {name: inserted for name, (inserted, _) in changes.items()},
+            modified = {name: modified for name, (_, modified) in changes.items()},
+            reset    = reset,
+        )
+
+    def trim_changes(self, version: int) -> None:
+        """
+        Release change records up to `version` once all consumers have caught up with it.
+        """
+        for log in self.change_logs.values(): log.trim(version)
+        self.history_start = max(self.history_start, version)
+
+    def drop_matches(self, match_idx: torch.Tensor) -> None:
+        """
+        Mark matches (e.g. observations rejected by the optimizer, see `TwoFrame_PGO.write_graph_data`) to be
+        removed by the next `compact`. Dropped matches stay in the map (and are returned by `get_*`) until then,
+        matches in the frozen prefix of `compact` stay pending until a compaction that does not freeze them.
+        """
+        self.dropped_match.append(match_idx.long().cpu())
+
+    def _update_covisibility(self, point_idx: torch.Tensor, match_idx: torch.Tensor, sign: int) -> None:
+        """
+        Update covisibility after observations `match_idx` of points `point_idx` are added (sign=1, edges
+        already written) or are about to be removed (sign=-1, edges not yet removed).
+        """
+        point_idx = torch.unique(point_idx)
+        if point_idx.numel() == 0 or self.match2frame1.mapping.tensor.size(0) == 0: return
+        matches   = self.point2match.edges.tensor[point_idx]
+        valid     = matches >= 0
+        if not valid.any(): return
+        changed   = valid & torch.isin(matches, match_idx)
+        slots     = torch.where(valid, matches, 0)
+        frames    = torch.cat([self.match2frame1.mapping.tensor[slots], self.match2frame2.mapping.tensor[slots]], dim=1)
         
+        # Replace contribution of points without the changed observations by the one with them.
+        self.covisibility.update(frames.masked_fill(~valid.repeat(1, 2), -1), sign)
+        self.covisibility.update(frames.masked_fill(~(valid & ~changed).repeat(1, 2), -1), -sign)
 
-    def get_frame2match(self, frame: FrameNode) -> MatchObs:
-        return self.match[self.frame2match.project(frame.index)]
+    @torch.no_grad()
+    @guarded
+    def compact(self, frozen: dict[str, int] | None = None, shrink: bool = True) -> MapCompaction:
+        """
+        Remove rows that are no longer referenced and remap all edges and spatial indices accordingly
+        * match      - dropped by `drop_matches`.
+        * points     - not observed by any remaining match.
+        * map_points - not associated to any frame through `frame2map`.
+        Frames are never removed since they form the trajectory (lost-track frames included).
+        
+        Row order is preserved. `frozen` maps store name ("points", "match", "map_points") to the number of
+        leading rows that must keep their index (e.g. rows already streamed to disk), these rows are always kept.
+        If `shrink`, capacity slack of all stores is released afterwards.
+        
+        Returns old-to-new row index of compacted stores, to remap indices held outside the map.
+        """
+        frozen = dict() if frozen is None else frozen
+        
+        dropped    = torch.unique(torch.cat(self.dropped_match)) if len(self.dropped_match) > 0 else torch.zeros((0,), dtype=torch.long)
+        match_keep = torch.ones((len(self.match),), dtype=torch.bool)
+        match_keep[dropped] = False
+        match_keep[:frozen.get("match", 0)] = True
+        
+        # Empty slot (-1) of point2match reads the appended `False`.
+        point_keep = torch.cat([match_keep, torch.zeros((1,), dtype=torch.bool)])[self.point2match.edges.tensor].any(dim=1)
+        live_point = self.match2point.mapping.tensor[match_keep]
+        point_keep[live_point[live_point >= 0]] = True
+        point_keep[:frozen.get("points", 0)] = True
+        
+        map_keep = torch.zeros((len(self.map_points),), dtype=torch.bool)
+        map_keep[self.frame2map.project(self.frames.index.tensor)] = True
+        map_keep[:frozen.get("map_points", 0)] = True
+        
+        removed_match = torch.nonzero(~match_keep).flatten()
+        if removed_match.numel() > 0:
+            removed_point = self.match2point.mapping.tensor[removed_match]
+            self._update_covisibility(removed_point[removed_point >= 0], removed_match, sign=-1)
+        
+        # Remap edge content (index into compacted stores) first, rows of edges are compacted with their store.
+        match2point = self.match2point.mapping.tensor
+        point2match = self.point2match.edges.tensor
+        match2point.copy_(remap_index(match2point, self.__old_to_new(point_keep)))
+        point2match.copy_(remap_index(point2match, self.__old_to_new(match_keep)))
+        # Move remaining observations of each point to the front of its row.
+        order = torch.argsort((point2match < 0).to(torch.uint8), dim=1, stable=True)
+        point2match.copy_(torch.gather(point2match, 1, order))
+        self.point2match.out_deg.tensor.copy_((point2match >= 0).sum(dim=1))
+        self.frame2match.ranges.tensor.copy_(remap_ranges(self.frame2match.ranges.tensor, match_keep))
+        self.frame2map.ranges.tensor.copy_(remap_ranges(self.frame2map.ranges.tensor, map_keep))
+        
+        result = MapCompaction(
+            self.points.compact(point_keep), self.match.compact(match_keep), self.map_points.compact(map_keep)
+        )
+        if not (point_keep.all() and match_keep.all() and map_keep.all()):
+            self.layout += 1
+            self._reset_changes()
+        if self.point_index is not None: self.point_index.remap(result.point_idx)
+        if self.map_point_index is not None: self.map_point_index.remap(result.map_idx)
+        # Dropped matches in the frozen prefix keep their index, so they are still valid for the next compaction.
+        pending = dropped[dropped < frozen.get("match", 0)]
+        self.dropped_match = [pending] if pending.numel() > 0 else []
+        
+        if shrink: self.shrink_to_fit()
+        return result
+
+    @staticmethod
+    def __old_to_new(keep: torch.Tensor) -> torch.Tensor:
+        return torch.where(keep, keep.long().cumsum(0) - 1, -1)
 
-    def get_match2point(self, match: MatchObs) -> PointNode:
-        return self.points[self.match2point.project(match.index)]
+    def _cov_columns(self) -> list[tuple[AutoScalingBundle, str]]:
+        return [(self.points, "cov_Tw"), (self.map_points, "cov_Tw"), (self.match, "obs1_covTc"), (self.match, "obs2_covTc")]
+
+    def enable_packed_cov(self, dtype: torch.dtype) -> None:
+        """
+        Store 3x3 covariance of points, map points and observations as 6 upper-triangular entries in `dtype`
+        (float32 takes 24 bytes per covariance instead of 72). Covariances are still read as full float64
+        matrices through `select` / `__getitem__` / `column`, see `AutoScalingBundle.declare_packed`.
+        """
+        for store, field in self._cov_columns(): store.declare_packed(field, PackedSymmetric(3, dtype))
+
+    def enable_shared_memory(self, name: str) -> SharedMapPublisher:
+        """
+        Move all storage of the map to named shared memory and publish its layout under `name`, so other
+        processes can attach with `SharedMapReader(name)` and read the live map without copy.
+        """
+        self.publisher = SharedMapPublisher(self, name)
+        return self.publisher
+
+    def enable_spatial_index(self, voxel_size: float) -> None:
+        """
+        Build voxel-hash index on `pos_Tw` of `points` and `map_points`. The index is kept in sync with
+        all following push into these stores.
+        
+        NOTE: if map fusion is enabled, `map_point_index` is the voxel index used by fusion and is kept as-is.
+        """
+        self.point_index = VoxelHashIndex(self.points.data["pos_Tw"], voxel_size)
+        self.point_index.insert(self.points.index.tensor, self.points.data["pos_Tw"].tensor)
+        self.points.register_listener(self.point_index)
+        
+        if self.map_fusion: return
+        self.map_point_index = VoxelHashIndex(self.map_points.data["pos_Tw"], voxel_size)
+        self.map_point_index.insert(self.map_points.index.tensor, self.map_points.data["pos_Tw"].tensor)
+        self.map_points.register_listener(self.map_point_index)
+
+    def enable_map_fusion(self, voxel_size: float) -> None:
+        """
+        Keep at most one map point per voxel of `voxel_size`. New map points should then be inserted with
+        `push_fused_map_points`, which fuses them into the existing point of the same voxel.
+        """
+        assert len(self.map_points) == 0, "Map fusion must be enabled before any map point is inserted."
+        if self.map_point_index in self.map_points.listeners:
+            self.map_points.listeners.remove(self.map_point_index)
+        
+        self.map_point_index = VoxelHashIndex(self.map_points.data["pos_Tw"], voxel_size)
+        self.map_fusion      = True
+
+    @torch.no_grad()
+    @guarded
+    def push_fused_map_points(self, value: PointNode) -> torch.Tensor:
+        """
+        Insert map points under voxel fusion policy. Points falling in the same voxel (in the batch, or with
+        an existing map point) are fused by covariance-weighted (information form) averaging:
+        
+            cov = (sum_i cov_i^-1)^-1,  pos = cov @ (sum_i cov_i^-1 @ pos_i)
+        
+        Returns the index of *newly created* map points (a contiguous range). Points fused into existing
+        map points are not included.
+        """
+        assert self.map_fusion and self.map_point_index is not None, "Call enable_map_fusion(...) first."
+        index = self.map_point_index
+        
+        pos_Tw  = value.data["pos_Tw"].cpu().double()
+        info    = torch.linalg.pinv(value.data["cov_Tw"].cpu().double(), hermitian=True)
+        keys    = index.voxel_key(index.voxel_coord(pos_Tw))
+        
+        # Fuse points in the same voxel within the batch
+        uniq_keys, inverse = torch.unique(keys, return_inverse=True)
+        num_voxel   = uniq_keys.size(0)
+        info_sum    = torch.zeros((num_voxel, 3, 3), dtype=torch.float64).index_add_(0, inverse, info)
+        infovec_sum = torch.zeros((num_voxel, 3), dtype=torch.float64).index_add_(0, inverse, (info @ pos_Tw.unsqueeze(-1)).squeeze(-1))
+        color_sum   = torch.zeros((num_voxel, 3), dtype=torch.float64).index_add_(0, inverse, value.data["color"].cpu().double())
+        color_cnt   = torch.bincount(inverse, minlength=num_voxel).unsqueeze(-1)
+        
+        # Fuse with existing map points in the same voxel
+        rows, starts, lengths = index.lookup(uniq_keys)
+        exist_mask  = lengths > 0
+        if exist_mask.any():
+            exist_rows  = rows[starts[exist_mask]]
+            exist       = self.map_points.select(exist_rows, ("pos_Tw", "cov_Tw"))
+            exist_pos   = exist.data["pos_Tw"].double()
+            exist_info  = torch.linalg.pinv(exist.data["cov_Tw"].double(), hermitian=True)
+            fused_info  = exist_info + info_sum[exist_mask]
+            fused_cov   = torch.linalg.pinv(fused_info, hermitian=True)
+            fused_pos   = (fused_cov @ ((exist_info @ exist_pos.unsqueeze(-1)).squeeze(-1) + infovec_sum[exist_mask]).unsqueeze(-1)).squeeze(-1)
+            
+            self.map_points.write_column("pos_Tw", exist_rows, fused_pos)
+            self.map_points.write_column("cov_Tw", exist_rows, fused_cov)
+        
+        # Create new map points for unoccupied voxels
+        new_mask = ~exist_mask
+        new_cov  = torch.linalg.pinv(info_sum[new_mask], hermitian=True)
+        new_pos  = (new_cov @ infovec_sum[new_mask].unsqueeze(-1)).squeeze(-1)
+        new_idx  = self.map_points.push(PointNode.init({
+            "pos_Tw": new_pos.float(),
+            "cov_Tw": new_cov,
+            "color" : (color_sum[new_mask] / color_cnt[new_mask]).round().to(torch.uint8),
+        }))
+        index.insert(new_idx, new_pos, keys=uniq_keys[new_mask])
+        return new_idx
+
+    @torch.no_grad()
+    @guarded
+    def push_frame(self, frame: FrameNode, ref_frame_idx: int, points: PointNode, match: MatchObs,
+                   map_points: PointNode | None = None) -> FrameInsertion:
+        """
+        Insert a new frame with everything observed on it in one transaction
+        * `frame`      - the new frame (one row).
+        * `points`     - new 3D points, the i-th point is observed by the i-th row of `match`.
+        * `match`      - matches between frame `ref_frame_idx` (frame1) and the new frame (frame2).
+        * `map_points` - (optional) mapping points associated to the new frame.
+        
+        Capacity of all stores and edges is reserved before any write, then rows and edges are written
+        in a single pass and listeners (e.g. spatial index) are notified only after everything succeeds.
+        If any step fails, the map is rolled back to the state before the call and the error is re-raised.
+        
+        NOTE: under map fusion, `map_points` are fused after the transaction is committed, since fusion
+        modifies existing map points in-place and can not be rolled back.
+        """
+        assert len(frame) == 1 and len(points) == len(match)
+        fused_map = map_points is not None and self.map_fusion
+        
+        stores    = [(self.frames, frame), (self.points, points), (self.match, match)]
+        if map_points is not None and not fused_map: stores.append((self.map_points, map_points))
+        # Rows that exist before the transaction and will be modified by it.
+        ref_ranges     = self.frame2match.ranges[ref_frame_idx].clone()
+        ref_num_ranges = self.frame2match.num_ranges[ref_frame_idx].clone()
+        orig_sizes     = [len(store) for store, _ in stores]
+        orig_fields    = [set(store.data.keys()) for store, _ in stores]
+        
+        try:
+            for (store, value), size in zip(stores, orig_sizes): store.ensure_capacity(size + len(value))
+            new_index = [store.push(value, notify=False) for store, value in stores]
+            frame_idx, point_idx, match_idx = new_index[:3]
+            map_idx   = new_index[3] if len(new_index) > 3 else None
+            
+            num_match   = match_idx.size(0)
+            match_start = torch.tensor([orig_sizes[2]], dtype=torch.long)
+            match_len   = torch.tensor([num_match], dtype=torch.long)
+            self.point2match.add(point_idx, match_idx)
+            self.match2point.set(match_idx, point_idx)
+            self.frame2match.add(torch.tensor([ref_frame_idx], dtype=torch.long), match_start, match_len)
+            self.frame2match.add(frame_idx, match_start, match_len)
+            self.match2frame1.set(match_idx, torch.full((num_match,), ref_frame_idx, dtype=torch.long))
+            self.match2frame2.set(match_idx, frame_idx.expand(num_match))
+            if map_idx is not None:
+                self.frame2map.add(frame_idx, torch.tensor([orig_sizes[3]], dtype=torch.long), torch.tensor([map_idx.size(0)], dtype=torch.long))
+        except BaseException:
+            for (store, _), size, fields in zip(stores, orig_sizes, orig_fields):
+                store.truncate(size)
+                store.discard_optional([k for k in store.data if k not in fields])
+            self.frame2match.ranges[ref_frame_idx]     = ref_ranges
+            self.frame2match.num_ranges[ref_frame_idx] = ref_num_ranges
+            raise
+        
+        for (store, value), index in zip(stores, new_index): store.notify_listeners(index, value)
+        self._update_covisibility(point_idx, match_idx, sign=1)
+        
+        if fused_map:
+            assert map_points is not None
+            map_idx = self.push_map_points(frame_idx, map_points)
+        return FrameInsertion(frame_idx, point_idx, match_idx, map_idx)
+
+    @torch.no_grad()
+    @guarded
+    def push_map_points(self, frame_idx: torch.Tensor, map_points: PointNode) -> torch.Tensor:
+        """
+        Associate mapping points to an existing frame (fused under map fusion), e.g. after `push_frame` so dense
+        mapping of a frame can run while the optimizer is working on it. Returns index of newly created map points.
+        """
+        num_map_orig = len(self.map_points)
+        map_idx      = self.push_fused_map_points(map_points) if self.map_fusion else self.map_points.push(map_points)
+        self.frame2map.add(frame_idx, torch.tensor([num_map_orig], dtype=torch.long), torch.tensor([map_idx.size(0)], dtype=torch.long))
+        return map_idx
+
+    # NOTE: `fields` selects the fields to gather on the target store (all fields if None), reading only
+    # a few fields of large rows (e.g. MatchObs with float64 covariances) saves most of the copy.
+    def get_frame2match(self, frame: FrameNode, fields: T.Iterable[str] | None = None) -> MatchObs:
+        return self.match.select(self.frame2match.project(frame.index), fields)
+
+    def get_match2point(self, match: MatchObs, fields: T.Iterable[str] | None = None) -> PointNode:
+        return self.points.select(self.match2point.project(match.index), fields)
     
-    def get_point2match(self, point: PointNode) -> MatchObs:
-        return self.match[self.point2match.project(point.index)]
+    def get_point2match(self, point: PointNode, fields: T.Iterable[str] | None = None) -> MatchObs:
+        return self.match.select(self.point2match.project(point.index), fields)
     
-    def get_match2frame1(self, match: MatchObs) -> FrameNode:
-        return self.frames[self.match2frame1.project(match.index)]
+    def get_match2frame1(self, match: MatchObs, fields: T.Iterable[str] | None = None) -> FrameNode:
+        return self.frames.select(self.match2frame1.project(match.index), fields)
     
-    def get_match2frame2(self, match: MatchObs) -> FrameNode:
-        return self.frames[self.match2frame2.project(match.index)]
+    def get_match2frame2(self, match: MatchObs, fields: T.Iterable[str] | None = None) -> FrameNode:
+        return self.frames.select(self.match2frame2.project(match.index), fields)
     
-    def get_frame2map(self, frame: FrameNode) -> PointNode:
-        return self.map_points[self.frame2map.project(frame.index)]
+    def get_frame2map(self, frame: FrameNode, fields: T.Iterable[str] | None = None) -> PointNode:
+        return self.map_points.select(self.frame2map.project(frame.index), fields)
+
+    def get_covisible_frames(self, frame_idx: int, k: int, fields: T.Iterable[str] | None = None) -> FrameNode:
+        """
+        Top-k frames sharing most observed points with frame `frame_idx` (descending), see `CovisibilityIndex`.
+        """
+        return self.frames.select(self.covisibility.top_k(frame_idx, k)[0], fields)
 
     def serialize(self) -> dict[str, np.ndarray]:
         return (
             self.frames.serialize("frames/")
           | self.points.serialize("points/")
+          | self.map_points.serialize("map_points/")
           | self.match.serialize("match/")
           | self.frame2match.serialize("edge/frame2match")
           | self.point2match.serialize("edge/point2match")
@@ -120,6 +632,8 @@ class VisualMap:
         map.frames = map.frames.deserialize("frames/", value)
         map.match  = map.match.deserialize("match/", value)
         map.points = map.points.deserialize("points/", value)
+        if any(k.startswith("map_points/") for k in value):    # Not available in files from older version.
+            map.map_points = map.map_points.deserialize("map_points/", value)
         
         map.frame2match  = map.frame2match.deserialize("edge/frame2match", value)
         map.point2match  = map.point2match.deserialize("edge/point2match", value)
@@ -127,7 +641,100 @@ class VisualMap:
         map.match2frame1 = map.match2frame1.deserialize("edge/match2frame1", value)
         map.match2frame2 = map.match2frame2.deserialize("edge/match2frame2", value)
         map.frame2map    = map.frame2map.deserialize("edge/frame2map", value)
+        map._register_edges()
+        # Give every store and the edges from it the same capacity, so they keep growing in sync.
+        for store in map._stores().values(): store.reserve(max(len(store), 1))
+        map._declare_optional_columns()
+        map._register_change_logs()
+        for store, field in map._cov_columns():
+            stored = store.data[field].tensor
+            if stored.dim() == 2: store.declare_packed(field, PackedSymmetric(3, stored.dtype))
+        map._update_covisibility(map.points.index.tensor, map.match.index.tensor, sign=1)
         return map
+    
+    def state_dict(self) -> dict:
+        """
+        Full state of the map (including spatial index and fusion setting) for checkpointing.
+        """
+        return {
+            "map"            : self.serialize(),
+            "map_fusion"     : self.map_fusion,
+            "dropped_match"  : [m.clone() for m in self.dropped_match],
+            "point_index"    : None if self.point_index is None else
+                               (self.point_index.voxel_size, self.point_index.state_dict()),
+            "map_point_index": None if self.map_point_index is None else
+                               (self.map_point_index.voxel_size, self.map_point_index.state_dict()),
+        }
+    
+    def load_state_dict(self, state: dict) -> None:
+        """
+        Restore the map from `state_dict()` in-place.
+        """
+        loaded = self.deserialize(state["map"])
+        self.frames, self.points, self.map_points, self.match = loaded.frames, loaded.points, loaded.map_points, loaded.match
+        self.frame2match, self.frame2map     = loaded.frame2match, loaded.frame2map
+        self.match2frame1, self.match2frame2 = loaded.match2frame1, loaded.match2frame2
+        self.match2point, self.point2match   = loaded.match2point, loaded.point2match
+        self.covisibility = loaded.covisibility
+        self._register_change_logs()
+        self._reset_changes()
+        self.layout += 1
+        if self.publisher is not None: self.publisher.attach(self)
+        self.map_fusion = state["map_fusion"]
+        self.dropped_match = list(state.get("dropped_match", []))
+        if self.growth is not None: self.set_growth(self.growth)
+        
+        self.point_index, self.map_point_index = None, None
+        if state["point_index"] is not None:
+            voxel_size, index_state = state["point_index"]
+            self.point_index = VoxelHashIndex(self.points.data["pos_Tw"], voxel_size)
+            self.point_index.load_state_dict(index_state)
+            self.points.register_listener(self.point_index)
+        if state["map_point_index"] is not None:
+            voxel_size, index_state = state["map_point_index"]
+            self.map_point_index = VoxelHashIndex(self.map_points.data["pos_Tw"], voxel_size)
+            self.map_point_index.load_state_dict(index_state)
+            # Under map fusion, the index is maintained by push_fused_map_points instead of listener.
+            if not self.map_fusion: self.map_points.register_listener(self.map_point_index)
+
+    def _components(self) -> dict[str, AutoScalingBundle | EdgeLike]:
+        return {
+            "frames"           : self.frames,
+            "points"           : self.points,
+            "map_points"       : self.map_points,
+            "match"            : self.match,
+            "edge/frame2match" : self.frame2match,
+            "edge/frame2map"   : self.frame2map,
+            "edge/match2frame1": self.match2frame1,
+            "edge/match2frame2": self.match2frame2,
+            "edge/match2point" : self.match2point,
+            "edge/point2match" : self.point2match,
+        }
+
+    def memory_usage(self) -> dict[str, dict[str, tuple[int, int]]]:
+        """
+        Returns {store or edge name: {field: (used bytes, allocated bytes)}} of the whole map.
+        """
+        return {name: component.memory_usage() for name, component in self._components().items()}
+    
+    def realloc_stats(self) -> dict[str, dict[str, tuple[int, int, int]]]:
+        """
+        Returns {store or edge name: {field: (#reallocation, bytes copied, peak allocated bytes)}} of the whole map.
+        """
+        return {
+            name: {field: (t.num_realloc, t.bytes_copied, t.peak_alloc) for field, t in scaling_tensors(component).items()}
+            for name, component in self._components().items()
+        }
+    
+    def memory_summary(self) -> str:
+        """
+        One-line summary of total used / allocated memory and the largest field.
+        """
+        usage  = [(f"{store}.{field}", used, alloc) for store, fields in self.memory_usage().items() for field, (used, alloc) in fields.items()]
+        used   = sum(u for _, u, _ in usage)
+        alloc  = sum(a for _, _, a in usage)
+        name, _, largest = max(usage, key=lambda x: x[2])
+        return f"VisualMap memory used={used / 2**20:.1f}MB, allocated={alloc / 2**20:.1f}MB, largest={name} ({largest / 2**20:.1f}MB allocated)"
 
     def __repr__(self) -> str:
         return f"VisualMap(#frame={len(self.frames)}, #point={len(self.points)}, #map={len(self.map_points)})"
@@ -1,2 +1,4 @@
-from .VisualMap import VisualMap, FrameNode, MatchObs, PointNode, FrameStore
+from .VisualMap import VisualMap, CovisibilityIndex, FrameInsertion, MapCompaction, MapDelta, FrameNode, MatchObs, PointNode, FrameStore
 from .Graph     import DenseEdge_Multi, SparseEdge_Multi, SingleEdge, TensorBundle
+from .SpatialIndex import VoxelHashIndex
+from .SharedMemory import SharedMapPublisher, SharedMapReader
@@ -41,7 +41,7 @@ class PoseInterpolate(IMapProcessor):
         
         interp_poses, _ = interpolate_pose(poses[~bad_mask], torch.nonzero(~bad_mask).flatten(), bad_idx)   #type: ignore
         
-        frames.data["pose"][bad_mask] = interp_poses.tensor()
+        frames.write_column("pose", bad_idx, interp_poses.tensor())
         return frames, bad_idx
 
     @classmethod
@@ -72,7 +72,7 @@ class MotionInterpolate(IMapProcessor):
         # https://github.com/pypose/pypose/issues/346
         # NOTE: the behavior of Pypose v0.6.7 and v0.6.8 are different for pp.cumops
         interp_poses = pp.cumops(motions, dim=0, ops=lambda a, b: NormalizeQuat(a) @ NormalizeQuat(b))
-        frames.data["pose"][1:] = (pp.SE3(frames.data["pose"][0:1]).double() @ interp_poses).float()
+        frames.write_column("pose", slice(1, None), (pp.SE3(frames.data["pose"][0:1]).double() @ interp_poses).float())
         return frames, interp_idx
 
     @classmethod
@@ -40,6 +40,16 @@ class IMotionModel(ABC, Generic[T_Data], ConfigTestableSubclass):
         Receive a feedback (optimized pose) and may (or may not) use this method to refine next prediction.
         """
         ...
+    
+    def state_dict(self) -> dict:
+        """
+        Internal state of motion model for checkpointing. By default, all `prev_*` attributes are considered
+        as state, override this method if the motion model keeps other mutable state.
+        """
+        return {k: v for k, v in vars(self).items() if k.startswith("prev_")}
+    
+    def load_state_dict(self, state: dict) -> None:
+        for k, v in state.items(): setattr(self, k, v)
 
 
 class GTMotionwithNoise(IMotionModel[StereoFrame]):
@@ -1,8 +1,11 @@
+import os
 import torch
 import signal
+import numpy as np
 import typing as T
 from types import SimpleNamespace
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import torch.multiprocessing as mp
 from multiprocessing.context import SpawnProcess
@@ -10,6 +13,7 @@ from multiprocessing.connection import _ConnectionBase as Conn_Type
 
 from Module.Map import TensorBundle, VisualMap
 from Utility.PrettyPrint import Logger
+from Utility.Timer import Timer
 from Utility.Extensions import ConfigTestableSubclass
 from Utility.Utils      import tensor_safe_asdict
 
@@ -37,47 +41,132 @@ def move_dataclass_to_local(obj: T_GraphInput) -> T_GraphInput:
     return type(obj)(**data_dict)
 
 
+class ConvergenceRecord(T.TypedDict):
+    """
+    Convergence of a single optimization, attached to the optimization output as `telemetry` (see `IOptimizer.telemetry`).
+    """
+    frame_idx: int
+    num_step : int
+    loss     : list[float]      # Loss before the first step and after each step
+    damping  : float            # Final damping of LM
+    time_ms  : float            # Wall-clock time of the solve (of the whole batch for `batch_optimize`)
+    stop     : str              # "converged" | "step_cap" | "time_budget"
+
+
+def summarize_convergence(records: T.Sequence[ConvergenceRecord]) -> dict:
+    """
+    Distribution of iterations, solve time and stop reasons over `records`.
+    """
+    if len(records) == 0: return {"num_solve": 0}
+    num_step = np.array([r["num_step"] for r in records])
+    time_ms  = np.array([r["time_ms"] for r in records])
+    steps, counts = np.unique(num_step, return_counts=True)
+    reasons, num_reason = np.unique([r["stop"] for r in records], return_counts=True)
+    return {
+        "num_solve"      : len(records),
+        "total_time_ms"  : float(time_ms.sum()),
+        "time_per_iter_ms": float(time_ms.sum() / max(int(num_step.sum()), 1)),
+        "iterations"     : {
+            "mean": float(num_step.mean()), "p50": float(np.percentile(num_step, 50)),
+            "p95" : float(np.percentile(num_step, 95)), "max": int(num_step.max()),
+            "histogram": {int(k): int(v) for k, v in zip(steps, counts)},
+        },
+        "time_ms"        : {
+            "mean": float(time_ms.mean()), "p50": float(np.percentile(time_ms, 50)),
+            "p95" : float(np.percentile(time_ms, 95)), "max": float(time_ms.max()),
+        },
+        "stop"           : {str(k): int(v) for k, v in zip(reasons, num_reason)},
+    }
+
+
+class ContextMessage:
+    """
+    Sent through Pipe to child process to read (`context=None`) or overwrite the optimization context 
+    on child process. Used for checkpointing in parallel mode.
+    """
+    def __init__(self, context: T.Any = None) -> None:
+        self.context = context
+
+
+T_ExecMode = T.Literal["sequential", "process", "thread"]
+
+
+def execution_mode(parallel: bool | str) -> T_ExecMode:
+    """
+    Map `config.parallel` to execution mode of the optimizer, `true` is kept as an alias of "process".
+    """
+    match parallel:
+        case False: return "sequential"
+        case True | "process": return "process"
+        case "thread": return "thread"
+        case _: raise ValueError(f"Unsupported optimizer parallel mode {parallel}")
+
+
 class IOptimizer(ABC, T.Generic[T_GraphInput, T_Context, T_GraphOutput], ConfigTestableSubclass):
     """
-    Interface for optimization module. When config.parallel set to `true`, will spawn a child process
-    to run optimization loop in "background".
+    Interface for optimization module. The execution mode is selected by `config.parallel`
+    
+    * `false`             - sequential mode, optimize on the caller thread.
+    * `true` / "process"  - spawn a child process to run optimization loop in "background".
+    * "thread"            - run optimization loop on a worker thread of this process. No startup cost, no
+                            second copy of the torch runtime and no pickling of graphs. Since the linear algebra
+                            of the solver releases the GIL, it still overlaps with the frontend of next frame.
+    
+    The optional `config.num_threads` sets intra-op thread budget of the optimizer (child process or worker
+    thread) in parallel modes.
     
     `IOptimizer.optimize(global_map: TensorMap, frames: BatchFrames) -> None`
     
     * In sequential mode, will run optimization loop in blocking mannor and return when optimization is finished.
     
-    * In parallel mode, will send optimization job to child process and return immediately (non-blocking).
+    * In parallel mode, will send optimization job to child process / worker thread and return immediately (non-blocking).
     
     `IOptimizer.write_back(global_map: TensorMap) -> None`
     
     * In sequential mode, will write back optimization result to global_map immediately and return.
     
-    * In parallel mode, will wait for child process to finish optimization job and write back result to global_map. (blocking)
+    * In parallel mode, will wait for the optimization job to finish and write back result to global_map. (blocking)
 
     `IOptimizer.terminate() -> None`
     
-    Force terminate child process if in parallel mode. no-op if in sequential mode.
+    Force terminate child process (or stop accepting jobs on worker thread) if in parallel mode. no-op if in sequential mode.
+    
+    `IOptimizer.telemetry`
+    
+    Outputs that carry a `telemetry` (`ConvergenceRecord`) are collected here once they reach the caller, in all modes.
     """
+    DEFAULT_NUM_THREADS: T.ClassVar[dict[T_ExecMode, int]] = {"process": 8, "thread": 4}
+    
     def __init__(self, config: SimpleNamespace) -> None:
         super().__init__()
         
         self.config: SimpleNamespace = config
-        self.is_parallel_mode = config.parallel
+        self.mode  : T_ExecMode      = execution_mode(config.parallel)
+        self.is_parallel_mode = self.mode != "sequential"
+        self.num_threads: int = getattr(config, "num_threads", self.DEFAULT_NUM_THREADS.get(self.mode, 1))
         
         # For sequential mode
         self.context     : None | T_Context  = None
         self.optimize_res: None | T_GraphOutput = None
         
-        # For parallel mode
+        # For parallel (process) mode
         self.main_conn : None | Conn_Type = None   # For parent-end
         self.child_conn: None | Conn_Type = None   # For child-end
         self.child_proc: None | SpawnProcess = None   # child process running optimization loop
         
+        # For parallel (thread) mode, context is owned by the worker while a job is pending.
+        self.executor  : None | ThreadPoolExecutor = None
+        self.opt_future: None | Future[tuple[T_Context, T_GraphOutput]] = None
+        
         # Keep track if there is a job on child to avoid deadlock (wait forever for child to finish
         # a non-exist job)
         self.has_opt_job: bool = False
+        # Result received from child before it is asked for (e.g. by state_dict), returned on next get.
+        self.drained_res: None | T_GraphOutput = None
+        
+        self.telemetry: list[ConvergenceRecord] = []
         
-        if self.is_parallel_mode:
+        if self.mode == "process":
             ctx = mp.get_context("spawn")
             torch.set_num_threads(1)
         
@@ -86,12 +175,20 @@ class IOptimizer(ABC, T.Generic[T_GraphInput, T_Context, T_GraphOutput], ConfigT
             # Spawn child process
             self.child_proc = ctx.Process(
                 target=IOptimizerParallelWorker,
-                args=(config, self.init_context, self._optimize, self.child_conn),
+                args=(config, self.init_context, self._optimize, self.child_conn, Timer.ACTIVE, self.num_threads),
             )
             assert self.child_proc is not None
             self.child_proc.start()
             
             torch.set_num_threads(4)
+        elif self.mode == "thread":
+            # Worker and caller (frontend) share the cores of this process, split them between the two so the
+            # intra-op pools do not oversubscribe. Caller keeps the same budget as in process mode at most.
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="IOptimizerThreadWorker",
+                initializer=torch.set_num_threads, initargs=(self.num_threads,)
+            )
+            torch.set_num_threads(max(1, min(4, (os.cpu_count() or 1) - self.num_threads)))
         
         self.context = self.init_context(config)
     
@@ -131,6 +228,7 @@ class IOptimizer(ABC, T.Generic[T_GraphInput, T_Context, T_GraphOutput], ConfigT
         assert self.context is not None
         self.has_opt_job = True
         self.context, self.optimize_res = self._optimize(self.context, graph_data)
+        self._collect_telemetry(self.optimize_res)
 
     def __get_output_sequential(self) -> T_GraphOutput | None:
         return self.optimize_res
@@ -145,34 +243,66 @@ class IOptimizer(ABC, T.Generic[T_GraphInput, T_Context, T_GraphOutput], ConfigT
     def __get_output_parallel(self) -> T_GraphOutput | None:
         assert self.main_conn is not None
         assert self.child_proc and self.child_proc.is_alive()
-        if self.has_opt_job:
+        if self.drained_res is not None:
+            graph_res_local, self.drained_res = self.drained_res, None
+            return graph_res_local
+        elif self.has_opt_job:
             while not self.main_conn.poll(timeout=0.1):
                 if not self.child_proc.is_alive():
                     raise RuntimeError("Optimizer child process exited unexpectedly!")
                 pass
             
-            graph_res: T_GraphOutput = self.main_conn.recv()
+            graph_res: T_GraphOutput
+            graph_res, worker_spans = self.main_conn.recv()
+            Timer.merge_spans(worker_spans)
             graph_res_local = move_dataclass_to_local(graph_res)
             del graph_res
             self.has_opt_job = False
+            self._collect_telemetry(graph_res_local)
             return graph_res_local
         else:
             return None
 
+    ## Parallel Version (thread)
+    def __launch_optim_thread(self, graph_data: T_GraphInput) -> None:
+        assert self.executor is not None
+        # The pending job (if any) is collected first, so the next job starts from its updated context.
+        self.__collect_thread()
+        self.opt_future  = self.executor.submit(self._optimize, self.context, graph_data)
+        self.has_opt_job = True
+
+    def __get_output_thread(self) -> T_GraphOutput | None:
+        self.__collect_thread()
+        graph_res, self.drained_res = self.drained_res, None
+        return graph_res
+
+    def __collect_thread(self) -> None:
+        if self.opt_future is None: return
+        # Exception raised on worker thread is re-raised here.
+        self.context, self.drained_res = self.opt_future.result()
+        self.opt_future  = None
+        self.has_opt_job = False
+        self._collect_telemetry(self.drained_res)
+
+    def _collect_telemetry(self, graph_res: T_GraphOutput | None) -> None:
+        record = getattr(graph_res, "telemetry", None)
+        if record is not None: self.telemetry.append(record)
+
     ### External Interface used by Users    #############################################
     @T.final
     @property
     def is_running(self) -> bool:
         """
         Returns immediately, indicate the status of optimizer:
-        - true if there is a job on child process running.
+        - true if there is a job on child process (worker thread) running.
         - false otherwise - which includes the following cases:
-            1. The optimizer is not running in parallel mode (no child process)
+            1. The optimizer is not running in parallel mode (no child process / worker thread)
             2. The job on child process is finished.
             3. The child process have not received optimization job yet.
         """
-        if self.main_conn is None: return False         # Not in Parallel Mode
         if not self.has_opt_job: return False      # No Job on Child
+        if self.opt_future is not None: return not self.opt_future.done()   # Thread Mode
+        if self.main_conn is None: return False         # Not in Parallel Mode
         return (not self.main_conn.poll(timeout=0))     # Job on Child but not finished
     
     @T.final
@@ -203,18 +333,24 @@ class IOptimizer(ABC, T.Generic[T_GraphInput, T_Context, T_GraphOutput], ConfigT
                     return input_type
         raise TypeError("T_GraphOutput not explicitly specified in IOptimizer subclass.")
     
+    def telemetry_summary(self) -> dict:
+        """
+        Summary of collected convergence records, see `summarize_convergence`.
+        """
+        return summarize_convergence(self.telemetry)
+
     def get_optimal(self) -> T_GraphOutput | None:
-        if self.is_parallel_mode:
-            return self.__get_output_parallel()
-        else:
-            return self.__get_output_sequential()
+        return self.get_result()
     
     def start_optimize(self, graph_data: T_GraphInput) -> None:
-        if self.is_parallel_mode:
-            # Send T_GraphArg to child process using Pipe
-            self.__launch_optim_parallel(graph_data)
-        else:
-            self.__launch_optim_sequential(graph_data)
+        match self.mode:
+            case "process":
+                # Send T_GraphArg to child process using Pipe
+                self.__launch_optim_parallel(graph_data)
+            case "thread":
+                self.__launch_optim_thread(graph_data)
+            case "sequential":
+                self.__launch_optim_sequential(graph_data)
         
     def sequential_optimize(self, graph_data: T_GraphInput) -> T_GraphOutput:
         assert self.context is not None
@@ -222,23 +358,59 @@ class IOptimizer(ABC, T.Generic[T_GraphInput, T_Context, T_GraphOutput], ConfigT
         return optim_res
     
     def write_map(self, global_map: VisualMap):
-        if self.is_parallel_mode:
-            # Recv T_GraphArg from child process using Pipe
-            graph_res_local = self.__get_output_parallel()
-        else:
-            graph_res_local = self.__get_output_sequential()
-
+        # Recv T_GraphArg from child process using Pipe (or wait for the worker thread) in parallel mode
+        graph_res_local = self.get_result()
         self.write_graph_data(graph_res_local, global_map)
 
     def get_result(self) -> T_GraphOutput | None:
-        if self.is_parallel_mode:
-            return self.__get_output_parallel()
-        else:
-            return self.__get_output_sequential()
+        match self.mode:
+            case "process"   : return self.__get_output_parallel()
+            case "thread"    : return self.__get_output_thread()
+            case "sequential": return self.__get_output_sequential()
+
+    def state_dict(self) -> dict:
+        """
+        Optimization context and the not-yet-written result for checkpointing.
+        
+        NOTE: in parallel mode, this blocks until the pending optimization job is finished.
+        """
+        match self.mode:
+            case "sequential":
+                return {"context": self.context, "result": self.optimize_res, "telemetry": list(self.telemetry)}
+            case "thread":
+                self.__collect_thread()
+                return {"context": self.context, "result": self.drained_res, "telemetry": list(self.telemetry)}
+        
+        assert self.main_conn is not None
+        self.drained_res = self.__get_output_parallel()
+        self.main_conn.send(ContextMessage())
+        context_msg: ContextMessage = self.main_conn.recv()
+        return {"context": context_msg.context, "result": self.drained_res, "telemetry": list(self.telemetry)}
+    
+    def load_state_dict(self, state: dict) -> None:
+        # Finish the pending job first, so its record is not appended to the restored telemetry.
+        match self.mode:
+            case "thread" : self.__collect_thread()
+            case "process": self.__get_output_parallel()
+        self.telemetry = list(state.get("telemetry", []))
+        match self.mode:
+            case "sequential":
+                self.context, self.optimize_res = state["context"], state["result"]
+                return
+            case "thread":
+                self.context, self.drained_res = state["context"], state["result"]
+                return
+        
+        assert self.main_conn is not None
+        self.main_conn.send(ContextMessage(state["context"]))
+        self.drained_res = state["result"]
 
     def terminate(self):
         if self.child_proc and self.child_proc.is_alive():
             self.child_proc.terminate()
+        if self.executor is not None:
+            # A running job can not be interrupted, it is left to finish without blocking the caller.
+            self.executor.shutdown(wait=False, cancel_futures=True)
 
 
 def IOptimizerParallelWorker(
@@ -246,19 +418,28 @@ def IOptimizerParallelWorker(
     init_context: T.Callable[[SimpleNamespace,], T_Context],
     optimize: T.Callable[[T_Context, T_GraphInput], tuple[T_Context, T_GraphOutput]],
     child_conn: Conn_Type,
+    timer_active: bool = False,
+    num_threads: int = 8,
 ):
     Logger.write("info", "OptimizationParallelWorker started")
+    Timer.setup(active=timer_active)
     # NOTE: child process ignore keyboard interrupt to ignore deadlock
     # (parent process will terminate child process on exit in MAC-VO implementation)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-    torch.set_num_threads(8)
+    torch.set_num_threads(num_threads)
     context = init_context(config)
     while True:
         if not child_conn.poll(timeout=0.1): continue
         
-        graph_args: T_GraphInput = child_conn.recv()
+        graph_args: T_GraphInput | ContextMessage = child_conn.recv()
+        if isinstance(graph_args, ContextMessage):
+            if graph_args.context is None: child_conn.send(ContextMessage(context))
+            else                         : context = graph_args.context
+            continue
+        
         graph_args_local = move_dataclass_to_local(graph_args)
         del graph_args
         
         context, graph_res = optimize(context, graph_args_local)
-        child_conn.send(graph_res)
+        # Spans recorded on worker are shipped back with the result and merged into main process timeline.
+        child_conn.send((graph_res, Timer.drain_spans()))
@@ -1,12 +1,15 @@
+import time
 import typing
 from abc import ABC, abstractmethod
-from typing import final
+from typing import final, NamedTuple
 import torch
+import pypose as pp
 from torch import nn
 from pypose.optim.functional import modjac
 from pypose.optim.strategy import TrustRegion
 from pypose.optim.solver import Cholesky
 from pypose.optim.corrector import FastTriggs
+from pypose.optim.kernel import Huber
 from pypose.optim.optimizer import _Optimizer, Trivial, RobustModel
 
 
@@ -21,6 +24,53 @@ class FactorGraph(nn.Module, ABC):
     def covariance_array(self) -> torch.Tensor: ...
 
 
+class BatchedFactorGraph(nn.Module, ABC):
+    """
+    B independent factor graphs, each optimizing a single SE3 pose (`pose2opt`, Bx7) with up to N residual
+    blocks of dimension m. Graphs with less residuals are padded to N, padded blocks are `False` in `mask` (BxN)
+    and must be zero in residual and jacobian.
+    """
+    pose2opt: torch.Tensor
+    mask    : torch.Tensor
+
+    @abstractmethod
+    def residual(self, pose: pp.LieTensor) -> torch.Tensor:
+        """
+        BxNxm residual of all graphs at given poses (Bx7).
+        """
+        ...
+
+    @abstractmethod
+    def jacobian(self, pose: pp.LieTensor) -> torch.Tensor:
+        """
+        BxNxmx6 jacobian of residual w.r.t. left perturbation of the pose (same convention as `LieTensor.add_`).
+        """
+        ...
+
+    @abstractmethod
+    def covariance_array(self, pose: pp.LieTensor) -> torch.Tensor:
+        """
+        BxNxmxm covariance of residual blocks at given poses.
+        """
+        ...
+
+    @abstractmethod
+    def write_back(self) -> typing.Any: ...
+
+    def linearize(self, pose: pp.LieTensor, delta: float) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Optional, (JᵀWJ, -JᵀWR, JᵀJ, JᵀR) at given poses with FastTriggs-corrected Huber(delta) kernel, evaluated as
+        a single (compiled) kernel. Used by `LM_batched` with `compiled=True`.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not provide compiled linearization.")
+
+    def robust_loss(self, pose: pp.LieTensor, delta: float) -> torch.Tensor:
+        """
+        Optional, B Huber(delta) loss at given poses, evaluated as a single (compiled) kernel.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not provide compiled loss.")
+
+
 class AnalyticModule(nn.Module, ABC):
     verify: bool = False
     def __init__(self, *args, **kwargs) -> None:
@@ -44,6 +94,52 @@ class AnalyticModule(nn.Module, ABC):
         """
         pass 
     
+    @torch.no_grad()
+    @abstractmethod
+    def build_jacobian_blocks(self, index: slice) -> torch.Tensor:
+        """
+        This function should be implemented by the user.
+        It should return the jacobian of residual blocks at `index` of the model's previous forward call (n x m x P),
+        used by `LM_analytic` to accumulate the normal equation block-wise (see `normal_equation`).
+        """
+        pass
+
+    @final
+    @torch.no_grad()
+    def normal_equation(self, R: torch.Tensor, weight: torch.Tensor, scale: torch.Tensor, chunk: int
+                        ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Accumulate normal equation of the weighted least square problem over residual blocks, `chunk` blocks at
+        a time, without materializing the full jacobian (Nm x P) or the block-diagonal weight (Nm x Nm).
+        
+        * R      - N x m residual of previous forward call.
+        * weight - N x m x m information matrix of each residual block.
+        * scale  - N x m row scale of residual and jacobian (from the robust corrector).
+        
+        Returns (JᵀWJ, -JᵀWR, JᵀJ, JᵀR) of the scaled jacobian J and residual R.
+        """
+        if self.verify:
+            J_analytic = self.build_jacobian_blocks(slice(None)).flatten(0, 1)
+            assert self.verify_jacobian(J_analytic), "Analytic Jacobian from build_jacobian_blocks() does not match with autograd jacobian!"
+        
+        A, b, JtJ, JtR = None, None, None, None
+        for start in range(0, R.size(0), chunk):
+            index = slice(start, start + chunk)
+            J     = self.build_jacobian_blocks(index)
+            S, r  = scale[index], R[index]
+            W     = S.unsqueeze(-1) * weight[index] * S.unsqueeze(-2)
+            Js    = S.unsqueeze(-1) * J
+            terms = (
+                torch.einsum("nip,nij,njq->pq", J, W, J),
+                -torch.einsum("nip,nij,nj->p", J, W, r).unsqueeze(-1),
+                torch.einsum("nip,niq->pq", Js, Js),
+                torch.einsum("nip,ni->p", Js, S * r).unsqueeze(-1),
+            )
+            if A is None: A, b, JtJ, JtR = terms
+            else        : A, b, JtJ, JtR = (x + y for x, y in zip((A, b, JtJ, JtR), terms))
+        assert A is not None and b is not None and JtJ is not None and JtR is not None, "Empty optimization problem."
+        return A, b, JtJ, JtR
+
     @final
     @torch.no_grad()  
     def jacobian(self) -> torch.Tensor:
@@ -133,9 +229,32 @@ class LM_autograd(_Optimizer):
         return self.loss
 
 
+def reduced_system(JtJ: torch.Tensor, JtR: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns a (P x P) J' and (P x 1) R' with J'ᵀJ' = JᵀJ and J'ᵀR' = JᵀR. `TrustRegion.update` only depends on J and R
+    through these products, so it can be evaluated on (J', R') when J is never materialized.
+    """
+    eigval, eigvec = torch.linalg.eigh(JtJ)
+    eigval = eigval.clamp(min=0.)
+    root   = eigval.sqrt()
+    J_red  = root.unsqueeze(-1) * eigvec.mT
+    inv    = torch.where(root > root.max() * 1e-12, root.reciprocal(), 0.)     # JᵀR has no component in null(J)
+    R_red  = inv.unsqueeze(-1) * (eigvec.mT @ JtR)
+    return J_red, R_red
+
+
 class LM_analytic(_Optimizer):
+    """
+    LM optimizer on `AnalyticModule`. When `chunk` is set, `weight` of `step` is the information matrix of each residual
+    block (N x m x m) and the normal equation is accumulated by `AnalyticModule.normal_equation`, so neither the full
+    jacobian nor the block-diagonal weight is formed. Otherwise `weight` is the dense (Nm x Nm) weight matrix.
+
+    When `grad_tol` is set, a step whose gradient norm fell below `grad_tol` times the gradient norm of the first
+    step is not taken and `converged` is set.
+    """
     def __init__(self, model: AnalyticModule, solver=None, strategy=None, kernel=None, corrector=None, \
-                       weight=None, reject=16, min=1e-6, max=1e32, vectorize=True):
+                       weight=None, reject=16, min=1e-6, max=1e32, vectorize=True, chunk: int | None = None,
+                       grad_tol: float | None = None):
         assert min > 0, ValueError("min value has to be positive: {}".format(min))
         assert max > 0, ValueError("max value has to be positive: {}".format(max))
         self.strategy = TrustRegion() if strategy is None else strategy
@@ -154,31 +273,58 @@ class LM_analytic(_Optimizer):
         self.corrector = [self.corrector] if not isinstance(self.corrector, (tuple, list)) else self.corrector
         self.corrector = [c if c is not None else Trivial() for c in self.corrector]
         self.model = RobustModel(model, kernel)
+        self.chunk = chunk
+        self.grad_tol  = grad_tol
+        self.grad_norm0: torch.Tensor | None = None
+        self.converged = False
 
+    def fused_system(self, R: torch.Tensor, weight: torch.Tensor | None) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns (A, b) of the normal equation, with (J', R') of `reduced_system` for the trust region strategy.
+        """
+        assert self.chunk is not None
+        model = typing.cast(AnalyticModule, self.model.model)
+        R     = R.view(R.size(0), -1)
+        # Row scale of the corrector, obtained by correcting a jacobian of ones.
+        _, scale = self.corrector[0](R, torch.ones((R.numel(), 1), dtype=R.dtype, device=R.device))
+        if weight is None:
+            weight = torch.eye(R.size(-1), dtype=R.dtype, device=R.device).expand(R.size(0), -1, -1)
+        A, b, JtJ, JtR = model.normal_equation(R, weight, scale.view_as(R), self.chunk)
+        J_red, R_red   = reduced_system(JtJ, JtR)
+        return A, b, J_red, R_red
 
     @torch.no_grad()
     def step(self, input, target=None, weight=None):    #type: ignore
         for pg in self.param_groups:
             weight_mtr = self.weight if weight is None else weight
             R = self.model(input, target=target)
-            J = self.model.model.jacobian()
             R = torch.cat(R, dim=0)
             self.last = self.loss = self.loss if hasattr(self, 'loss') else self.model.loss(input, target)
             self.reject_count = 0
-            R, J = self.corrector[0](R, J)
-            J_T = J.mT 
-            if weight is None:
-                A = J_T @ J
-                b = -J_T @ R.view(-1, 1)
+            if self.chunk is not None:
+                A, b, J, R = self.fused_system(R, weight_mtr)
             else:
-                J_T = J_T @ weight_mtr
-                A = J_T  @ J
-                b = - J_T  @ R.view(-1, 1)
+                J = self.model.model.jacobian()
+                R, J = self.corrector[0](R, J)
+                J_T = J.mT 
+                if weight_mtr is None:
+                    A = J_T @ J
+                    b = -J_T @ R.view(-1, 1)
+                else:
+                    J_T = J_T @ weight_mtr
+                    A = J_T  @ J
+                    b = - J_T  @ R.view(-1, 1)
+            grad_norm = b.norm()
+            if self.grad_norm0 is None:
+                self.grad_norm0 = grad_norm
+            elif self.grad_tol is not None and grad_norm <= self.grad_tol * self.grad_norm0:
+                self.converged = True
+                return self.loss
             A.diagonal().clamp_(pg['min'], pg['max'])
             while self.last <= self.loss:
                 A.diagonal().add_(A.diagonal() * pg['damping'])
                 try:
-                    D = self.solver(A = A, b = -J_T @ R.view(-1, 1))
+                    D = self.solver(A = A, b = b)
                 except Exception as e:
                     print(e, "\nLinear solver failed. Breaking optimization step...")
                     break
@@ -192,3 +338,159 @@ class LM_analytic(_Optimizer):
                 else:
                     break
         return self.loss
+
+
+class BatchedLMResult(NamedTuple):
+    loss     : torch.Tensor     # B   , robust loss at the final pose
+    damping  : torch.Tensor     # B   , final damping of trust region
+    num_step : torch.Tensor     # B   , number of LM steps taken
+    converged: torch.Tensor     # B   , stopped on plateau (instead of step limit)
+    history  : torch.Tensor     # Bx(steps+1), loss before the first step and after each step (NaN once stopped)
+    time_ms  : float            # wall-clock time of the whole solve
+
+
+class LM_batched:
+    """
+    Levenberg-Marquardt on all problems of a `BatchedFactorGraph` at once. Every problem keeps its own damping,
+    step rejection and plateau termination, following `LM_analytic` with `FastTriggs` corrector, `TrustRegion`
+    strategy and `StopOnPlateau` scheduler, so each problem is solved as if it was optimized alone. Problems that
+    terminated are masked out of updates (but not out of the batched computation).
+
+    With `compiled=True`, the linearization and loss are evaluated by the compiled kernels of the graph
+    (`linearize` / `robust_loss`), the kernel must be a `Huber` kernel.
+    """
+    def __init__(self, graph: BatchedFactorGraph, kernel: nn.Module | None = None, radius=1e6, high=.5, low=1e-3,
+                       up=2., down=.5, factor=.5, reject=16, min=1e-6, max=1e32, radius_min=1e-6, radius_max=1e16,
+                       compiled: bool = False):
+        assert min > 0, ValueError("min value has to be positive: {}".format(min))
+        assert max > 0, ValueError("max value has to be positive: {}".format(max))
+        self.graph  = graph
+        self.kernel = kernel
+        self.delta: float | None = None
+        if compiled:
+            assert isinstance(kernel, Huber), "Compiled LM_batched only supports Huber kernel."
+            self.delta = float(kernel.delta)
+        self.radius, self.high, self.low, self.up, self.down, self.factor = radius, high, low, up, down, factor
+        self.radius_min, self.radius_max = radius_min, radius_max
+        self.reject, self.min, self.max  = reject, min, max
+
+    @torch.no_grad()
+    def loss(self, pose: pp.LieTensor) -> torch.Tensor:
+        if self.delta is not None: return self.graph.robust_loss(pose, self.delta)
+        x = self.graph.residual(pose).square().sum(-1)
+        x = x if self.kernel is None else self.kernel(x)
+        return torch.where(self.graph.mask, x, 0.).sum(-1)
+
+    @torch.no_grad()
+    def optimize(self, steps: int = 10, patience: int = 2, decreasing: float = 1e-5, damping: torch.Tensor | float | None = None,
+                 time_budget: float | None = None, grad_tol: float | None = None) -> BatchedLMResult:
+        """
+        Optimize until every problem reached `steps` or plateaued (loss decreased less than `decreasing` for
+        `patience` consecutive steps). Optimized poses are written to `graph.pose2opt`.
+        
+        * damping     - initial damping (e.g. from a previous solve), default to 1 / radius.
+        * time_budget - wall-clock budget (ms), no step is started if it is expected to exceed the budget.
+        * grad_tol    - a problem also converges when its gradient norm fell below `grad_tol` times its initial one.
+        """
+        graph = self.graph
+        pose  = pp.SE3(graph.pose2opt.detach().clone())
+        B     = pose.size(0)
+        like  = dict(dtype=pose.dtype, device=pose.device)
+        start = time.perf_counter()
+
+        loss      = self.loss(pose)
+        damping   = torch.full((B,), 1. / self.radius, **like) if damping is None else torch.as_tensor(damping, **like).expand(B).clone()
+        down      = torch.full((B,), self.down, **like)
+        num_step  = torch.zeros((B,), dtype=torch.long, device=pose.device)
+        stall     = torch.zeros((B,), dtype=torch.long, device=pose.device)
+        active    = torch.ones((B,), dtype=torch.bool, device=pose.device)
+        converged = torch.zeros((B,), dtype=torch.bool, device=pose.device)
+        grad_norm0: torch.Tensor | None = None
+        history   = torch.full((B, steps + 1), torch.nan, **like)
+        history[:, 0] = loss
+
+        for step in range(steps):
+            if not active.any(): break
+            if time_budget is not None and step > 0 and (time.perf_counter() - start) * 1e3 * (step + 1) / step > time_budget: break
+            last = loss
+            A, b, JtJ, JtR = self.linearize(pose)
+            grad_norm = b.flatten(1).norm(dim=-1)
+            if grad_norm0 is None:
+                grad_norm0 = grad_norm
+            elif grad_tol is not None:
+                small      = active & (grad_norm <= grad_tol * grad_norm0)
+                converged |= small
+                active    &= ~small
+            A.diagonal(dim1=-2, dim2=-1).clamp_(self.min, self.max)
+
+            pending, num_reject = active.clone(), 0
+            while pending.any():
+                diag = A.diagonal(dim1=-2, dim2=-1)
+                diag.add_(torch.where(pending.unsqueeze(-1), diag * damping.unsqueeze(-1), 0.))
+                D = torch.where(pending.unsqueeze(-1), (torch.linalg.pinv(A) @ b).squeeze(-1), 0.)
+
+                trial      = pp.se3(D).Exp() @ pose
+                trial_loss = self.loss(trial)
+                # Predicted decrease -(JD)ᵀ(2R + JD) of the (corrected) linear model, as in TrustRegion.update
+                predicted     = -(D.unsqueeze(-2) @ (JtJ @ D.unsqueeze(-1) + 2 * JtR)).view(B)
+                damping, down = self.__update_region(pending, last, trial_loss, predicted, damping, down)
+
+                rejected = pending & (trial_loss > last) & (num_reject < self.reject)
+                accepted = pending & ~rejected
+                pose     = pp.SE3(torch.where(accepted.unsqueeze(-1), trial.tensor(), pose.tensor()))
+                loss     = torch.where(accepted, trial_loss, loss)
+                pending, num_reject = rejected, num_reject + 1
+
+            history[:, step + 1] = torch.where(active, loss, torch.nan)
+            num_step  += active.long()
+            stall      = torch.where(active, torch.where(last - loss < decreasing, stall + 1, 0), stall)
+            plateau    = active & (stall >= patience)
+            converged |= plateau
+            active    &= ~plateau
+
+        graph.pose2opt.data.copy_(pose.tensor())
+        return BatchedLMResult(loss=loss, damping=damping, num_step=num_step, converged=converged, history=history,
+                               time_ms=(time.perf_counter() - start) * 1e3)
+
+    @torch.no_grad()
+    def linearize(self, pose: pp.LieTensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns (JᵀWJ, -JᵀWR, JᵀJ, JᵀR) of the corrected residual at given poses, each summed over residual blocks.
+        """
+        graph = self.graph
+        if self.delta is not None: return graph.linearize(pose, self.delta)
+
+        R, J = self.__correct(graph.residual(pose), graph.jacobian(pose))
+        W    = torch.where(graph.mask[..., None, None], torch.linalg.pinv(graph.covariance_array(pose)), 0.)
+        J_TW = J.mT @ W                                             # B x N x 6 x m
+        return (
+            (J_TW @ J).sum(dim=1),                                  # B x 6 x 6
+            -(J_TW @ R.unsqueeze(-1)).sum(dim=1),                   # B x 6 x 1
+            (J.mT @ J).sum(dim=1),
+            (J.mT @ R.unsqueeze(-1)).sum(dim=1),
+        )
+
+    def __correct(self, R: torch.Tensor, J: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        FastTriggs correction, scale every residual block (and its jacobian) by sqrt of kernel derivative.
+        """
+        if self.kernel is None: return R, J
+        with torch.enable_grad():
+            x = R.square().sum(-1).detach().requires_grad_(True)
+            grad, = torch.autograd.grad(self.kernel(x).sum(), x)
+        scale = torch.where(self.graph.mask, grad, 0.).sqrt()     # Kernel derivative may be NaN on padded blocks
+        return scale[..., None] * R, scale[..., None, None] * J
+
+    def __update_region(self, pending: torch.Tensor, last: torch.Tensor, loss: torch.Tensor, predicted: torch.Tensor,
+                        damping: torch.Tensor, down: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Per-problem `TrustRegion.update`, returns updated (damping, down) where `pending`.
+        """
+        quality   = (last - loss) / predicted
+        radius    = damping.reciprocal()
+
+        new_radius = torch.where(quality > self.high, radius * self.up, torch.where(quality > self.low, radius, radius * down))
+        new_down   = torch.where(quality > self.low, torch.full_like(down, self.down), down * self.factor)
+        new_radius = new_radius.clamp(self.radius_min, self.radius_max)
+        new_down   = new_down.clamp(self.radius_min, self.radius_max)
+        return torch.where(pending, new_radius.reciprocal(), damping), torch.where(pending, new_down, down)
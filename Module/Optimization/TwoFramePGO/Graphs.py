@@ -5,7 +5,9 @@ from dataclasses import dataclass
 
 from Module.Map import MatchObs, PointNode
 from Utility.Point import pixel2point_NED, point2pixel_NED
-from ..PyposeOptimizers import AnalyticModule, FactorGraph
+from ..Interface import ConvergenceRecord
+from ..PyposeOptimizers import AnalyticModule, FactorGraph, BatchedFactorGraph
+from . import Kernels
 
 
 @dataclass
@@ -26,11 +28,18 @@ class GraphOutput:
     motion   : torch.Tensor
     from_idx : torch.Tensor
     frame_idx: torch.Tensor
+    telemetry: ConvergenceRecord | None = None     # Set by solvers that report convergence
+    outlier  : torch.Tensor | None = None          # Map index of observations rejected at the optimum
 
 
 ############## Optimization Graphs
 
 class ICP_TwoframePGO(FactorGraph):
+    # Fields of observations (MatchObs) and points (PointNode) read by the graph, only these fields
+    # are gathered from the map (see TwoFrame_PGO.get_graph_data).
+    OBS_FIELDS  : T.ClassVar[tuple[str, ...]] = ("pixel2_uv", "pixel2_d", "obs2_covTc")
+    POINT_FIELDS: T.ClassVar[tuple[str, ...]] = ("pos_Tw", "cov_Tw")
+    
     def __init__(self, graph_data: GraphInput) -> None:
         super().__init__()
         self.device                = graph_data.device
@@ -74,6 +83,9 @@ class ICP_TwoframePGO(FactorGraph):
 
 
 class Reproj_TwoFramePGO(FactorGraph):
+    OBS_FIELDS  : T.ClassVar[tuple[str, ...]] = ("pixel2_uv", "pixel2_uv_cov")
+    POINT_FIELDS: T.ClassVar[tuple[str, ...]] = ("pos_Tw", "cov_Tw")
+    
     def __init__(self, graph_data: GraphInput) -> None:
         super().__init__()
         self.from_idx : torch.Tensor = graph_data.from_idx
@@ -119,6 +131,8 @@ class Reproj_TwoFramePGO(FactorGraph):
 
 
 class ReprojDisp_TwoFramePGO(Reproj_TwoFramePGO):
+    OBS_FIELDS  : T.ClassVar[tuple[str, ...]] = Reproj_TwoFramePGO.OBS_FIELDS + ("pixel2_disp", "pixel2_disp_cov")
+    
     def __init__(self, graph_data: GraphInput) -> None:
         super().__init__(graph_data)
         self.register_buffer("baseline", graph_data.baseline)
@@ -154,9 +168,12 @@ class Analytic_ICP_TwoframePGO(ICP_TwoframePGO, AnalyticModule):
 
     @torch.no_grad()
     def build_jacobian(self) -> torch.Tensor:
-        frame_pose = T.cast(pp.LieTensor, self.pose2opt[self.edges_index])
-        R = frame_pose.rotation().matrix()
-        p = self.points_Tc
+        return self.build_jacobian_blocks(slice(None)).view(-1, 7)
+
+    @torch.no_grad()
+    def build_jacobian_blocks(self, index: slice) -> torch.Tensor:
+        frame_pose = T.cast(pp.LieTensor, self.pose2opt[self.edges_index[index]])
+        p = self.points_Tc[index]
         E = p.shape[0]
 
         J = torch.zeros((E, 3, 7), device=p.device, dtype=p.dtype)
@@ -165,7 +182,7 @@ class Analytic_ICP_TwoframePGO(ICP_TwoframePGO, AnalyticModule):
         J[..., 0:3] = I3
         J[..., 3:6] = -pp.vec2skew(frame_pose.Act(p))
 
-        return J.view(-1, 7)
+        return J
 
 
 class Analytic_Reproj_TwoFramePGO(Reproj_TwoFramePGO, AnalyticModule):
@@ -174,15 +191,20 @@ class Analytic_Reproj_TwoFramePGO(Reproj_TwoFramePGO, AnalyticModule):
 
     @torch.no_grad()
     def build_jacobian(self) -> torch.Tensor:
+        return self.build_jacobian_blocks(slice(None)).view(-1, 7)
+
+    @torch.no_grad()
+    def build_jacobian_blocks(self, index: slice) -> torch.Tensor:
         assert self.pos_Tc is not None, "pos_Tc not found, need to call forward() before building jacobian."
         fx = self.K[0, 0]
         fy = self.K[1, 1]
         assert self.K[0, 1] == 0, "K[0, 1] non-zero is currently not supported"
         # s = self.K[0, 1] # TODO: add this feature later!
 
-        x, y, z = self.pos_Tc[:, 0], self.pos_Tc[:, 1], self.pos_Tc[:, 2]
+        pos_Tc = self.pos_Tc[index]
+        x, y, z = pos_Tc[:, 0], pos_Tc[:, 1], pos_Tc[:, 2]
         x_square = x ** 2
-        J_homoKS = torch.zeros(self.pos_Tc.shape[0], 2, 3, device=self.pos_Tc.device, dtype=self.pos_Tc.dtype)
+        J_homoKS = torch.zeros(pos_Tc.shape[0], 2, 3, device=pos_Tc.device, dtype=pos_Tc.dtype)
         J_homoKS[:, 0, 0] = -fx * y / x_square
         J_homoKS[:, 0, 1] = fx / x
         J_homoKS[:, 1, 0] = -fy * z / x_square
@@ -190,11 +212,11 @@ class Analytic_Reproj_TwoFramePGO(Reproj_TwoFramePGO, AnalyticModule):
 
         R = self.pose2opt.rotation().matrix()
         R_T = R.transpose(-2, -1)
-        J_Tinv_p = torch.zeros(self.pos_Tc.shape[0], 3, 7, device=self.pos_Tc.device,
-                               dtype=self.pos_Tc.dtype)  # 7 width because of pypose implementation, last column is useless
+        J_Tinv_p = torch.zeros(pos_Tc.shape[0], 3, 7, device=pos_Tc.device,
+                               dtype=pos_Tc.dtype)  # 7 width because of pypose implementation, last column is useless
         J_Tinv_p[..., :3] = -R_T
-        J_Tinv_p[..., 3:6] = R_T @ pp.vec2skew(self.pos_Tw)
-        J = (J_homoKS @ J_Tinv_p).view(-1, 7)
+        J_Tinv_p[..., 3:6] = R_T @ pp.vec2skew(self.pos_Tw[index])
+        J = J_homoKS @ J_Tinv_p
         return J
 
 
@@ -204,6 +226,10 @@ class Analytic_ReprojDisp_TwoFramePGO(ReprojDisp_TwoFramePGO, AnalyticModule):
 
     @torch.no_grad()
     def build_jacobian(self) -> torch.Tensor:
+        return self.build_jacobian_blocks(slice(None)).view(-1, 7)
+
+    @torch.no_grad()
+    def build_jacobian_blocks(self, index: slice) -> torch.Tensor:
         assert self.pos_Tc is not None, "pos_Tc not found, need to call forward() before building jacobian."
         fx = self.K[0, 0]
         fy = self.K[1, 1]
@@ -212,20 +238,174 @@ class Analytic_ReprojDisp_TwoFramePGO(ReprojDisp_TwoFramePGO, AnalyticModule):
         assert self.K[0, 1] == 0, "K[0, 1] non-zero is currently not supported"
         # s = self.K[0, 1] # TODO: add this feature later!
 
-        x, y, z = self.pos_Tc[:, 0], self.pos_Tc[:, 1], self.pos_Tc[:, 2]
+        pos_Tc = self.pos_Tc[index]
+        x, y, z = pos_Tc[:, 0], pos_Tc[:, 1], pos_Tc[:, 2]
         x_square = x ** 2
-        J_homoKS = torch.zeros(self.pos_Tc.shape[0], 2, 3, device=self.pos_Tc.device, dtype=self.pos_Tc.dtype)
+        J_homoKS = torch.zeros(pos_Tc.shape[0], 2, 3, device=pos_Tc.device, dtype=pos_Tc.dtype)
         J_homoKS[:, 0, 0] = -fx * y / x_square
         J_homoKS[:, 0, 1] = fx / x
         J_homoKS[:, 1, 0] = -fy * z / x_square
         J_homoKS[:, 1, 2] = fy / x
         R = self.pose2opt.rotation().matrix()
         R_T = R.transpose(-2, -1)
-        J_Tinv_p = torch.zeros(self.pos_Tc.shape[0], 3, 7, device=self.pos_Tc.device,
-                               dtype=self.pos_Tc.dtype)  # 7 width because of pypose implementation, last column is useless
+        J_Tinv_p = torch.zeros(pos_Tc.shape[0], 3, 7, device=pos_Tc.device,
+                               dtype=pos_Tc.dtype)  # 7 width because of pypose implementation, last column is useless
         J_Tinv_p[..., :3] = -R_T
-        J_Tinv_p[..., 3:6] = R_T @ pp.vec2skew(self.pos_Tw)
+        J_Tinv_p[..., 3:6] = R_T @ pp.vec2skew(self.pos_Tw[index])
         J_reproj = (J_homoKS @ J_Tinv_p)
         J_disp = (-(self.baseline * fx) / x_square).view(-1, 1, 1) * J_Tinv_p[:, 0:1, :]
-        J = torch.cat((J_reproj, J_disp), dim=1).view(-1, 7)
+        J = torch.cat((J_reproj, J_disp), dim=1)
         return J
+
+
+
+############## Batched Optimization Graphs
+# Same residuals and analytic jacobians as the graphs above, for B independent problems padded to the same
+# number of observations (see LM_batched). The math is in `Kernels`, `linearize` / `robust_loss` run it as
+# compiled kernels.
+
+class Batched_TwoFramePGO(BatchedFactorGraph):
+    def __init__(self, graph_data: T.Sequence[GraphInput], length: int | None = None) -> None:
+        """
+        Observations of all problems are padded to `length` (default to the largest problem).
+        """
+        super().__init__()
+        assert len(graph_data) > 0
+        assert all(g.init_motion.numel() == 7 for g in graph_data), "Batched graph optimizes one pose per problem."
+        self.from_idx : list[torch.Tensor] = [g.from_idx for g in graph_data]
+        self.frame_idx: list[torch.Tensor] = [g.frame_idx for g in graph_data]
+
+        lengths     = torch.tensor([g.edges_index.size(0) for g in graph_data])
+        self.length = int(lengths.max()) if length is None else length
+        assert self.length >= int(lengths.max())
+
+        self.pose2opt = pp.Parameter(pp.SE3(torch.stack([pp.SE3(g.init_motion).tensor().view(7) for g in graph_data])))
+        self.mask: torch.Tensor
+        self.K   : torch.Tensor
+        self.register_buffer("mask", torch.arange(self.length).unsqueeze(0) < lengths.unsqueeze(1))
+        self.register_buffer("K", torch.stack([g.images_intrinsic for g in graph_data]))
+
+    @staticmethod
+    def bucket(num: int, minimum: int = 64) -> int:
+        """
+        Padded length for `num` observations (next power of two), keeps the number of compiled shapes small.
+        """
+        return max(minimum, 1 << max(num - 1, 0).bit_length())
+
+    def pad(self, values: T.Sequence[torch.Tensor]) -> torch.Tensor:
+        padded = values[0].new_zeros((len(values), self.length, *values[0].shape[1:]))
+        for idx, value in enumerate(values): padded[idx, :value.size(0)] = value
+        return padded
+
+    def masked(self, value: torch.Tensor) -> torch.Tensor:
+        mask = self.mask.view(*self.mask.shape, *([1] * (value.dim() - 2)))
+        return torch.where(mask, value, 0.)
+
+    @torch.no_grad()
+    def write_back(self) -> list[GraphOutput]:
+        return [
+            GraphOutput(motion=pp.SE3(self.pose2opt[idx:idx+1].detach()), frame_idx=frame_idx, from_idx=from_idx)
+            for idx, (frame_idx, from_idx) in enumerate(zip(self.frame_idx, self.from_idx))
+        ]
+
+
+class Batched_ICP_TwoframePGO(Batched_TwoFramePGO):
+    OBS_FIELDS  : T.ClassVar[tuple[str, ...]] = ICP_TwoframePGO.OBS_FIELDS
+    POINT_FIELDS: T.ClassVar[tuple[str, ...]] = ICP_TwoframePGO.POINT_FIELDS
+
+    def __init__(self, graph_data: T.Sequence[GraphInput], length: int | None = None) -> None:
+        super().__init__(graph_data, length)
+        self.points_Tc: torch.Tensor
+        self.points_Tw: torch.Tensor
+        self.obs_covTc: torch.Tensor
+        self.pts_covTw: torch.Tensor
+        self.register_buffer("points_Tc", self.pad([
+            pixel2point_NED(g.observations.data["pixel2_uv"], g.observations.data["pixel2_d"].squeeze(-1), g.images_intrinsic)
+            for g in graph_data
+        ]))
+        self.register_buffer("points_Tw", self.pad([g.points.data["pos_Tw"] for g in graph_data]))
+        self.register_buffer("obs_covTc", self.pad([g.observations.data["obs2_covTc"] for g in graph_data]))
+        self.register_buffer("pts_covTw", self.pad([g.points.data["cov_Tw"] for g in graph_data]))
+
+    def residual(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.masked(Kernels.icp_residual(pose.tensor(), self.points_Tc, self.points_Tw))
+
+    def jacobian(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.masked(Kernels.icp_jacobian(pose.tensor(), self.points_Tc))
+
+    def covariance_array(self, pose: pp.LieTensor) -> torch.Tensor:
+        return Kernels.icp_covariance(pose.tensor(), self.obs_covTc, self.pts_covTw)
+
+    def linearize(self, pose: pp.LieTensor, delta: float):
+        return Kernels.icp_linearize(pose.tensor(), self.mask, delta, self.points_Tc, self.points_Tw, self.obs_covTc, self.pts_covTw)
+
+    def robust_loss(self, pose: pp.LieTensor, delta: float) -> torch.Tensor:
+        return Kernels.icp_loss(pose.tensor(), self.mask, delta, self.points_Tc, self.points_Tw)
+
+
+class Batched_Reproj_TwoFramePGO(Batched_TwoFramePGO):
+    OBS_FIELDS  : T.ClassVar[tuple[str, ...]] = Reproj_TwoFramePGO.OBS_FIELDS
+    POINT_FIELDS: T.ClassVar[tuple[str, ...]] = Reproj_TwoFramePGO.POINT_FIELDS
+
+    def __init__(self, graph_data: T.Sequence[GraphInput], length: int | None = None) -> None:
+        super().__init__(graph_data, length)
+        assert bool((self.K[:, 0, 1] == 0).all()), "K[0, 1] non-zero is currently not supported"
+        self.pos_Tw : torch.Tensor
+        self.kp2    : torch.Tensor
+        self.cov_kp2: torch.Tensor
+        self.register_buffer("pos_Tw", self.pad([g.points.data["pos_Tw"] for g in graph_data]))
+        self.register_buffer("kp2"   , self.pad([g.observations.data["pixel2_uv"] for g in graph_data]))
+
+        uv_cov  = self.pad([g.observations.data["pixel2_uv_cov"] for g in graph_data])
+        cov_kp2 = torch.stack((uv_cov[..., 0], uv_cov[..., 2], uv_cov[..., 2], uv_cov[..., 1]), dim=-1)
+        self.register_buffer("cov_kp2", cov_kp2.unflatten(-1, (2, 2)))
+
+    def residual(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.masked(Kernels.reproj_residual(pose.tensor(), self.K, self.pos_Tw, self.kp2))
+
+    def jacobian(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.masked(Kernels.reproj_jacobian(pose.tensor(), self.K, self.pos_Tw))
+
+    def covariance_array(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.cov_kp2
+
+    def linearize(self, pose: pp.LieTensor, delta: float):
+        return Kernels.reproj_linearize(pose.tensor(), self.mask, delta, self.K, self.pos_Tw, self.kp2, self.cov_kp2)
+
+    def robust_loss(self, pose: pp.LieTensor, delta: float) -> torch.Tensor:
+        return Kernels.reproj_loss(pose.tensor(), self.mask, delta, self.K, self.pos_Tw, self.kp2)
+
+
+class Batched_ReprojDisp_TwoFramePGO(Batched_Reproj_TwoFramePGO):
+    OBS_FIELDS  : T.ClassVar[tuple[str, ...]] = ReprojDisp_TwoFramePGO.OBS_FIELDS
+
+    def __init__(self, graph_data: T.Sequence[GraphInput], length: int | None = None) -> None:
+        super().__init__(graph_data, length)
+        self.baseline     : torch.Tensor
+        self.kp2_disparity: torch.Tensor
+        self.cov          : torch.Tensor
+        self.register_buffer("baseline", torch.cat([g.baseline.reshape(-1)[:1] for g in graph_data]))
+        self.register_buffer("kp2_disparity", self.pad([g.observations.data["pixel2_disp"] for g in graph_data]))
+
+        disp_cov = self.pad([g.observations.data["pixel2_disp_cov"] for g in graph_data])
+        cov = torch.zeros((*disp_cov.shape[:2], 3, 3), dtype=self.cov_kp2.dtype)
+        cov[..., :2, :2] = self.cov_kp2
+        cov[..., 2, 2]   = disp_cov.squeeze(-1)
+        self.register_buffer("cov", cov)
+
+    def residual(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.masked(Kernels.disp_residual(pose.tensor(), self.K, self.baseline, self.pos_Tw, self.kp2, self.kp2_disparity))
+
+    def jacobian(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.masked(Kernels.disp_jacobian(pose.tensor(), self.K, self.baseline, self.pos_Tw))
+
+    def covariance_array(self, pose: pp.LieTensor) -> torch.Tensor:
+        return self.cov
+
+    def linearize(self, pose: pp.LieTensor, delta: float):
+        return Kernels.disp_linearize(pose.tensor(), self.mask, delta, self.K, self.baseline, self.pos_Tw, self.kp2,
+                                      self.kp2_disparity, self.cov)
+
+    def robust_loss(self, pose: pp.LieTensor, delta: float) -> torch.Tensor:
+        return Kernels.disp_loss(pose.tensor(), self.mask, delta, self.K, self.baseline, self.pos_Tw, self.kp2,
+                                 self.kp2_disparity)
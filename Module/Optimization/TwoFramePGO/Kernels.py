@@ -0,0 +1,175 @@
+"""
+Residual, jacobian and normal equation of batched two-frame graphs (see `Batched_TwoFramePGO`) written with plain
+tensor operations only (poses are Bx7 tensors of [tx, ty, tz, qx, qy, qz, qw], as pypose SE3), so the linearization
+of a whole LM step can be compiled by `torch.compile` through `OnCallCompiler`.
+
+All jacobians are w.r.t. the left perturbation of pose (translation first), the same convention as `LieTensor.add_`.
+"""
+import torch
+from Utility.Extensions import OnCallCompiler
+
+
+def quat_matrix(q: torch.Tensor) -> torch.Tensor:
+    x, y, z, w = q.unbind(-1)
+    return torch.stack((
+        1 - 2 * (y * y + z * z), 2 * (x * y - z * w)    , 2 * (x * z + y * w),
+        2 * (x * y + z * w)    , 1 - 2 * (x * x + z * z), 2 * (y * z - x * w),
+        2 * (x * z - y * w)    , 2 * (y * z + x * w)    , 1 - 2 * (x * x + y * y),
+    ), dim=-1).unflatten(-1, (3, 3))
+
+
+def skew(v: torch.Tensor) -> torch.Tensor:
+    x, y, z = v.unbind(-1)
+    zero    = torch.zeros_like(x)
+    return torch.stack((
+        zero, -z  , y   ,
+        z   , zero, -x  ,
+        -y  , x   , zero,
+    ), dim=-1).unflatten(-1, (3, 3))
+
+
+def rotation(pose: torch.Tensor) -> torch.Tensor:
+    """Bx1x3x3 rotation of Bx7 poses, broadcastable over N."""
+    return quat_matrix(pose[:, 3:]).unsqueeze(1)
+
+
+def transform(pose: torch.Tensor, points: torch.Tensor) -> torch.Tensor:
+    return (rotation(pose) @ points.unsqueeze(-1)).squeeze(-1) + pose[:, None, :3]
+
+
+def transform_inv(pose: torch.Tensor, points: torch.Tensor) -> torch.Tensor:
+    return (rotation(pose).mT @ (points - pose[:, None, :3]).unsqueeze(-1)).squeeze(-1)
+
+
+### ICP
+def icp_residual(pose: torch.Tensor, points_Tc: torch.Tensor, points_Tw: torch.Tensor) -> torch.Tensor:
+    return transform(pose, points_Tc) - points_Tw
+
+
+def icp_jacobian(pose: torch.Tensor, points_Tc: torch.Tensor) -> torch.Tensor:
+    I3 = torch.eye(3, dtype=points_Tc.dtype, device=points_Tc.device).expand(*points_Tc.shape[:2], 3, 3)
+    return torch.cat((I3, -skew(transform(pose, points_Tc))), dim=-1)
+
+
+def icp_covariance(pose: torch.Tensor, obs_covTc: torch.Tensor, pts_covTw: torch.Tensor) -> torch.Tensor:
+    R = rotation(pose)
+    return (R @ obs_covTc @ R.mT) + pts_covTw
+
+
+### Reprojection (and disparity)
+def project(pos_Tc: torch.Tensor, K: torch.Tensor) -> torch.Tensor:
+    x, y, z = pos_Tc.unbind(-1)
+    K       = K.unsqueeze(1)
+    return torch.stack((K[..., 0, 0] * y / x + K[..., 0, 2], K[..., 1, 1] * z / x + K[..., 1, 2]), dim=-1)
+
+
+def project_jacobian(pos_Tc: torch.Tensor, K: torch.Tensor) -> torch.Tensor:
+    """BxNx2x3 jacobian of projection w.r.t. points under camera frame."""
+    x, y, z  = pos_Tc.unbind(-1)
+    fx, fy   = K[:, None, 0, 0], K[:, None, 1, 1]
+    zero     = torch.zeros_like(x)
+    return torch.stack((
+        -fx * y / x.square(), fx / x, zero,
+        -fy * z / x.square(), zero  , fy / x,
+    ), dim=-1).unflatten(-1, (2, 3))
+
+
+def camera_jacobian(pose: torch.Tensor, pos_Tw: torch.Tensor) -> torch.Tensor:
+    """BxNx3x6 jacobian of points under camera frame (T⁻¹ p) w.r.t. the pose."""
+    R_T = rotation(pose).mT
+    return torch.cat((-R_T.expand(*pos_Tw.shape[:2], 3, 3), R_T @ skew(pos_Tw)), dim=-1)
+
+
+def reproj_residual(pose: torch.Tensor, K: torch.Tensor, pos_Tw: torch.Tensor, kp2: torch.Tensor) -> torch.Tensor:
+    return project(transform_inv(pose, pos_Tw), K) - kp2
+
+
+def reproj_jacobian(pose: torch.Tensor, K: torch.Tensor, pos_Tw: torch.Tensor) -> torch.Tensor:
+    return project_jacobian(transform_inv(pose, pos_Tw), K) @ camera_jacobian(pose, pos_Tw)
+
+
+def disp_residual(pose: torch.Tensor, K: torch.Tensor, baseline: torch.Tensor, pos_Tw: torch.Tensor,
+                  kp2: torch.Tensor, kp2_disparity: torch.Tensor) -> torch.Tensor:
+    pos_Tc    = transform_inv(pose, pos_Tw)
+    fx_bl     = (K[:, 0, 0] * baseline)[:, None, None]
+    depth_err = pos_Tc[..., 0:1].reciprocal() * fx_bl - kp2_disparity
+    return torch.cat((project(pos_Tc, K) - kp2, depth_err), dim=-1)
+
+
+def disp_jacobian(pose: torch.Tensor, K: torch.Tensor, baseline: torch.Tensor, pos_Tw: torch.Tensor) -> torch.Tensor:
+    pos_Tc = transform_inv(pose, pos_Tw)
+    J_Tc   = camera_jacobian(pose, pos_Tw)
+    fx_bl  = (K[:, 0, 0] * baseline)[:, None]
+    J_disp = (-fx_bl / pos_Tc[..., 0].square())[..., None, None] * J_Tc[..., 0:1, :]
+    return torch.cat((project_jacobian(pos_Tc, K) @ J_Tc, J_disp), dim=-2)
+
+
+### Huber-robustified normal equation
+def huber_loss(R: torch.Tensor, mask: torch.Tensor, delta: float) -> torch.Tensor:
+    x   = R.square().sum(-1)
+    rho = torch.where(x > delta ** 2, 2 * delta * x.clamp_min(delta ** 2).sqrt() - delta ** 2, x)
+    return torch.where(mask, rho, 0.).sum(-1)
+
+
+def huber_normal_equation(R: torch.Tensor, J: torch.Tensor, cov: torch.Tensor, mask: torch.Tensor, delta: float
+                          ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Returns (JᵀWJ, -JᵀWR, JᵀJ, JᵀR) with FastTriggs correction of Huber kernel, reduced over residual blocks.
+    """
+    R     = torch.where(mask[..., None], R, 0.)
+    J     = torch.where(mask[..., None, None], J, 0.)
+    W     = torch.where(mask[..., None, None], torch.linalg.pinv(cov), 0.)
+    x     = R.square().sum(-1)
+    scale = torch.where(x > delta ** 2, (delta / x.clamp_min(delta ** 2).sqrt()).sqrt(), 1.)
+    R, J  = scale[..., None] * R, scale[..., None, None] * J
+    return (
+        torch.einsum("bnip,bnij,bnjq->bpq", J, W, J),
+        -torch.einsum("bnip,bnij,bnj->bp", J, W, R).unsqueeze(-1),
+        torch.einsum("bnip,bniq->bpq", J, J),
+        torch.einsum("bnip,bni->bp", J, R).unsqueeze(-1),
+    )
+
+
+# Compiled linearization and loss, one kernel per graph type. Shapes are bucketed by the graphs (see
+# `Batched_TwoFramePGO.bucket`), so only a few variants are ever compiled.
+@OnCallCompiler()
+def icp_linearize(pose: torch.Tensor, mask: torch.Tensor, delta: float, points_Tc: torch.Tensor,
+                  points_Tw: torch.Tensor, obs_covTc: torch.Tensor, pts_covTw: torch.Tensor):
+    return huber_normal_equation(
+        icp_residual(pose, points_Tc, points_Tw), icp_jacobian(pose, points_Tc),
+        icp_covariance(pose, obs_covTc, pts_covTw), mask, delta
+    )
+
+
+@OnCallCompiler()
+def icp_loss(pose: torch.Tensor, mask: torch.Tensor, delta: float, points_Tc: torch.Tensor, points_Tw: torch.Tensor):
+    return huber_loss(icp_residual(pose, points_Tc, points_Tw), mask, delta)
+
+
+@OnCallCompiler()
+def reproj_linearize(pose: torch.Tensor, mask: torch.Tensor, delta: float, K: torch.Tensor, pos_Tw: torch.Tensor,
+                     kp2: torch.Tensor, cov_kp2: torch.Tensor):
+    return huber_normal_equation(
+        reproj_residual(pose, K, pos_Tw, kp2), reproj_jacobian(pose, K, pos_Tw), cov_kp2, mask, delta
+    )
+
+
+@OnCallCompiler()
+def reproj_loss(pose: torch.Tensor, mask: torch.Tensor, delta: float, K: torch.Tensor, pos_Tw: torch.Tensor,
+                kp2: torch.Tensor):
+    return huber_loss(reproj_residual(pose, K, pos_Tw, kp2), mask, delta)
+
+
+@OnCallCompiler()
+def disp_linearize(pose: torch.Tensor, mask: torch.Tensor, delta: float, K: torch.Tensor, baseline: torch.Tensor,
+                   pos_Tw: torch.Tensor, kp2: torch.Tensor, kp2_disparity: torch.Tensor, cov: torch.Tensor):
+    return huber_normal_equation(
+        disp_residual(pose, K, baseline, pos_Tw, kp2, kp2_disparity), disp_jacobian(pose, K, baseline, pos_Tw),
+        cov, mask, delta
+    )
+
+
+@OnCallCompiler()
+def disp_loss(pose: torch.Tensor, mask: torch.Tensor, delta: float, K: torch.Tensor, baseline: torch.Tensor,
+              pos_Tw: torch.Tensor, kp2: torch.Tensor, kp2_disparity: torch.Tensor):
+    return huber_loss(disp_residual(pose, K, baseline, pos_Tw, kp2, kp2_disparity), mask, delta)
@@ -1,4 +1,6 @@
+import time
 import torch
+import typing as T
 from types import SimpleNamespace
 import pypose as pp
 
@@ -11,13 +13,15 @@ from pypose.optim.strategy import TrustRegion
 
 from Module.Map import VisualMap
 from Utility.Timer import Timer
+from Utility.PrettyPrint import Logger
 from Utility.Math  import NormalizeQuat
 
-from ..Interface import IOptimizer
-from ..PyposeOptimizers import LM_analytic, AnalyticModule, FactorGraph
+from ..Interface import IOptimizer, ConvergenceRecord
+from ..PyposeOptimizers import LM_analytic, LM_batched, BatchedLMResult, AnalyticModule, FactorGraph
 from .Graphs import GraphInput, GraphOutput
 from .Graphs import ICP_TwoframePGO, Reproj_TwoFramePGO, ReprojDisp_TwoFramePGO
 from .Graphs import Analytic_ICP_TwoframePGO, Analytic_Reproj_TwoFramePGO, Analytic_ReprojDisp_TwoFramePGO
+from .Graphs import Batched_TwoFramePGO, Batched_ICP_TwoframePGO, Batched_Reproj_TwoFramePGO, Batched_ReprojDisp_TwoFramePGO
 
 
 class TwoFrame_PGO(IOptimizer[GraphInput, dict, GraphOutput]):
@@ -25,9 +29,10 @@ class TwoFrame_PGO(IOptimizer[GraphInput, dict, GraphOutput]):
     def get_graph_data(self, global_map: VisualMap, frame_idx: torch.Tensor,
                        observations: torch.Tensor | None = None, edges: torch.Tensor | None = None) -> GraphInput:
         frame2opt = global_map.frames[frame_idx]
+        graph_cls = self.graph_class(self.config)
 
-        obs = global_map.get_frame2match(frame2opt)
-        pts = global_map.get_match2point(obs)
+        obs = global_map.get_frame2match(frame2opt, graph_cls.OBS_FIELDS)
+        pts = global_map.get_match2point(obs, graph_cls.POINT_FIELDS)
         im_intrinsics = frame2opt.data["K"][0]
 
         lengths = global_map.frame2match.ranges[frame2opt.index, :, 1].flatten()
@@ -35,6 +40,8 @@ class TwoFrame_PGO(IOptimizer[GraphInput, dict, GraphOutput]):
         edges_idx = torch.repeat_interleave(torch.arange(lengths.size(0)), lengths.long())
         init_motion = pp.SE3(frame2opt.data["pose"])
         baseline = frame2opt.data["baseline"]
+        # Rejected observations are reported by map index, which is only valid until the map is compacted.
+        self.map_layout = global_map.layout
         return GraphInput(frame_idx, frame_idx - 1, init_motion, baseline, obs, pts, im_intrinsics, edges_idx, "cpu")
 
     @classmethod
@@ -43,28 +50,57 @@ class TwoFrame_PGO(IOptimizer[GraphInput, dict, GraphOutput]):
             "graph_type": lambda s: s in {"icp", "reproj", "disp"},
             "device": lambda v: isinstance(v, str) and (v == "cpu" or "cuda" in v),
             "vectorize": lambda b: isinstance(b, bool),
-            "parallel": lambda b: isinstance(b, bool),
+            "parallel": lambda b: isinstance(b, bool) or b in {"process", "thread"},
             "autodiff": lambda b: isinstance(b, bool)
+        }, optional_spec={
+            "num_threads": lambda n: isinstance(n, int) and n > 0,
+            "fused"      : lambda b: isinstance(b, bool),
+            "compile"    : lambda b: isinstance(b, bool),
+            "warm_start" : lambda b: isinstance(b, bool),
+            "time_budget": lambda v: isinstance(v, (int, float)) and v > 0,
+            "grad_tol"   : lambda v: isinstance(v, float) and 0. < v < 1.,
+            "outlier_chi2": lambda v: isinstance(v, (int, float)) and v > 0,
         })
+        assert config is not None
+        # Autodiff graphs are solved by pypose's LM, which has no gradient-norm termination.
+        if getattr(config, "grad_tol", None) is not None and config.autodiff and not getattr(config, "compile", False):
+            Logger.write("error", "grad_tol requires analytic graphs (autodiff: false) or compile: true")
+            raise ValueError("grad_tol requires analytic graphs (autodiff: false) or compile: true")
 
     @staticmethod
-    def init_context(config) -> dict:
+    def graph_class(config) -> type[ICP_TwoframePGO] | type[Reproj_TwoFramePGO]:
         match (config.autodiff, config.graph_type):
             case (True, "icp"):
-                PoseGraphClass = ICP_TwoframePGO
+                return ICP_TwoframePGO
             case (True, "reproj"):
-                PoseGraphClass = Reproj_TwoFramePGO
+                return Reproj_TwoFramePGO
             case (True, "disp"):
-                PoseGraphClass = ReprojDisp_TwoFramePGO
+                return ReprojDisp_TwoFramePGO
             case (False, "icp"):
-                PoseGraphClass = Analytic_ICP_TwoframePGO
+                return Analytic_ICP_TwoframePGO
             case (False, "reproj"):
-                PoseGraphClass = Analytic_Reproj_TwoFramePGO
+                return Analytic_Reproj_TwoFramePGO
             case (False, "disp"):
-                PoseGraphClass = Analytic_ReprojDisp_TwoFramePGO
+                return Analytic_ReprojDisp_TwoFramePGO
+            case _:
+                raise ValueError(f"Graph type of {config.graph_type} is not supported")
+
+    @staticmethod
+    def batched_graph_class(config) -> type[Batched_TwoFramePGO]:
+        match config.graph_type:
+            case "icp":
+                return Batched_ICP_TwoframePGO
+            case "reproj":
+                return Batched_Reproj_TwoFramePGO
+            case "disp":
+                return Batched_ReprojDisp_TwoFramePGO
             case _:
                 raise ValueError(f"Graph type of {config.graph_type} is not supported")
 
+    @staticmethod
+    def init_context(config) -> dict:
+        PoseGraphClass = TwoFrame_PGO.graph_class(config)
+
         return {
             "optimizer_cfg": {
                 "kernel"   : Huber(delta=0.1),
@@ -74,38 +110,144 @@ class TwoFrame_PGO(IOptimizer[GraphInput, dict, GraphOutput]):
                 "vectorize": config.vectorize,
             },
             "device": config.device,
+            # Accumulate normal equation of analytic graphs block-wise, this many residual blocks at a time.
+            "fused_chunk": 4096 if getattr(config, "fused", False) else None,
+            # Solve with compiled linearization kernels of the batched graphs (see batch_optimize).
+            "compiled"   : getattr(config, "compile", False),
+            # Termination - start from damping of previous converged solve, stop on wall-clock budget (ms) or
+            # when gradient norm fell below grad_tol times its initial value (analytic and compiled solves only).
+            "warm_start" : getattr(config, "warm_start", False),
+            "time_budget": getattr(config, "time_budget", None),
+            "grad_tol"   : getattr(config, "grad_tol", None),
+            "damping"    : None,
+            # Observations with squared Mahalanobis residual above this at the optimum are dropped from the map.
+            "outlier_chi2": getattr(config, "outlier_chi2", None),
 
-            "pose_graph_class": PoseGraphClass
+            "pose_graph_class": PoseGraphClass,
+            "batched_graph_class": TwoFrame_PGO.batched_graph_class(config),
         }
 
     @staticmethod
     def _optimize(context: dict, graph_data: GraphInput) -> tuple[dict, GraphOutput]:
+        if context.get("compiled", False):
+            context, (result, ), info = TwoFrame_PGO.batch_optimize(context, [graph_data])
+            if context.get("warm_start", False) and bool(info.converged[0]):
+                context["damping"] = info.damping[0].item()
+            return context, result
+
         with Timer.CPUTimingContext("TwoframePGO"), Timer.GPUTimingContext("TwoframePGO", torch.cuda.current_stream()):
             graph: FactorGraph = context["pose_graph_class"](graph_data)\
                 .to(device=torch.device(context["device"]), dtype=torch.double)
             assert isinstance(graph, FactorGraph)
 
+            fused = isinstance(graph, AnalyticModule) and context.get("fused_chunk") is not None
             if isinstance(graph, AnalyticModule):
-                optimizer = LM_analytic(graph, min=1e-6, **context["optimizer_cfg"])
+                optimizer = LM_analytic(graph, min=1e-6, chunk=context.get("fused_chunk"), grad_tol=context.get("grad_tol"),
+                                        **context["optimizer_cfg"])
             else:
                 optimizer = LM(graph, min=1e-6, **context["optimizer_cfg"])
+            warm_start = context.get("warm_start", False)
+            if warm_start and context.get("damping") is not None:
+                for pg in optimizer.param_groups:
+                    pg["damping"] = context["damping"]
+                    if "radius" in pg: pg["radius"] = 1. / context["damping"]
 
-            scheduler = StopOnPlateau(optimizer, steps=10, patience=2, decreasing=1e-5, verbose=False)
+            scheduler   = StopOnPlateau(optimizer, steps=10, patience=2, decreasing=1e-5, verbose=False)
+            time_budget = context.get("time_budget")
+            start, num_step, stop = time.perf_counter(), 0, None
+            history: list[float] = []
 
             while scheduler.continual():
-                weight = torch.block_diag(*(
-                    torch.pinverse(graph.covariance_array().to(context["device"]).double())
-                ))
+                weight = torch.pinverse(graph.covariance_array().to(context["device"]).double())
+                # Fused path takes the information matrix of each residual block, instead of the block diagonal.
+                if not fused: weight = torch.block_diag(*weight)
+                last = getattr(optimizer, "loss", None)
                 loss = optimizer.step(input=(), weight=weight)
+                # Gradient-norm termination returns without taking the step.
+                if getattr(optimizer, "converged", False):
+                    stop = "converged"
+                    break
                 scheduler.step(loss)
+                num_step += 1
+                if last is None: history.append(float(optimizer.last))
+                history.append(float(loss))
+                
+                # No step is started if it is expected to exceed the budget.
+                elapsed = (time.perf_counter() - start) * 1e3
+                if time_budget is not None and elapsed * (num_step + 1) / num_step > time_budget:
+                    stop = "time_budget"
+                    break
+            # Converged if the scheduler stopped on plateau (loss decreased less than `decreasing` for `patience`
+            # consecutive steps) or before the step cap (e.g. every trial step rejected).
+            if stop is None:
+                plateau = scheduler.patience_count >= scheduler.patience
+                stop    = "converged" if (plateau or num_step < 10) else "step_cap"
+
+            damping = float(optimizer.param_groups[0]["damping"])
+            if warm_start and stop == "converged": context["damping"] = damping
+
+            result = graph.write_back()
+            if context.get("outlier_chi2") is not None:
+                with torch.no_grad():
+                    chi2 = TwoFrame_PGO.mahalanobis(graph().double(), graph.covariance_array().double())
+                result.outlier = graph_data.observations.index[(chi2 > context["outlier_chi2"]).cpu()]
+            result.telemetry = ConvergenceRecord(
+                frame_idx=int(graph_data.frame_idx.flatten()[0]), num_step=num_step, loss=history, damping=damping,
+                time_ms=(time.perf_counter() - start) * 1e3, stop=stop
+            )
+        return context, result
 
-        return context, graph.write_back()
+    @staticmethod
+    def batch_optimize(context: dict, graph_data: T.Sequence[GraphInput]) -> tuple[dict, list[GraphOutput], BatchedLMResult]:
+        """
+        Solve independent two-frame problems (e.g. from multiple sequences or Monte Carlo trials) at once, with
+        per-problem damping and termination. Each problem is solved as `_optimize` would (with analytic jacobian),
+        results are in the order of `graph_data`.
+        
+        With compiled context, observations are padded to a power-of-two bucket so the compiled kernels are reused
+        across calls instead of being recompiled for every problem size.
+        """
+        compiled = context.get("compiled", False)
+        with Timer.CPUTimingContext("TwoframePGO.batch"):
+            length = Batched_TwoFramePGO.bucket(max(g.edges_index.size(0) for g in graph_data)) if compiled else None
+            graph: Batched_TwoFramePGO = context["batched_graph_class"](graph_data, length)\
+                .to(device=torch.device(context["device"]), dtype=torch.double)
+            optimizer = LM_batched(graph, kernel=context["optimizer_cfg"]["kernel"], radius=1e3, min=1e-6, compiled=compiled)
+            damping   = context.get("damping") if context.get("warm_start", False) else None
+            result    = optimizer.optimize(steps=10, patience=2, decreasing=1e-5, damping=damping,
+                                           time_budget=context.get("time_budget"), grad_tol=context.get("grad_tol"))
+            outputs   = graph.write_back()
+            if context.get("outlier_chi2") is not None:
+                pose    = pp.SE3(graph.pose2opt.detach())
+                chi2    = TwoFrame_PGO.mahalanobis(graph.residual(pose), graph.covariance_array(pose))
+                outlier = (graph.mask & (chi2 > context["outlier_chi2"])).cpu()
+                for idx, (data, output) in enumerate(zip(graph_data, outputs)):
+                    output.outlier = data.observations.index[outlier[idx, :data.edges_index.size(0)]]
+
+        for idx, (data, output) in enumerate(zip(graph_data, outputs)):
+            num_step = int(result.num_step[idx])
+            stop     = "converged" if bool(result.converged[idx]) else ("step_cap" if num_step >= 10 else "time_budget")
+            output.telemetry = ConvergenceRecord(
+                frame_idx=int(data.frame_idx.flatten()[0]), num_step=num_step, loss=result.history[idx, :num_step + 1].tolist(),
+                damping=float(result.damping[idx]), time_ms=result.time_ms, stop=stop
+            )
+        return context, outputs, result
+
+    @staticmethod
+    def mahalanobis(R: torch.Tensor, cov: torch.Tensor) -> torch.Tensor:
+        """
+        Squared Mahalanobis norm of each residual block (R is ...xm, cov is ...xmxm).
+        """
+        return (R.unsqueeze(-2) @ torch.linalg.pinv(cov) @ R.unsqueeze(-1)).squeeze(-1).squeeze(-1)
 
     def write_graph_data(self, result: GraphOutput | None, global_map: VisualMap) -> None:
         if result is None: return
         
         to_pose     = pp.SE3(result.motion[0].data.double().cpu())
-        global_map.frames.data["pose"][result.frame_idx] = to_pose.float()
+        global_map.frames.write_column("pose", result.frame_idx, to_pose.float())
+        # Skipped if the map is compacted while the job is running (index of observations are stale).
+        if result.outlier is not None and result.outlier.numel() > 0 and getattr(self, "map_layout", None) == global_map.layout:
+            global_map.drop_matches(result.outlier)
 
 
 class Local_TwoFrame_PGO(TwoFrame_PGO):
@@ -128,6 +270,13 @@ class Local_TwoFrame_PGO(TwoFrame_PGO):
         T_o2w = pp.SE3(global_map.frames.data["pose"][self.T_o2w_idx])
         super().write_graph_data(self.optim_to_world(result, T_o2w), global_map)
 
+    def state_dict(self) -> dict:
+        return super().state_dict() | {"T_o2w_idx": getattr(self, "T_o2w_idx", None)}
+    
+    def load_state_dict(self, state: dict) -> None:
+        super().load_state_dict(state)
+        if state["T_o2w_idx"] is not None: self.T_o2w_idx = state["T_o2w_idx"]
+
     def world_to_optim(self, data: GraphInput, T_w2o: pp.LieTensor) -> GraphInput:
         """Transform the optimization graph data into local reference frame (i.e. the reference frame is the pose of previous key frame)
         """
@@ -129,10 +129,11 @@ class SimpleDepthFilter(IObservationFilter):
 
 class LikelyFrontOfCamFilter(IObservationFilter):
     @property
-    def required_keys(self) -> set[LiteralString]: return {"pixel1_d", "pixel1_d_cov", "pixel2_d", "pixel2_d_cov"}
+    def required_keys(self) -> set[LiteralString]: return {"pixel1_d", "pixel2_d"}
     
     def filter(self, values: TensorBundle, device: torch.device) -> torch.Tensor:
-        if (values.data["pixel1_d_cov"] == -1).any(): 
+        # Depth covariance is an optional column, absent when depth estimator does not provide uncertainty.
+        if ("pixel1_d_cov" not in values.data) or ("pixel2_d_cov" not in values.data) or (values.data["pixel1_d_cov"] == -1).any(): 
             # This means we don't have covariance estimation, 
             # it's just a placeholder.
             return torch.ones((len(values),), dtype=torch.bool)
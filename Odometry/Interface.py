@@ -1,8 +1,13 @@
+import os
+import json
 import torch
+import random
 import traceback
 import numpy as np
 import pypose as pp
 
+from pathlib import Path
+from types import SimpleNamespace
 from typing import Callable, Generic
 from typing_extensions import Self
 from abc import ABC, abstractmethod
@@ -11,38 +16,85 @@ from Utility.Sandbox import Sandbox
 from DataLoader import SequenceBase, T_Data
 from Module.Map import VisualMap
 from Utility.PrettyPrint import ColoredTqdm, Logger
+from Utility.Timer import Timer
+from .ResultWriter import IncrementalResultWriter
+from .ProfileController import ProfileController
 
-from torch.profiler import profile, ProfilerActivity
 
 
 class IOdometry(ABC, Generic[T_Data]):
-    def __init__(self, profile: bool = False) -> None:
+    def __init__(self, profile: bool | SimpleNamespace = False, incremental_write: int | None = None,
+                 memory_log: int | None = None, compact_every: int | None = None) -> None:
         super().__init__()
         self.terminated = False
+        # Profiling windows, see ProfileController.from_config
         self.profile    = profile
-        self.profile_save_path = "trace_parallel.json"
+        
+        # If set, stream results to disk every `incremental_write` frames (see IncrementalResultWriter)
+        self.incremental_write = incremental_write
+        # If set, log memory usage of the map every `memory_log` frames
+        self.memory_log = memory_log
+        # If set, remove unreferenced rows of the map every `compact_every` frames (see VisualMap.compact)
+        self.compact_every = compact_every
     
-    def receive_frames(self, sequence: SequenceBase[T_Data], saveto: Sandbox, on_frame_finished: None | Callable[[T_Data, Self, ColoredTqdm], None]=None):
+    def receive_frames(self, sequence: SequenceBase[T_Data], saveto: Sandbox, on_frame_finished: None | Callable[[T_Data, Self, ColoredTqdm], None]=None,
+                       checkpoint_every: int | None = None, resume: bool = False):
+        """
+        Run odometry on all frames of sequence and write results to `saveto`.
+        
+        * `checkpoint_every` - if set, save full odometry state to `saveto/checkpoint.pth` every N frames.
+        * `resume`           - continue from `saveto/checkpoint.pth` instead of starting from the first frame.
+        """
+        writer   = None if self.incremental_write is None else IncrementalResultWriter(saveto, self.incremental_write)
+        profiler = ProfileController.from_config(self.profile, saveto.path("profile"))
         try:
             reference_poses, reference_time = [], []
-            pb = ColoredTqdm(sequence)
+            start_index = 0
+            if resume:
+                checkpoint  = self.load_checkpoint(saveto.path("checkpoint.pth"))
+                start_index = checkpoint["next_index"]
+                reference_poses, reference_time = checkpoint["reference_poses"], checkpoint["reference_time"]
+                if writer is not None: writer.load_state_dict(checkpoint["writer"])
+                Logger.write("info", f"Resume from checkpoint at frame #{start_index}")
+            
+            # Length of sequence is known, so frame store can be allocated once instead of growing.
+            self.get_map().reserve_frames(len(sequence))
+            pb = ColoredTqdm(range(start_index, len(sequence)), initial=start_index, total=len(sequence))
             frame: T_Data
-            for frame in pb:
-                if self.profile and frame.frame_idx == 2:
-                    with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA], with_stack=True, with_flops=True) as prof:
-                        self.run(frame)
-                    prof.export_chrome_trace(self.profile_save_path)
-                else:
-                    self.run(frame)
+            for index in pb:
+                with Timer.CPUTimingContext("DataLoading"):
+                    frame = sequence[index]
+                if profiler is not None: profiler.before_frame(frame.frame_idx)
+                self.run(frame)
+                if profiler is not None: profiler.after_frame(frame.frame_idx)
                 
                 if frame.gt_pose is not None:
                     reference_poses.append(frame.gt_pose)
                     reference_time.append(frame.time_ns[0])
                 
                 if on_frame_finished is not None: on_frame_finished(frame, self, pb)
+                if writer is not None: writer.update(self.get_map(), self.settled_frames())
+                if self.compact_every is not None and (index + 1) % self.compact_every == 0:
+                    # Capacity is kept during the run since following frames will fill it again.
+                    self.get_map().compact(frozen=None if writer is None else writer.frozen_rows(), shrink=False)
+                if self.memory_log is not None and (index + 1) % self.memory_log == 0:
+                    Logger.write("info", f"Frame #{frame.frame_idx} {self.get_map().memory_summary()}")
+                
+                if checkpoint_every is not None and (index + 1) % checkpoint_every == 0 and (index + 1) < len(sequence):
+                    self.save_checkpoint(saveto.path("checkpoint.pth"), {
+                        "next_index"     : index + 1,
+                        "reference_poses": reference_poses,
+                        "reference_time" : reference_time,
+                        "writer"         : None if writer is None else writer.state_dict(),
+                    })
             
             self.terminate()
+            if profiler is not None: profiler.finalize()
             global_map = self.get_map()
+            # Statistics are taken before the map is compacted and releases its capacity slack for serialization.
+            usage      = global_map.memory_usage()
+            realloc    = global_map.realloc_stats()
+            global_map.compact(frozen=None if writer is None else writer.frozen_rows())
             
             sensor_poses = pp.SE3(global_map.frames.data["pose"].tensor)
             T_BS         = pp.SE3(global_map.frames.data["T_BS"].tensor)
@@ -50,7 +102,20 @@ class IOdometry(ABC, Generic[T_Data]):
             time_ns   : np.ndarray = global_map.frames.data["time_ns"].tensor.cpu().numpy()[:, np.newaxis]
             
             np.save(saveto.path("poses.npy"), np.concatenate([time_ns, body_poses], axis=-1))
-            np.savez_compressed(saveto.path("tensor_map.npz"), **global_map.serialize())
+            with saveto.open("memory_usage.json", "w") as f:
+                json.dump({
+                    store: {
+                        field: {"used": used, "allocated": alloc, "num_realloc": realloc[store][field][0],
+                                "bytes_copied": realloc[store][field][1], "peak_allocated": realloc[store][field][2]}
+                        for field, (used, alloc) in fields.items()
+                    }
+                    for store, fields in usage.items()
+                }, f, indent=2)
+            self.write_telemetry(saveto)
+            if writer is None:
+                np.savez_compressed(saveto.path("tensor_map.npz"), **global_map.serialize())
+            else:
+                writer.finalize(global_map)
             
             if len(reference_poses) > 1:    # At least two poses for a non-trivial trajectory
                 ref_body_poses: np.ndarray = torch.cat(reference_poses, dim=0).numpy()
@@ -61,10 +126,12 @@ class IOdometry(ABC, Generic[T_Data]):
             
         except KeyboardInterrupt as e:
             self.terminate()
+            if writer is not None: writer.close()
             Logger.write("fatal", f"Experiment at {saveto.folder} is interrupted.")
             raise e
         except Exception as e:
             self.terminate()
+            if writer is not None: writer.close()
             Logger.show_exception()
             Logger.write("fatal", f"Failed to execute experiment at {saveto.folder}.")
         
@@ -82,6 +149,55 @@ class IOdometry(ABC, Generic[T_Data]):
         """
         ...
 
+    def state_dict(self) -> dict:
+        """
+        Full internal state of the odometry system, used for checkpointing (see `receive_frames`).
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support checkpointing.")
+    
+    def load_state_dict(self, state: dict) -> None:
+        raise NotImplementedError(f"{self.__class__.__name__} does not support checkpointing.")
+    
+    def save_checkpoint(self, path: Path, extra: dict) -> None:
+        checkpoint = extra | {
+            "odometry": self.state_dict(),
+            "rng"     : {
+                "torch" : torch.get_rng_state(),
+                "cuda"  : torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                "numpy" : np.random.get_state(),
+                "python": random.getstate(),
+            }
+        }
+        # Write to a temporary file first so a preempted job never leaves a corrupted checkpoint.
+        temp_path = path.with_name("tmp_" + path.name)
+        torch.save(checkpoint, temp_path)
+        os.replace(temp_path, path)
+    
+    def load_checkpoint(self, path: Path) -> dict:
+        if not path.exists():
+            raise FileNotFoundError(f"Unable to resume - no checkpoint at {path}")
+        checkpoint = torch.load(path, weights_only=False)
+        self.load_state_dict(checkpoint["odometry"])
+        
+        torch.set_rng_state(checkpoint["rng"]["torch"])
+        if checkpoint["rng"]["cuda"] is not None: torch.cuda.set_rng_state_all(checkpoint["rng"]["cuda"])
+        np.random.set_state(checkpoint["rng"]["numpy"])
+        random.setstate(checkpoint["rng"]["python"])
+        return checkpoint
+    
+    def settled_frames(self) -> int:
+        """
+        Number of leading frames in the map whose pose will not be changed by `run` anymore (post-processing
+        on `terminate` may still change them). By default, all frames except the latest one.
+        """
+        return len(self.get_map().frames) - 1
+
+    def write_telemetry(self, saveto: Sandbox) -> None:
+        """
+        Write diagnostics collected during the run (e.g. optimizer convergence) to `saveto`. No-op by default.
+        """
+        return
+
     def terminate(self) -> None: 
         """
         You can define additional operations on terminate. For instance, smoothing trajectory / interpolate bad frames etc.
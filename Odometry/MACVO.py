@@ -1,3 +1,4 @@
+import json
 import torch
 import pypose as pp
 import typing as T
@@ -12,9 +13,10 @@ from DataLoader import StereoFrame
 from Module.Map import VisualMap, FrameNode, MatchObs, PointNode
 from Utility.Point import filterPointsInRange, pixel2point_NED
 from Utility.PrettyPrint import Logger, GlobalConsole
+from Utility.Sandbox import Sandbox
 from Utility.Timer import Timer
 from Utility.Visualize import fig_plt
-from Utility.Extensions import ConfigTestable
+from Utility.Extensions import ConfigTestable, growth_from_config
 
 from .Interface import IOdometry
 
@@ -38,13 +40,26 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         post_process    : Module.IMapProcessor,
         kf_selector     : Module.IKeyframeSelector[T_SensorFrame],
         optimizer       : Module.IOptimizer,
+        spatial_index   : float | None = None,
+        map_voxel_size  : float | None = None,
+        incremental_write: int | None = None,
+        memory_log      : int | None = None,
+        compact_every   : int | None = None,
+        growth          : SimpleNamespace | None = None,
+        packed_cov      : str | None = None,
+        shared_memory   : str | None = None,
         **_excessive_args,
     ) -> None:
-        super().__init__(profile=profile)
+        super().__init__(profile=profile, incremental_write=incremental_write, memory_log=memory_log,
+                         compact_every=compact_every)
         if len(_excessive_args) > 0:
             Logger.write("warn", f"Receive excessive arguments for __init__ {_excessive_args}, update/clean up your config!")
         
-        self.graph = VisualMap()
+        self.graph = VisualMap(None if growth is None else growth_from_config(growth))
+        if map_voxel_size is not None: self.graph.enable_map_fusion(map_voxel_size)
+        if spatial_index is not None: self.graph.enable_spatial_index(spatial_index)
+        if packed_cov is not None: self.graph.enable_packed_cov(getattr(torch, packed_cov))
+        if shared_memory is not None: self.graph.enable_shared_memory(shared_memory)
         self.device = device
         self.mapping: bool = mapping
         self.match_cov_default: float = match_cov_default
@@ -153,8 +168,28 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
             "num_point"         : lambda b: isinstance(b, int) and b > 0, 
             "edgewidth"         : lambda b: isinstance(b, int) and b > 0, 
             "match_cov_default" : lambda b: isinstance(b, (float, int)) and b > 0.0, 
-            "profile"           : lambda b: isinstance(b, bool),
+            # Either a bool (profile frame #2) or profiling windows {ranges, every, slow_ms}, see ProfileController
+            "profile"           : lambda b: isinstance(b, (bool, SimpleNamespace)),
             "mapping"           : lambda b: isinstance(b, bool),
+        }, optional_spec={
+            # Voxel size (meter) of the spatial index over map points, no index is built if not set.
+            "spatial_index"     : lambda v: v is None or (isinstance(v, (float, int)) and v > 0),
+            # Voxel size (meter) to fuse dense mapping points into, every mapping point is kept if not set.
+            "map_voxel_size"    : lambda v: v is None or (isinstance(v, (float, int)) and v > 0),
+            # Stream results to sandbox every N frames instead of writing everything at the end.
+            "incremental_write" : lambda v: v is None or (isinstance(v, int) and v > 0),
+            # Log memory usage (used / allocated bytes) of the map every N frames.
+            "memory_log"        : lambda v: v is None or (isinstance(v, int) and v > 0),
+            # Remove unreferenced points / matches / map points from the map every N frames.
+            "compact_every"     : lambda v: v is None or (isinstance(v, int) and v > 0),
+            # Capacity growth of map stores, {type: geometric, factor: float > 1} or {type: linear, chunk: int > 0}.
+            "growth"            : lambda v: v is None or (isinstance(v, SimpleNamespace) and (
+                                    (v.type == "geometric" and getattr(v, "factor", 2.) > 1) or
+                                    (v.type == "linear" and isinstance(getattr(v, "chunk", None), int) and v.chunk > 0))),
+            # Store covariance in map as packed upper-triangle of given precision, full 3x3 float64 if not set.
+            "packed_cov"        : lambda v: v is None or v in ("float32", "float64"),
+            # Publish the live map in named shared memory for other processes, see SharedMapReader.
+            "shared_memory"     : lambda v: v is None or (isinstance(v, str) and len(v) > 0),
         })
 
     def initialize(self, frame0: T_SensorFrame):
@@ -172,6 +207,7 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         self.OutlierFilter.set_meta(frame0.stereo)
         self.prev_keyframe = (frame0, int(frame_idx.item()), depth0)
 
+    @Timer.cpu_timeit("MACVO.run_pair")
     def run_pair(self, frame0: T_SensorFrame, frame1: T_SensorFrame) -> None:
         assert self.prev_keyframe is not None
         
@@ -189,7 +225,8 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         # Receive optimization result from previous step (if exists) ####################
         # NOTE: should always writeback optimized pose to global map before selecting new 
         # keypoints (register new 3D point) on that frame.
-        self.Optimizer.write_map(self.graph)
+        with Timer.CPUTimingContext("Optimizer.write_map"):
+            self.Optimizer.write_map(self.graph)
         for func in self.on_optimize_writeback: func(self)
         
         # Motion model provide an initial guess to the pose of frame1 ###################
@@ -248,6 +285,20 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         
         
         # Run Outlier Filter ############################################################
+        # Disparity / uncertainty not produced by the configured frontend are left out (optional columns).
+        optional_obs = {
+            "pixel1_disp"    : None if kp0_disparity is None else kp0_disparity.T.cpu(),
+            "pixel2_disp"    : None if kp1_disparity is None else kp1_disparity.T.cpu(),
+            
+            "pixel1_disp_cov": None if kp0_sigma_disparity is None else kp0_sigma_disparity.T.cpu(),
+            "pixel2_disp_cov": None if kp1_sigma_disparity is None else kp1_sigma_disparity.T.cpu(),
+            
+            "pixel1_d_cov"   : None if kp0_sigma_dd is None else kp0_sigma_dd.unsqueeze(-1).cpu(),
+            "pixel2_d_cov"   : None if kp1_sigma_dd is None else kp1_sigma_dd.unsqueeze(-1).cpu(),
+            
+            "pixel1_uv_cov"  : kp0_sigma_uv,
+            "pixel2_uv_cov"  : kp1_sigma_uv,
+        }
         match_obs = MatchObs.init({
             "pixel1_uv"      : kp0_uv_cpu,
             "pixel2_uv"      : kp1_uv.cpu(),
@@ -255,21 +306,9 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
             "pixel1_d"       : kp0_d.unsqueeze(-1).cpu(),
             "pixel2_d"       : kp1_d.unsqueeze(-1).cpu(),
             
-            "pixel1_disp"    : torch.empty((num_kp, 1)).fill_(-1) if kp0_disparity is None else kp0_disparity.T.cpu(),
-            "pixel2_disp"    : torch.empty((num_kp, 1)).fill_(-1) if kp1_disparity is None else kp1_disparity.T.cpu(),
-            
-            "pixel1_disp_cov": torch.empty((num_kp, 1)).fill_(-1) if kp0_sigma_disparity is None else kp0_sigma_disparity.T.cpu(),
-            "pixel2_disp_cov": torch.empty((num_kp, 1)).fill_(-1) if kp1_sigma_disparity is None else kp1_sigma_disparity.T.cpu(),
-            
-            "pixel1_d_cov"   : torch.empty((num_kp, 1)).fill_(-1) if kp0_sigma_dd is None else kp0_sigma_dd.unsqueeze(-1).cpu(),
-            "pixel2_d_cov"   : torch.empty((num_kp, 1)).fill_(-1) if kp1_sigma_dd is None else kp1_sigma_dd.unsqueeze(-1).cpu(),
-            
-            "pixel1_uv_cov"  : torch.empty((num_kp, 3)).fill_(-1) if kp0_sigma_uv is None else kp0_sigma_uv,
-            "pixel2_uv_cov"  : torch.empty((num_kp, 3)).fill_(-1) if kp1_sigma_uv is None else kp1_sigma_uv,
-            
             "obs1_covTc"     : pos0_covTc,
             "obs2_covTc"     : pos1_covTc,
-        })
+        } | {k: v for k, v in optional_obs.items() if v is not None})
         assert self.OutlierFilter.verify_shape(match_obs), "The provided MatchFactor does not contain all data for outlier filter."
         
         # Store initial count before filtering
@@ -293,24 +332,20 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         # Register the factor graph #####################################################
         prev_pose       = pp.SE3(self.graph.frames.data["pose"][self.prev_keyframe[1]])
         prev_rot        = prev_pose.rotation().matrix().repeat((num_kp, 1, 1)).to(torch.float64)
-        num_match_orig  = len(self.graph.match)
-        
-        point_idx = self.graph.points.push(PointNode.init({
+        new_points      = PointNode.init({
             "pos_Tw": pp.SE3_type.Act(prev_pose, pos0_Tc)[..., :3],  # NOTE: Refer to https://github.com/pypose/pypose/issues/342 
             "cov_Tw": torch.bmm(torch.bmm(prev_rot, pos0_covTc), prev_rot.transpose(1, 2)),
             "color" : kp0_color
-        })[mask])
-        frame_idx      = self.push_keyframe(frame1, est_pose)
-        prev_frame_idx = torch.tensor([self.prev_keyframe[1]], dtype=torch.long)
-        match_idx      = self.graph.match.push(match_obs)
-        
-        num_match_kp = len(match_obs)
-        self.graph.point2match.add(point_idx, match_idx)    # Associate point -> match
-        self.graph.match2point.set(match_idx, point_idx)    # Associate match -> point
-        self.graph.frame2match.add(prev_frame_idx, torch.tensor([num_match_orig], dtype=torch.long), torch.tensor([num_match_kp], dtype=torch.long))   # Associate frame -> match
-        self.graph.frame2match.add(frame_idx     , torch.tensor([num_match_orig], dtype=torch.long), torch.tensor([num_match_kp], dtype=torch.long))   # Associate frame -> match
-        self.graph.match2frame1.set(match_idx    , torch.empty((num_match_kp,), dtype=torch.long).fill_(prev_frame_idx.item()))    # Associate match -> frame1
-        self.graph.match2frame2.set(match_idx    , torch.empty((num_match_kp,), dtype=torch.long).fill_(frame_idx.item()     ))    # Associate match -> frame2
+        })[mask]
+        # NOTE: if lost track, we do not do mapping since the pose is not reliable anyway.
+        lost_track      = len(match_obs) < self.min_num_point
+        
+        # Insert frame, points, matches and all edges in one transaction.
+        inserted  = self.graph.push_frame(
+            self.make_frame_node(frame1, est_pose, need_interp=lost_track), self.prev_keyframe[1],
+            new_points, match_obs
+        )
+        frame_idx, match_idx = inserted.frame_idx, inserted.match_idx
 
         # Visualization #################################################################
         fig_plt.plot_imatcher("matching", match01, frame0, frame1)
@@ -321,17 +356,15 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         self.prev_keyframe = (frame1, int(frame_idx.item()), depth1)
 
         # Launch Optimization task  #####################################################
-        if match_idx.size(0) < self.min_num_point:
-            # NOTE: if lost track, we do not do mapping since the pose is not reliable anyway.
+        if lost_track:
             Logger.write("warn", f"VOLostTrack @ {frame1.frame_idx} - only get {match_idx.size(0)} observations")
-            self.graph.frames.data["need_interp"][frame_idx] = True
             return
-        else:
-            self.Optimizer.start_optimize(
-                self.Optimizer.get_graph_data(self.graph, frame_idx)
-            )
+        self.Optimizer.start_optimize(
+            self.Optimizer.get_graph_data(self.graph, frame_idx)
+        )
         
-        # Add (dense) mapping points to the map #########################################
+        # Dense mapping points of the frame #############################################
+        # NOTE: runs after the optimization task is launched, so it overlaps with the optimizer in parallel mode.
         if self.mapping:
             map0_uv       = self.MappointSelector.select_point(frame0.stereo, 2000, depth0, depth1, match01)
             num_kp        = map0_uv.size(0)
@@ -348,25 +381,28 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
             map0_color  = frame0.stereo.imageL[..., map0_uv_cpu[..., 1], map0_uv_cpu[..., 0]].squeeze(0).T
             map0_color  = (map0_color * 255).to(torch.uint8)
             
-            num_map_orig  = len(self.graph.map_points)
-            num_mappoint  = map0_Tc.size(0)
-            map_idx = self.graph.map_points.push(PointNode.init({
+            if self.graph.map_fusion:
+                # Fusing observations across frames requires covariance under the (common) world frame.
+                map_rot     = prev_pose.rotation().matrix().repeat((num_kp, 1, 1)).to(torch.float64)
+                map0_Tc_cov = torch.bmm(torch.bmm(map_rot, map0_Tc_cov.cpu().double()), map_rot.transpose(1, 2))
+            self.graph.push_map_points(frame_idx, PointNode.init({
                 "pos_Tw": pp.SE3_type.Act(prev_pose, map0_Tc)[..., :3],
                 "cov_Tw": map0_Tc_cov,
                 "color" : map0_color,
             }))
-            self.graph.frame2map.add(frame_idx, torch.tensor([num_map_orig], dtype=torch.long), torch.tensor([num_mappoint], dtype=torch.long))   # Associate frame -> map
 
     def push_keyframe(self, frame: T_SensorFrame, est_pose: pp.LieTensor | torch.Tensor, need_interp: bool=False) -> torch.Tensor:
-        frame_idx = self.graph.frames.push(FrameNode.init({
+        return self.graph.frames.push(self.make_frame_node(frame, est_pose, need_interp))
+
+    def make_frame_node(self, frame: T_SensorFrame, est_pose: pp.LieTensor | torch.Tensor, need_interp: bool=False) -> FrameNode:
+        return FrameNode.init({
             "pose"        : est_pose,
             "T_BS"        : frame.stereo.T_BS,
             "need_interp" : torch.tensor([need_interp], dtype=torch.bool),
             "time_ns"     : torch.tensor([frame.stereo.frame_ns], dtype=torch.long),
             "K"           : frame.stereo.K,
             "baseline"    : frame.stereo.baseline,
-        }))
-        return frame_idx
+        })
 
     @Timer.cpu_timeit("Odom_Runtime")
     @Timer.gpu_timeit("Odom_Runtime")
@@ -391,6 +427,24 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
     def get_map(self) -> VisualMap:
         return self.graph
 
+    def state_dict(self) -> dict:
+        return {
+            "graph"        : self.graph.state_dict(),
+            "isinitiated"  : self.isinitiated,
+            "prev_keyframe": self.prev_keyframe,
+            "motion_model" : self.MotionEstimator.state_dict(),
+            "optimizer"    : self.Optimizer.state_dict(),
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        self.graph.load_state_dict(state["graph"])
+        self.isinitiated   = state["isinitiated"]
+        self.prev_keyframe = state["prev_keyframe"]
+        self.MotionEstimator.load_state_dict(state["motion_model"])
+        self.Optimizer.load_state_dict(state["optimizer"])
+        if self.prev_keyframe is not None:
+            self.OutlierFilter.set_meta(self.prev_keyframe[0].stereo)
+
     def terminate(self) -> None:
         super().terminate()
         if self.prev_keyframe is not None:
@@ -398,6 +452,24 @@ class MACVO(IOdometry[T_SensorFrame], ConfigTestable):
         self.Optimizer.terminate()
         self.MapRefiner.elaborate_map(self.graph.frames)
 
+    def settled_frames(self) -> int:
+        # Optimized pose of the latest keyframe is written back when the next keyframe arrives, frames after it
+        # are placeholders (need_interp) until then.
+        if self.prev_keyframe is None: return 0
+        return self.prev_keyframe[1]
+
+    def write_telemetry(self, saveto: Sandbox) -> None:
+        """
+        Per-frame convergence records of the optimizer (and their summary) to `optimizer_telemetry.json`.
+        """
+        if len(self.Optimizer.telemetry) == 0: return
+        summary = self.Optimizer.telemetry_summary()
+        with saveto.open("optimizer_telemetry.json", "w") as f:
+            json.dump({"summary": summary, "records": self.Optimizer.telemetry}, f)
+        Logger.write("info", f"Optimizer: {summary['num_solve']} solves, {summary['iterations']['mean']:.2f} iterations "
+                             f"(p95 {summary['iterations']['p95']:.0f}), {summary['time_per_iter_ms']:.3f} ms / iteration, "
+                             f"stop {summary['stop']}")
+
     def register_on_optimize_finish(self, func: T_SYSHOOK):
         """
         Install a callback hook when optimization result is written back to the map
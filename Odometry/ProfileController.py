@@ -0,0 +1,108 @@
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from torch.profiler import profile, ProfilerActivity
+
+from Utility.PrettyPrint import Logger, save_as_csv
+
+
+class ProfileController:
+    """
+    Decides which frames in `IOdometry.receive_frames` run under `torch.profiler` and collects the results.
+
+    Windows to profile
+    * `ranges`  - list of [start, end] frame index (inclusive), each range is profiled as one window.
+    * `every`   - profile every N-th frame (one frame per window).
+    * `slow_ms` - frame latency is measured with a wall-clock timer only, once a (not profiled) frame exceeds
+                  `slow_ms`, the next frame is profiled (one frame per window).
+
+    One chrome trace is written per window as `<folder>/trace_<start>-<end>.json`. On `finalize`, statistics
+    of all operators across all kept windows are aggregated into `<folder>/operator_summary.csv`.
+    """
+    def __init__(self, folder: Path, ranges: list[tuple[int, int]] | None = None, every: int | None = None,
+                 slow_ms: float | None = None, with_stack: bool = True) -> None:
+        self.folder     = folder
+        self.ranges     = sorted(ranges or [])
+        self.every      = every
+        self.slow_ms    = slow_ms
+        self.with_stack = with_stack
+
+        self.active        : profile | None = None
+        self.window_start  : int = -1
+        self.window_end    : int = -1
+        self.frame_start   : float = 0.
+        self.profile_next  : bool = False
+
+        self.num_window: int = 0
+        # Operator name -> [#call, cpu_total (us), self_cpu_total (us), device_total (us), self_device_total (us)]
+        self.summary: dict[str, list[float]] = dict()
+
+    @classmethod
+    def from_config(cls, config: bool | SimpleNamespace, folder: Path) -> "ProfileController | None":
+        """
+        `config` is either a boolean (true to profile frame #2 only, the legacy behavior) or a namespace
+        with optional fields `ranges`, `every`, `slow_ms` and `with_stack`.
+        """
+        if isinstance(config, bool):
+            return cls(folder, ranges=[(2, 2)]) if config else None
+        ranges  = [(int(r[0]), int(r[1])) for r in getattr(config, "ranges", [])]
+        every   = getattr(config, "every", None)
+        slow_ms = getattr(config, "slow_ms", None)
+        if len(ranges) == 0 and every is None and slow_ms is None: return None
+        return cls(folder, ranges=ranges, every=every, slow_ms=slow_ms, with_stack=getattr(config, "with_stack", True))
+
+    def before_frame(self, frame_idx: int) -> None:
+        self.frame_start = time.perf_counter()
+        if self.active is not None: return      # Inside a (multi-frame) range window
+
+        range_end = next((end for start, end in self.ranges if start <= frame_idx <= end), None)
+        if range_end is not None:
+            self.__start(frame_idx, range_end)
+        elif self.every is not None and frame_idx % self.every == 0:
+            self.__start(frame_idx, frame_idx)
+        elif self.profile_next:
+            self.__start(frame_idx, frame_idx)
+        self.profile_next = False
+
+    def after_frame(self, frame_idx: int) -> None:
+        elapsed_ms = (time.perf_counter() - self.frame_start) * 1000
+        # Frames under profiler are not timed, since the profiler adds overhead to them.
+        if self.slow_ms is not None and self.active is None and elapsed_ms > self.slow_ms:
+            Logger.write("info", f"Frame #{frame_idx} took {round(elapsed_ms, 2)} ms, profiling the next frame.")
+            self.profile_next = True
+
+        if self.active is None or frame_idx < self.window_end: return
+        self.active.__exit__(None, None, None)
+        prof, self.active = self.active, None
+        self.__collect(prof)
+
+    def finalize(self) -> None:
+        if self.active is not None:      # Sequence ends inside a window
+            self.active.__exit__(None, None, None)
+            self.__collect(self.active)
+            self.active = None
+        if self.num_window == 0: return
+
+        header = ["name", "count", "cpu_total_us", "self_cpu_total_us", "device_total_us", "self_device_total_us"]
+        rows   = [[name.replace(",", ";")] + stats for name, stats in self.summary.items()]
+        save_as_csv(header, rows, str(Path(self.folder, "operator_summary.csv")), sort_rows=lambda row: -row[3])
+
+    ### Implementation detail
+    def __start(self, start: int, end: int) -> None:
+        self.window_start, self.window_end = start, end
+        self.active = profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA], with_stack=self.with_stack, with_flops=True)
+        self.active.__enter__()
+
+    def __collect(self, prof: profile) -> None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        prof.export_chrome_trace(str(Path(self.folder, f"trace_{self.window_start:06d}-{self.window_end:06d}.json")))
+        self.num_window += 1
+
+        for event in prof.key_averages():
+            stats = self.summary.setdefault(event.key, [0, 0., 0., 0., 0.])
+            stats[0] += event.count
+            stats[1] += event.cpu_time_total
+            stats[2] += event.self_cpu_time_total
+            stats[3] += getattr(event, "device_time_total", getattr(event, "cuda_time_total", 0.))
+            stats[4] += getattr(event, "self_device_time_total", getattr(event, "self_cuda_time_total", 0.))
@@ -0,0 +1,184 @@
+import os
+import json
+import numpy as np
+import pypose as pp
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from Module.Map import VisualMap
+from Utility.Sandbox import Sandbox
+from Utility.PrettyPrint import Logger
+
+
+class IncrementalResultWriter:
+    """
+    Append odometry results to chunked files under `<sandbox>/incremental/` while the sequence is running,
+    so an interrupted run still leaves readable (partial) results and finishing a run only need to write
+    the small remaining part.
+
+    Streams
+    * `poses`      - (time_ns, body pose) of frames whose pose is settled by the odometry (see `IOdometry.settled_frames`).
+                     Post-processing (e.g. interpolation of `need_interp` frames) only happens on terminate, so the
+                     stream is rewritten with final poses on `finalize`.
+    * `points`     - rows of `VisualMap.points`
+    * `match`      - rows of `VisualMap.match`
+    * `map_points` - rows of `VisualMap.map_points` (only when map fusion is off, since fused rows are updated in-place)
+
+    Every `flush_every` frames, newly settled rows of each stream are handed to a background thread and written
+    as `incremental/<stream>/<chunk_id>.npz`. On `finalize`, remaining rows, the final frame store and all edges
+    are written to `incremental/final.npz` with a `manifest.json`.
+
+    Use `IncrementalResultWriter.load_tensor_map` / `load_poses` to read results back (also works on partial runs).
+    """
+    STREAMS = ("poses", "points", "match", "map_points")
+
+    def __init__(self, saveto: Sandbox, flush_every: int) -> None:
+        self.root        = saveto.path("incremental")
+        self.root.mkdir(exist_ok=True)
+        self.flush_every = flush_every
+        self.executor    = ThreadPoolExecutor(max_workers=1)
+        self.pending     : list[Future] = []
+
+        self.cursor   : dict[str, int] = {stream: 0 for stream in self.STREAMS}
+        self.num_chunk: dict[str, int] = {stream: 0 for stream in self.STREAMS}
+        self.num_update = 0
+        for stream in self.STREAMS: Path(self.root, stream).mkdir(exist_ok=True)
+
+    def update(self, global_map: VisualMap, settled_frames: int) -> None:
+        """
+        Called after each frame, schedule a background flush every `flush_every` frames. Poses of the first
+        `settled_frames` frames will not be changed by the odometry anymore.
+        """
+        self.num_update += 1
+        if self.num_update % self.flush_every != 0: return
+        self.flush(global_map, settled_frames=settled_frames)
+
+    def flush(self, global_map: VisualMap, settled_frames: int) -> None:
+        # Raise errors of finished writes instead of dropping them silently.
+        for future in self.pending:
+            if future.done(): future.result()
+        self.pending = [f for f in self.pending if not f.done()]
+
+        self._schedule("poses", self._pose_rows(global_map, self.cursor["poses"], settled_frames), settled_frames)
+        for stream in ("points", "match", "map_points"):
+            if stream == "map_points" and global_map.map_fusion: continue
+            store = getattr(global_map, stream)
+            end   = len(store)
+            # Rows in these stores are never modified after push, so numpy views (without copy) are safe to
+            # be written by the background thread.
+            rows  = {k: v.tensor[self.cursor[stream]:end].numpy() for k, v in store.data.items()}
+            self._schedule(stream, rows, end)
+
+    def finalize(self, global_map: VisualMap) -> None:
+        """
+        Write all remaining rows, the final frame store (after post-processing) and edges. Blocks until all
+        background writes are finished.
+        """
+        # Streamed poses are estimates before post-processing, replace them with the final trajectory.
+        self.sync()
+        for chunk in Path(self.root, "poses").glob("[0-9]*.npz"): chunk.unlink()
+        self.cursor["poses"], self.num_chunk["poses"] = 0, 0
+        self.flush(global_map, settled_frames=len(global_map.frames))
+        serialized = global_map.serialize()
+        final_part = {k: v for k, v in serialized.items() if not k.startswith(("points/", "match/"))}
+        if not global_map.map_fusion:
+            final_part = {k: v for k, v in final_part.items() if not k.startswith("map_points/")}
+
+        self.close()
+        self._atomic_savez(Path(self.root, "final.npz"), final_part)
+        with open(Path(self.root, "manifest.json"), "w") as f:
+            json.dump({"num_chunk": self.num_chunk, "num_rows": self.cursor, "finalized": True}, f)
+
+    def frozen_rows(self) -> dict[str, int]:
+        """
+        Number of leading rows of each store already streamed, their index must not change (see `VisualMap.compact`).
+        """
+        return {stream: self.cursor[stream] for stream in ("points", "match", "map_points")}
+
+    def sync(self) -> None:
+        """
+        Block until all scheduled writes are on disk.
+        """
+        for future in self.pending: future.result()
+        self.pending.clear()
+
+    def close(self) -> None:
+        self.sync()
+        self.executor.shutdown(wait=True)
+    
+    def state_dict(self) -> dict:
+        self.sync()
+        return {"cursor": dict(self.cursor), "num_chunk": dict(self.num_chunk), "num_update": self.num_update}
+    
+    def load_state_dict(self, state: dict) -> None:
+        self.cursor, self.num_chunk, self.num_update = dict(state["cursor"]), dict(state["num_chunk"]), state["num_update"]
+        # Chunks written after the checkpoint are stale, they will be re-written by the resumed run.
+        for stream in self.STREAMS:
+            for chunk in Path(self.root, stream).glob("[0-9]*.npz"):
+                if int(chunk.stem) >= self.num_chunk[stream]: chunk.unlink()
+
+    ### Implementation detail
+    @staticmethod
+    def _pose_rows(global_map: VisualMap, start: int, end: int) -> dict[str, np.ndarray]:
+        if end <= start: return {"time_ns": np.zeros((0, 1)), "pose": np.zeros((0, 7))}
+        sensor_poses = pp.SE3(global_map.frames.data["pose"][start:end].clone())
+        T_BS         = pp.SE3(global_map.frames.data["T_BS"][start:end].clone())
+        body_poses   = (T_BS @ sensor_poses @ T_BS.Inv()).tensor().cpu().numpy()
+        time_ns      = global_map.frames.data["time_ns"][start:end].cpu().numpy()[:, np.newaxis]
+        return {"time_ns": time_ns, "pose": body_poses}
+
+    def _schedule(self, stream: str, rows: dict[str, np.ndarray], end: int) -> None:
+        if end <= self.cursor[stream]: return
+        file_name = Path(self.root, stream, f"{self.num_chunk[stream]:06d}.npz")
+        self.pending.append(self.executor.submit(self._atomic_savez, file_name, rows))
+        self.cursor[stream]    = end
+        self.num_chunk[stream] += 1
+
+    @staticmethod
+    def _atomic_savez(file_name: Path, value: dict[str, np.ndarray]) -> None:
+        temp_name = file_name.with_name("tmp_" + file_name.name)
+        np.savez(temp_name, **value)
+        os.replace(temp_name, file_name)
+
+    @staticmethod
+    def _load_stream(root: Path, stream: str) -> dict[str, np.ndarray]:
+        chunks = [dict(np.load(f)) for f in sorted(Path(root, stream).glob("[0-9]*.npz"))]
+        if len(chunks) == 0: return dict()
+        # Optional columns (see AutoScalingBundle.declare_optional) may materialize in the middle of a run,
+        # earlier chunks without the column are filled with the placeholder value (-1).
+        keys   = {k for c in chunks for k in c}
+        result = dict()
+        for k in keys:
+            ref       = next(c[k] for c in chunks if k in c)
+            result[k] = np.concatenate([
+                c[k] if k in c else np.full((len(next(iter(c.values()))), *ref.shape[1:]), -1, dtype=ref.dtype)
+                for c in chunks
+            ], axis=0)
+        return result
+
+    ### Read-back
+    @classmethod
+    def load_poses(cls, folder: Path | str) -> np.ndarray:
+        """
+        Returns Nx8 array of (time_ns, body pose) in the same format as `poses.npy`.
+        """
+        if Path(folder, "poses.npy").exists(): return np.load(Path(folder, "poses.npy"))
+        Logger.write("warn", f"Reading partial (unfinished) trajectory from {folder}")
+        poses = cls._load_stream(Path(folder, "incremental"), "poses")
+        if len(poses) == 0: return np.zeros((0, 8))
+        return np.concatenate([poses["time_ns"], poses["pose"]], axis=-1)
+
+    @classmethod
+    def load_tensor_map(cls, folder: Path | str) -> dict[str, np.ndarray]:
+        """
+        Returns the map in the same format as `VisualMap.serialize()`. For an unfinished run, only the
+        streamed `points`, `match` (and `map_points`) rows are available.
+        """
+        root   = Path(folder, "incremental")
+        result: dict[str, np.ndarray] = dict()
+        for stream in ("points", "match", "map_points"):
+            result |= {f"{stream}//{k}": v for k, v in cls._load_stream(root, stream).items()}
+        if Path(root, "final.npz").exists():
+            result |= dict(np.load(Path(root, "final.npz")))
+        return result
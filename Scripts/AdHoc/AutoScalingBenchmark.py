@@ -0,0 +1,54 @@
+"""
+Micro-benchmark of per-access overhead of AutoScalingTensor / AutoScalingBundle compared to plain torch.Tensor
+with the same content. Also checks that all access paths return identical results.
+"""
+import torch
+import timeit
+
+from Module.Map import VisualMap, PointNode
+
+
+def make_map(num_point: int) -> VisualMap:
+    gmap = VisualMap()
+    gmap.points.push(PointNode.init({
+        "pos_Tw": torch.rand((num_point, 3)),
+        "cov_Tw": torch.eye(3, dtype=torch.float64).repeat(num_point, 1, 1),
+        "color" : torch.zeros((num_point, 3), dtype=torch.uint8),
+    }))
+    return gmap
+
+
+def main(num_point: int, repeat: int):
+    gmap   = make_map(num_point)
+    pos    = gmap.points.data["pos_Tw"]
+    plain  = pos.tensor.clone()
+    view   = gmap.points.view()
+    select = torch.randint(0, num_point, (256,))
+
+    # Results must be identical regardless of the access path.
+    assert (pos[select] == plain[select]).all()
+    assert (gmap.points[select].data["pos_Tw"] == view[select].data["pos_Tw"]).all()
+    assert (torch.cat([pos.tensor, pos.tensor]) == torch.cat([plain, plain])).all()
+
+    cases = {
+        "attribute (.shape)"  : (lambda: pos.shape             , lambda: plain.shape),
+        "indexing (x[idx])"   : (lambda: pos[select]           , lambda: plain[select]),
+        "arithmetic (x + 1)"  : (lambda: pos + 1.              , lambda: plain + 1.),
+        "torch function"      : (lambda: torch.norm(pos)       , lambda: torch.norm(plain)),
+        "bundle[idx]"         : (lambda: gmap.points[select]   , lambda: view[select]),
+    }
+    print(f"{'case':<22}{'scaling (us)':>14}{'plain (us)':>14}{'overhead (us)':>16}")
+    for name, (scaling_fn, plain_fn) in cases.items():
+        t_scaling = min(timeit.repeat(scaling_fn, number=repeat, repeat=5)) / repeat * 1e6
+        t_plain   = min(timeit.repeat(plain_fn  , number=repeat, repeat=5)) / repeat * 1e6
+        print(f"{name:<22}{t_scaling:>14.3f}{t_plain:>14.3f}{t_scaling - t_plain:>16.3f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_point", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=10000)
+    args = parser.parse_args()
+
+    main(args.num_point, args.repeat)
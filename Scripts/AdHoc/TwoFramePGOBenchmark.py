@@ -0,0 +1,51 @@
+"""
+Benchmark of TwoFrame_PGO solve paths on synthetic two-frame problems (CPU): per-frame `_optimize` (eager and with
+compiled kernels) and `batch_optimize` over all problems. Problems are generated as in the unit test, also checks
+that all paths reach the same pose.
+"""
+import time
+import torch
+import pypose as pp
+from types import SimpleNamespace
+
+from Module.Optimization.TwoFramePGO import TwoFrame_PGO
+from Scripts.UnitTest.test_batched_pgo import make_problem
+
+
+def main(graph_type: str, num_problem: int, num_point: int):
+    problems = [make_problem(num_point + seed % 64, seed)[0] for seed in range(num_problem)]
+    config   = SimpleNamespace(graph_type=graph_type, device="cpu", vectorize=True, parallel=False, autodiff=False)
+    eager    = TwoFrame_PGO.init_context(config)
+    compiled = TwoFrame_PGO.init_context(SimpleNamespace(**vars(config), compile=True))
+    TwoFrame_PGO._optimize(compiled, problems[0])      # Warm up (compile) outside of timing
+
+    def timed(fn):
+        start  = time.perf_counter()
+        result = fn()
+        return result, (time.perf_counter() - start) / num_problem * 1e3
+
+    ref, t_eager    = timed(lambda: [TwoFrame_PGO._optimize(eager, g)[1] for g in problems])
+    cmp, t_compiled = timed(lambda: [TwoFrame_PGO._optimize(compiled, g)[1] for g in problems])
+    (_, bat, info), t_batch = timed(lambda: TwoFrame_PGO.batch_optimize(eager, problems))
+
+    for a, b, c in zip(ref, cmp, bat):
+        pose = pp.SE3(a.motion).double()
+        assert (pose.Inv() @ pp.SE3(b.motion).double()).Log().norm() < 1e-4
+        assert (pose.Inv() @ pp.SE3(c.motion).double()).Log().norm() < 1e-4
+
+    print(f"{'path':<22}{'ms / problem':>14}")
+    for name, t in (("eager _optimize", t_eager), ("compiled _optimize", t_compiled), ("batch_optimize", t_batch)):
+        print(f"{name:<22}{t:>14.3f}")
+    print(f"batched steps: mean {info.num_step.double().mean().item():.2f}, converged {info.converged.double().mean().item():.2%}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--graph_type", type=str, default="disp", choices=["icp", "reproj", "disp"])
+    parser.add_argument("--num_problem", type=int, default=256)
+    parser.add_argument("--num_point", type=int, default=400)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    main(args.graph_type, args.num_problem, args.num_point)
@@ -0,0 +1,30 @@
+import time
+import threading
+
+from Utility.Extensions import AsyncHookExecutor
+
+
+def test_block_policy_keeps_order():
+    received = []
+    executor = AsyncHookExecutor(received.append, max_pending=2, policy="block")
+    for i in range(100): assert executor.submit(i)
+    executor.close()
+    assert received == list(range(100))
+
+
+def test_drop_policy_never_blocks():
+    release  = threading.Event()
+    received = []
+    def slow_consumer(x: int):
+        release.wait()
+        received.append(x)
+    
+    executor = AsyncHookExecutor(slow_consumer, max_pending=2, policy="drop")
+    start = time.perf_counter()
+    accepted = [executor.submit(i) for i in range(10)]
+    assert time.perf_counter() - start < 1.
+    release.set()
+    executor.close()
+    
+    assert executor.num_dropped == accepted.count(False) > 0
+    assert received == [i for i, ok in enumerate(accepted) if ok]
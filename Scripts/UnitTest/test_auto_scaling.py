@@ -0,0 +1,59 @@
+import torch
+
+from Utility.Extensions import AutoScalingTensor, GeometricGrowth, LinearGrowth
+
+
+def test_growth_policy():
+    assert GeometricGrowth(2.).next_size(1024, 1025) == 2048
+    assert GeometricGrowth(1.5).next_size(1024, 1025) == 1536
+    assert GeometricGrowth(1.5).next_size(1024, 5000) == 5184
+    assert LinearGrowth(100).next_size(1024, 1025) == 1124
+    assert LinearGrowth(100).next_size(1024, 1350) == 1424
+
+
+def test_reserve_and_shrink():
+    buf = AutoScalingTensor((4, 3), grow_on=0, dtype=torch.float32, init_val=0., growth=LinearGrowth(4))
+    buf.reserve(16)
+    assert buf.num_realloc == 1 and buf.bytes_copied == 0
+
+    data = torch.arange(16 * 3, dtype=torch.float32).view(16, 3)
+    for row in data.split(1): buf.push(row)
+    assert buf.num_realloc == 1 and buf._curr_max_size == 16     # Exact reservation never grows
+
+    buf.push(torch.ones((1, 3)))
+    assert buf._curr_max_size == 20 and buf.bytes_copied == 16 * 3 * 4
+
+    buf.shrink_to_fit()
+    assert buf.memory_usage() == (17 * 3 * 4, 17 * 3 * 4)
+    assert (buf.tensor[:16] == data).all() and (buf.tensor[16] == 1.).all()
+    assert buf.peak_alloc == (20 + 17) * 3 * 4
+
+
+def test_view_and_delegation():
+    buf = AutoScalingTensor((2, 3), grow_on=0, dtype=torch.float32)
+    buf.push(torch.ones((3, 3)))
+    assert buf.tensor.shape == (3, 3) and buf.shape == (3, 3) and len(buf) == 3
+
+    # View is live (writes are visible) and refreshed after push / reallocation.
+    buf.tensor[0] = 2.
+    assert (buf[0] == 2.).all()
+    buf.push(torch.zeros((10, 3)))
+    assert buf.tensor.shape == (13, 3) and (buf.tensor[0] == 2.).all() and (buf.tensor[3:] == 0.).all()
+    assert torch.equal(torch.sum(buf), buf.tensor.sum())
+
+
+def test_init_tensor():
+    storage = torch.arange(8, dtype=torch.float32)
+    assert len(AutoScalingTensor(None, grow_on=0, init_tensor=storage)) == 0      # Storage only by default
+    buf = AutoScalingTensor(None, grow_on=0, init_tensor=storage, init_size=5)
+    assert torch.equal(buf.tensor, storage[:5]) and buf._curr_max_size == 8
+
+    # Storage copied into an allocator is handed back to it on reallocation.
+    class Recorder:
+        def __init__(self): self.released = []
+        def allocate(self, shape, dtype): return torch.empty(shape, dtype=dtype)
+        def release(self, tensor): self.released.append(tensor)
+    allocator = Recorder()
+    buf = AutoScalingTensor(None, grow_on=0, init_tensor=storage, init_size=8, allocator=allocator)     # type: ignore
+    buf.push(torch.ones(1))
+    assert len(allocator.released) == 1 and torch.equal(buf.tensor[:8], storage)
@@ -0,0 +1,161 @@
+import torch
+import pytest
+import pypose as pp
+from types import SimpleNamespace
+
+from Module.Map import MatchObs, PointNode
+from Module.Optimization.TwoFramePGO import TwoFrame_PGO
+from Module.Optimization.TwoFramePGO.Graphs import GraphInput
+
+
+K        = torch.tensor([[320., 0., 320.], [0., 320., 240.], [0., 0., 1.]])
+BASELINE = 0.25
+
+
+def make_problem(num: int, seed: int) -> tuple[GraphInput, pp.LieTensor]:
+    gen    = torch.Generator().manual_seed(seed)
+    motion = pp.se3(torch.cat([torch.rand(3, generator=gen) * 0.5, torch.rand(3, generator=gen) * 0.05])).Exp()
+    pos_Tw = torch.rand((num, 3), generator=gen) * torch.tensor([8., 4., 4.]) + torch.tensor([4., -2., -2.])
+    pos_Tc = motion.Inv().Act(pos_Tw)
+    x, y, z = pos_Tc.unbind(-1)
+    uv      = torch.stack((K[0, 0] * y / x + K[0, 2], K[1, 1] * z / x + K[1, 2]), dim=-1)
+    uv      = uv + torch.randn(uv.shape, generator=gen) * 0.5
+
+    observations = MatchObs.init({
+        "pixel2_uv"      : uv.float(),
+        "pixel2_d"       : x.unsqueeze(-1).float(),
+        "pixel2_disp"    : (K[0, 0] * BASELINE / x).unsqueeze(-1).float(),
+        "pixel2_uv_cov"  : torch.tensor([[1., 1., 0.]]).repeat(num, 1),
+        "pixel2_disp_cov": torch.ones((num, 1)),
+        "obs2_covTc"     : torch.eye(3, dtype=torch.float64).repeat(num, 1, 1) * 1e-2,
+    })
+    points = PointNode.init({
+        "pos_Tw": pos_Tw.float(),
+        "cov_Tw": torch.eye(3, dtype=torch.float64).repeat(num, 1, 1) * 1e-2,
+    })
+    init_motion = pp.se3(torch.tensor([[0.05, -0.05, 0.05, 0.01, 0., -0.01]])).Exp() @ motion.unsqueeze(0)
+    graph = GraphInput(
+        torch.tensor([1]), torch.tensor([0]), pp.SE3(init_motion), torch.tensor([[BASELINE]]),
+        observations, points, K, torch.zeros(num, dtype=torch.long), "cpu"
+    )
+    return graph, motion
+
+
+def make_context(graph_type: str) -> dict:
+    return TwoFrame_PGO.init_context(SimpleNamespace(
+        graph_type=graph_type, device="cpu", vectorize=True, parallel=False, autodiff=False
+    ))
+
+
+def test_batched_matches_sequential():
+    problems = [make_problem(num, seed) for seed, num in enumerate((50, 200, 120))]
+    for graph_type in ("icp", "reproj", "disp"):
+        context = make_context(graph_type)
+        _, outputs, result = TwoFrame_PGO.batch_optimize(context, [graph for graph, _ in problems])
+        assert len(outputs) == 3 and result.num_step.shape == (3,)
+        assert bool((result.num_step > 0).all())
+
+        for (graph, motion), output in zip(problems, outputs):
+            _, expect = TwoFrame_PGO._optimize(make_context(graph_type), graph)
+            batched   = pp.SE3(output.motion).double()
+            assert (pp.SE3(expect.motion).double().Inv() @ batched).Log().norm() < 1e-4
+            assert (motion.double().Inv() @ batched.squeeze(0)).Log().norm() < 1e-2
+
+
+def test_batched_padding_invariant():
+    small, _ = make_problem(30, seed=0)
+    large, _ = make_problem(300, seed=1)
+    context  = make_context("disp")
+
+    _, alone, alone_res = TwoFrame_PGO.batch_optimize(context, [small])
+    _, batch, batch_res = TwoFrame_PGO.batch_optimize(context, [small, large])
+    assert torch.allclose(alone[0].motion.tensor(), batch[0].motion.tensor(), atol=1e-10)
+    assert alone_res.num_step[0] == batch_res.num_step[0]
+    assert torch.allclose(alone_res.damping[0], batch_res.damping[0])
+
+
+def test_fused_normal_equation():
+    graph_data, _ = make_problem(100, seed=2)
+    for graph_type in ("icp", "reproj", "disp"):
+        graph = TwoFrame_PGO.graph_class(SimpleNamespace(autodiff=False, graph_type=graph_type))(graph_data).double()
+        R     = graph()
+        info  = torch.pinverse(graph.covariance_array().double())
+        scale = torch.rand(R.shape, dtype=torch.double) + 0.5
+
+        J     = graph.build_jacobian() * scale.view(-1, 1)
+        W     = torch.block_diag(*info)
+        A, b, JtJ, JtR = graph.normal_equation(R, info, scale, chunk=7)
+        assert torch.allclose(A, J.mT @ W @ J) and torch.allclose(b, -J.mT @ W @ (scale * R).view(-1, 1))
+        assert torch.allclose(JtJ, J.mT @ J) and torch.allclose(JtR, J.mT @ (scale * R).view(-1, 1))
+
+        context = make_context(graph_type)
+        context["fused_chunk"] = 16
+        _, fused = TwoFrame_PGO._optimize(context, graph_data)
+        _, dense = TwoFrame_PGO._optimize(make_context(graph_type), graph_data)
+        assert (pp.SE3(dense.motion).double().Inv() @ pp.SE3(fused.motion).double()).Log().norm() < 1e-8
+
+
+def test_compiled_matches_eager():
+    from Module.Optimization.TwoFramePGO.Graphs import Batched_TwoFramePGO
+    assert [Batched_TwoFramePGO.bucket(n) for n in (1, 64, 65, 300, 1024)] == [64, 64, 128, 512, 1024]
+
+    problems = [make_problem(num, seed) for seed, num in enumerate((40, 150))]
+    for graph_type in ("icp", "reproj", "disp"):
+        compiled = make_context(graph_type)
+        compiled["compiled"] = True
+        for graph, _ in problems:
+            _, expect = TwoFrame_PGO._optimize(make_context(graph_type), graph)
+            _, result = TwoFrame_PGO._optimize(compiled, graph)
+            assert (pp.SE3(expect.motion).double().Inv() @ pp.SE3(result.motion).double()).Log().norm() < 1e-4
+
+
+def test_warm_start_and_termination():
+    problems = [make_problem(200, seed)[0] for seed in range(3)]
+    for compiled in (False, True):
+        context = make_context("disp")
+        context.update(compiled=compiled, warm_start=True, grad_tol=1e-3)
+        _, result = TwoFrame_PGO._optimize(context, problems[0])
+        assert context["damping"] is not None       # Converged solve is carried to the next frame
+        for graph in problems[1:]:
+            _, warm   = TwoFrame_PGO._optimize(context, graph)
+            _, expect = TwoFrame_PGO._optimize(make_context("disp"), graph)
+            assert (pp.SE3(expect.motion).double().Inv() @ pp.SE3(warm.motion).double()).Log().norm() < 1e-3
+
+    # Time budget bounds the number of steps, at least one step is always taken.
+    context = make_context("disp")
+    context["time_budget"] = 1e-6
+    _, outputs, info = TwoFrame_PGO.batch_optimize(context, problems)
+    assert (info.num_step == 1).all() and not info.converged.any()
+    assert all(o.telemetry is not None and o.telemetry["stop"] == "time_budget" for o in outputs)
+
+    # pypose's LM (autodiff graphs) has no gradient-norm termination.
+    config = SimpleNamespace(graph_type="disp", device="cpu", vectorize=True, parallel=False, autodiff=True, grad_tol=1e-3)
+    with pytest.raises(ValueError): TwoFrame_PGO.is_valid_config(config)
+    config.compile = True
+    TwoFrame_PGO.is_valid_config(config)
+
+
+def test_convergence_telemetry():
+    graph, _ = make_problem(200, seed=0)
+    for compiled in (False, True):
+        context = make_context("disp")
+        context["compiled"] = compiled
+        _, result = TwoFrame_PGO._optimize(context, graph)
+        record    = result.telemetry
+        assert record is not None and record["frame_idx"] == 1 and record["time_ms"] > 0
+        assert 0 < record["num_step"] <= 10 and len(record["loss"]) == record["num_step"] + 1
+        assert record["loss"][-1] < record["loss"][0]
+        assert record["stop"] in ("converged", "step_cap")
+
+
+def test_outlier_rejection():
+    graph, _ = make_problem(200, seed=3)
+    graph.observations.data["pixel2_uv"][:5] += 100.
+    for graph_type in ("icp", "disp"):
+        context = make_context(graph_type)
+        context["outlier_chi2"] = 16.
+        _, result = TwoFrame_PGO._optimize(context, graph)
+        assert result.outlier is not None and result.outlier.tolist() == [0, 1, 2, 3, 4]
+        
+        _, (batched, ), _ = TwoFrame_PGO.batch_optimize(context, [graph])
+        assert batched.outlier is not None and batched.outlier.tolist() == [0, 1, 2, 3, 4]
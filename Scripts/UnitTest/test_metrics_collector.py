@@ -0,0 +1,77 @@
+import torch
+import pandas as pd
+from types import SimpleNamespace
+
+from Utility.MetricsCollector import FrameMetricsCollector
+
+
+def test_metrics_match_reference(tmp_path):
+    collector = FrameMetricsCollector(tmp_path, flush_every=3)
+    covs  = torch.eye(3, dtype=torch.float64).repeat(20, 1, 1) * torch.rand(20, 1, 1, dtype=torch.float64)
+    depths = []
+    for idx in range(7):
+        depth = torch.rand((1, 1, 16, 16))
+        depth[depth < 0.2] = torch.nan
+        depths.append(depth)
+        stereo = SimpleNamespace(depth=depth, disparity=None, disparity_uncertainty=None, cov=None)
+        collector.record_frame_metrics(idx, idx, None, stereo_data=stereo,          # type: ignore
+                                       point3d_covs=covs[idx * 2:(idx + 1) * 2], filtering_stats={"initial_count": 10, "final_count": 8})
+    collector.save_metrics()
+    collector.close()
+    
+    df = pd.read_csv(tmp_path / "frame_metrics.csv")
+    assert len(df) == 7
+    for idx, depth in enumerate(depths):
+        valid = depth[~torch.isnan(depth)].double()
+        traces = torch.diagonal(covs[:(idx + 1) * 2], dim1=1, dim2=2).sum(dim=1)
+        assert abs(df["depth_mean"][idx] - valid.mean().item()) < 1e-6
+        assert abs(df["depth_std"][idx] - valid.std().item()) < 1e-6
+        assert abs(df["point3d_uncertainty_mean"][idx] - traces.mean().item()) < 1e-6
+        assert abs(df["point3d_uncertainty_std"][idx] - traces.std().item()) < 1e-6
+    assert (df["rejection_rate"] - 0.2).abs().max() < 1e-9
+
+
+def test_metrics_sampling(tmp_path):
+    collector = FrameMetricsCollector(tmp_path, sample_every=3, keyframe_only=True)
+    for idx in range(10):
+        collector.record_frame_metrics(idx, idx, None, is_keyframe=(idx != 6))     # type: ignore
+    collector.save_metrics()
+    collector.close()
+    assert pd.read_csv(tmp_path / "frame_metrics.csv")["frame_idx"].tolist() == [0, 3, 9]
+
+
+def test_metrics_point3d_sampled_and_reset(tmp_path):
+    collector = FrameMetricsCollector(tmp_path, sample_every=2)
+    covs = torch.eye(3, dtype=torch.float64).repeat(12, 1, 1) * torch.rand(12, 1, 1, dtype=torch.float64)
+    for idx in range(4):    # Points of frames not recorded are still counted
+        collector.record_frame_metrics(idx, idx, None, point3d_covs=covs[idx * 2:(idx + 1) * 2])    # type: ignore
+    # Points are renumbered, statistics restart from all remaining points.
+    collector.record_frame_metrics(4, 4, None, point3d_covs=covs[8:], point3d_reset=True)          # type: ignore
+    collector.save_metrics()
+    collector.close()
+    
+    df = pd.read_csv(tmp_path / "frame_metrics.csv")
+    traces = torch.diagonal(covs, dim1=1, dim2=2).sum(dim=1)
+    assert abs(df["point3d_uncertainty_mean"][1] - traces[:6].mean().item()) < 1e-6
+    assert abs(df["point3d_uncertainty_mean"][2] - traces[8:].mean().item()) < 1e-6
+
+
+def test_metrics_resume(tmp_path):
+    collector = FrameMetricsCollector(tmp_path, flush_every=2)
+    for idx in range(7):    # Checkpoint saved before frame 4, run killed after frame 6
+        collector.record_frame_metrics(idx, idx, None)                          # type: ignore
+    collector.close()
+    
+    collector = FrameMetricsCollector(tmp_path, flush_every=2, resume=True)
+    for idx in range(4, 9):
+        collector.record_frame_metrics(idx, idx, None)                          # type: ignore
+    collector.save_metrics()
+    collector.close()
+    assert pd.read_csv(tmp_path / "frame_metrics.csv")["frame_idx"].tolist() == list(range(9))
+
+    # A new (not resumed) run replaces the metrics.
+    collector = FrameMetricsCollector(tmp_path)
+    collector.record_frame_metrics(0, 0, None)                                  # type: ignore
+    collector.save_metrics()
+    collector.close()
+    assert pd.read_csv(tmp_path / "frame_metrics.csv")["frame_idx"].tolist() == [0]
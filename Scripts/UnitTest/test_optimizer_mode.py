@@ -0,0 +1,115 @@
+import time
+import torch
+import threading
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+from Module.Optimization.Interface import IOptimizer, ConvergenceRecord
+
+
+@dataclass
+class CounterInput:
+    value: torch.Tensor
+
+
+@dataclass
+class CounterOutput:
+    value    : torch.Tensor
+    step     : int
+    telemetry: ConvergenceRecord | None = None
+
+
+class CounterOptimizer(IOptimizer[CounterInput, dict, CounterOutput]):
+    """Accumulates inputs into context, slow enough for the job to be observed while running."""
+    @staticmethod
+    def init_context(config) -> dict:
+        return {"step": 0, "total": torch.zeros(3)}
+
+    @staticmethod
+    def _optimize(context: dict, graph_data: CounterInput) -> tuple[dict, CounterOutput]:
+        time.sleep(0.05)
+        context["step"] += 1
+        context["total"] = context["total"] + graph_data.value
+        num_step = int(graph_data.value[0]) + 1
+        return context, CounterOutput(context["total"].clone(), context["step"], ConvergenceRecord(
+            frame_idx=context["step"], num_step=num_step, loss=[1. / (i + 1) for i in range(num_step + 1)],
+            damping=1e-3, time_ms=2. * num_step, stop="converged" if num_step < 4 else "step_cap"
+        ))
+
+
+def run(optimizer: CounterOptimizer, num_job: int) -> list[CounterOutput | None]:
+    results = []
+    for idx in range(num_job):
+        optimizer.start_optimize(CounterInput(torch.full((3,), float(idx))))
+        results.append(optimizer.get_result())
+    return results
+
+
+def test_thread_mode_matches_sequential():
+    sequential = CounterOptimizer(SimpleNamespace(parallel=False))
+    threaded   = CounterOptimizer(SimpleNamespace(parallel="thread", num_threads=1))
+    assert threaded.mode == "thread" and threaded.is_parallel_mode
+
+    for seq_res, thr_res in zip(run(sequential, 5), run(threaded, 5)):
+        assert seq_res is not None and thr_res is not None
+        assert seq_res.step == thr_res.step and torch.equal(seq_res.value, thr_res.value)
+    assert threaded.get_result() is None
+    threaded.terminate()
+
+
+class GatedOptimizer(CounterOptimizer):
+    """Jobs block until `gate` is set, so a pending job can be observed deterministically."""
+    gate = threading.Event()
+
+    @staticmethod
+    def _optimize(context: dict, graph_data: CounterInput) -> tuple[dict, CounterOutput]:
+        GatedOptimizer.gate.wait()
+        return CounterOptimizer._optimize(context, graph_data)
+
+
+def test_thread_mode_state_dict():
+    optimizer = GatedOptimizer(SimpleNamespace(parallel="thread"))
+    GatedOptimizer.gate.clear()
+    optimizer.start_optimize(CounterInput(torch.ones(3)))
+    assert optimizer.is_running
+
+    GatedOptimizer.gate.set()
+    state = optimizer.state_dict()      # Waits for the pending job
+    assert not optimizer.is_running and state["context"]["step"] == 1
+    assert state["result"] is not None and state["result"].step == 1
+
+    restored = CounterOptimizer(SimpleNamespace(parallel="thread"))
+    restored.load_state_dict(state)
+    result = restored.get_result()
+    assert result is not None and result.step == 1 and restored.get_result() is None
+
+    restored.start_optimize(CounterInput(torch.ones(3)))
+    result = restored.get_result()
+    assert result is not None and result.step == 2 and torch.equal(result.value, torch.full((3,), 2.))
+    optimizer.terminate()
+    restored.terminate()
+
+
+def test_telemetry():
+    for parallel in (False, "thread"):
+        optimizer = CounterOptimizer(SimpleNamespace(parallel=parallel))
+        run(optimizer, 5)
+        assert [r["frame_idx"] for r in optimizer.telemetry] == [1, 2, 3, 4, 5]
+
+        summary = optimizer.telemetry_summary()
+        assert summary["num_solve"] == 5 and summary["total_time_ms"] == 30.
+        assert summary["time_per_iter_ms"] == 2. and summary["iterations"]["max"] == 5
+        assert summary["iterations"]["histogram"] == {1: 1, 2: 1, 3: 1, 4: 1, 5: 1}
+        assert summary["stop"] == {"converged": 3, "step_cap": 2}
+
+        state = optimizer.state_dict()
+        assert state["telemetry"] == optimizer.telemetry and state["telemetry"] is not optimizer.telemetry
+
+        # Record of a job pending while restoring is not appended to the restored telemetry.
+        restored = CounterOptimizer(SimpleNamespace(parallel=parallel))
+        restored.start_optimize(CounterInput(torch.ones(3)))
+        restored.load_state_dict(state)
+        assert restored.telemetry == optimizer.telemetry
+        optimizer.terminate()
+        restored.terminate()
+    assert CounterOptimizer(SimpleNamespace(parallel=False)).telemetry_summary() == {"num_solve": 0}
@@ -0,0 +1,29 @@
+import torch
+
+from Module.Map import VisualMap, FrameNode
+from Odometry.ResultWriter import IncrementalResultWriter
+from Utility.Sandbox import Sandbox
+
+
+def make_frame(x: float) -> FrameNode:
+    return FrameNode.init({
+        "K": torch.eye(3).unsqueeze(0), "baseline": torch.ones(1), "pose": torch.tensor([[x, 0., 0., 0., 0., 0., 1.]]),
+        "T_BS": torch.tensor([[0., 0., 0., 0., 0., 0., 1.]]), "need_interp": torch.zeros(1, dtype=torch.bool),
+        "time_ns": torch.tensor([int(x)], dtype=torch.long),
+    })
+
+
+def test_settled_poses(tmp_path):
+    gmap   = VisualMap()
+    writer = IncrementalResultWriter(Sandbox(tmp_path), flush_every=1)
+    for idx in range(6):
+        gmap.frames.push(make_frame(float(idx)))
+        writer.update(gmap, settled_frames=max(idx - 1, 0))
+    writer.sync()
+    assert IncrementalResultWriter.load_poses(tmp_path).shape == (4, 8)
+
+    # Poses changed after being streamed (optimizer write back, post-processing) are rewritten on finalize.
+    gmap.frames.write_column("pose", torch.tensor([1]), torch.tensor([[10., 0., 0., 0., 0., 0., 1.]]))
+    writer.finalize(gmap)
+    poses = IncrementalResultWriter.load_poses(tmp_path)
+    assert poses.shape == (6, 8) and poses[1, 1] == 10.
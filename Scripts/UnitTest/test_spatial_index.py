@@ -0,0 +1,63 @@
+import torch
+import pypose as pp
+
+from Module.Map import VisualMap, PointNode
+
+
+def push_random_points(gmap: VisualMap, num: int) -> None:
+    gmap.points.push(PointNode.init({
+        "pos_Tw": torch.rand((num, 3)) * 10. - 5.,
+        "cov_Tw": torch.eye(3, dtype=torch.float64).repeat(num, 1, 1),
+        "color" : torch.zeros((num, 3), dtype=torch.uint8),
+    }))
+
+
+def test_radius_query():
+    gmap = VisualMap()
+    push_random_points(gmap, 500)
+    gmap.enable_spatial_index(0.5)
+    push_random_points(gmap, 1500)          # Index must follow push after it is enabled.
+    assert gmap.point_index is not None
+
+    centers = torch.rand((16, 3)) * 10. - 5.
+    query_idx, point_idx = gmap.point_index.query_radius(centers, 0.8)
+
+    dist = torch.cdist(centers.double(), gmap.points.data["pos_Tw"].tensor.double())
+    for q in range(centers.size(0)):
+        expect = set(torch.nonzero(dist[q] <= 0.8).flatten().tolist())
+        actual = set(point_idx[query_idx == q].tolist())
+        assert expect == actual
+
+
+def test_knn_query():
+    gmap = VisualMap()
+    gmap.enable_spatial_index(0.5)
+    push_random_points(gmap, 2000)
+    assert gmap.point_index is not None
+
+    centers = torch.rand((16, 3)) * 6. - 3.
+    index, distance = gmap.point_index.query_knn(centers, k=5)
+
+    dist = torch.cdist(centers.double(), gmap.points.data["pos_Tw"].tensor.double())
+    expect_dist, _ = dist.topk(5, dim=-1, largest=False)
+    assert torch.allclose(distance, expect_dist)
+    assert (index >= 0).all()
+
+
+def test_frustum_query():
+    gmap = VisualMap()
+    gmap.enable_spatial_index(0.5)
+    push_random_points(gmap, 2000)
+    assert gmap.point_index is not None
+
+    K    = torch.tensor([[50., 0., 32.], [0., 50., 24.], [0., 0., 1.]])
+    pose = pp.identity_SE3()
+    query_idx, point_idx = gmap.point_index.query_frustum(pose, K, width=64, height=48, max_depth=4.)
+    assert (query_idx == 0).all()
+
+    pos   = gmap.points.data["pos_Tw"].tensor.double()
+    depth = pos[:, 0]
+    u     = 50. * pos[:, 1] / depth + 32.
+    v     = 50. * pos[:, 2] / depth + 24.
+    expect = (depth > 0) & (depth <= 4.) & (u >= 0) & (u < 64) & (v >= 0) & (v < 48)
+    assert set(torch.nonzero(expect).flatten().tolist()) == set(point_idx.tolist())
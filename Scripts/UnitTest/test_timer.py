@@ -0,0 +1,40 @@
+import time
+
+from Utility.Timer import SpanRecorder, EventRing
+
+
+def test_nested_spans():
+    spans = SpanRecorder(capacity=16)
+    d0 = spans.begin()
+    d1 = spans.begin()
+    start = time.perf_counter_ns()
+    spans.end("inner", start, start + 1_000_000, d1)
+    spans.end("outer", start, start + 3_000_000, d0)
+    
+    result = spans.spans()
+    assert result["name"].tolist() == ["inner", "outer"]
+    assert result["depth"].tolist() == [1, 0]
+    assert spans.elapsed_ms()["outer"].tolist() == [3.0]
+
+
+def test_ring_buffer_and_merge():
+    spans = SpanRecorder(capacity=4)
+    for i in range(10): spans.end("stage", i, i + 1, spans.begin())
+    assert len(spans.spans()["name"]) == 4
+    assert spans.spans()["start_ns"].tolist() == [6, 7, 8, 9]
+    assert spans.num_calls[spans.name_index["stage"]] == 10
+    
+    worker = SpanRecorder(capacity=4)
+    worker.record("worker", 0, 5, 0, thread=1, pid=12345)
+    assert len(worker.drain()["name"]) == 1
+    assert len(worker.drain()["name"]) == 0
+    
+    worker.record("worker", 5, 10, 0, thread=1, pid=12345)
+    spans.merge(worker.drain())
+    assert spans.spans()["pid"].tolist()[-1] == 12345
+
+
+def test_gpu_event_ring():
+    ring = EventRing(capacity=4)
+    for i in range(10): ring.append(i, i + 1)     # type: ignore
+    assert ring.num_calls == 10 and list(ring.events) == [(6, 7), (7, 8), (8, 9), (9, 10)]
@@ -0,0 +1,299 @@
+import os
+import torch
+import pytest
+
+from Module.Map import VisualMap, PointNode, FrameNode, MatchObs, SharedMapReader
+
+
+def make_points(pos: torch.Tensor, cov_scale: torch.Tensor) -> PointNode:
+    return PointNode.init({
+        "pos_Tw": pos.float(),
+        "cov_Tw": torch.eye(3, dtype=torch.float64).unsqueeze(0) * cov_scale.double().view(-1, 1, 1),
+        "color" : torch.full((pos.size(0), 3), 128, dtype=torch.uint8),
+    })
+
+
+def test_map_fusion_bounded():
+    gmap = VisualMap()
+    gmap.enable_map_fusion(1.0)
+
+    pos = torch.rand((200, 3)) * 4.
+    for _ in range(5):
+        gmap.push_fused_map_points(make_points(pos + torch.randn_like(pos) * 1e-4, torch.ones(200)))
+
+    # Revisiting the same surface should not grow the map.
+    num_voxel = torch.unique(torch.floor(pos.double()), dim=0).size(0)
+    assert len(gmap.map_points) <= num_voxel + 10
+
+
+def test_map_fusion_weighted():
+    gmap = VisualMap()
+    gmap.enable_map_fusion(1.0)
+
+    new_idx = gmap.push_fused_map_points(make_points(torch.tensor([[0.2, 0.2, 0.2]]), torch.tensor([1.])))
+    assert new_idx.tolist() == [0]
+    new_idx = gmap.push_fused_map_points(make_points(torch.tensor([[0.8, 0.8, 0.8]]), torch.tensor([3.])))
+    assert new_idx.numel() == 0
+
+    # Information-weighted average: (0.2 * 1 + 0.8 * 1/3) / (1 + 1/3) = 0.35, cov = 1 / (1 + 1/3) = 0.75
+    assert torch.allclose(gmap.map_points.data["pos_Tw"][0], torch.tensor([0.35, 0.35, 0.35]))
+    assert torch.allclose(gmap.map_points.data["cov_Tw"][0], torch.eye(3, dtype=torch.float64) * 0.75)
+
+
+def test_state_dict_roundtrip():
+    gmap = VisualMap()
+    gmap.enable_spatial_index(0.5)
+    gmap.points.push(make_points(torch.rand((100, 3)), torch.ones(100)))
+    gmap.point2match.add(torch.arange(10), torch.arange(10))
+    
+    restored = VisualMap()
+    restored.load_state_dict(gmap.state_dict())
+    for k, v in gmap.serialize().items():
+        assert (restored.serialize()[k] == v).all(), f"Mismatch on {k}"
+    
+    # Restored map should keep growing (with edges and index) as the original one.
+    new_points = make_points(torch.rand((2000, 3)), torch.ones(2000))
+    for m in (gmap, restored):
+        m.points.push(new_points)
+    assert len(restored.points) == 2100 and len(restored.point2match.out_deg) == 2100
+    assert restored.point2match.edges._curr_max_size == restored.points.index._curr_max_size
+    assert restored.point_index is not None and gmap.point_index is not None
+    centers = torch.rand((4, 3))
+    for a, b in zip(restored.point_index.query_radius(centers, 0.3), gmap.point_index.query_radius(centers, 0.3)):
+        assert (a == b).all()
+
+
+def test_memory_usage():
+    gmap = VisualMap()
+    gmap.points.push(make_points(torch.rand((100, 3)), torch.ones(100)))
+    usage = gmap.memory_usage()
+    
+    assert usage["points"]["pos_Tw"] == (100 * 3 * 4, gmap.init_size * 3 * 4)
+    assert usage["points"]["cov_Tw"] == (100 * 9 * 8, gmap.init_size * 9 * 8)
+    assert usage["edge/point2match"]["edges"][0] == 100 * gmap.max_pt_obs * 8
+    assert usage["frames"]["pose"][0] == 0
+
+
+def make_frame() -> FrameNode:
+    return FrameNode.init({
+        "K": torch.eye(3).unsqueeze(0), "baseline": torch.ones(1), "pose": torch.tensor([[0., 0., 0., 0., 0., 0., 1.]]),
+        "T_BS": torch.tensor([[0., 0., 0., 0., 0., 0., 1.]]), "need_interp": torch.zeros(1, dtype=torch.bool),
+        "time_ns": torch.zeros(1, dtype=torch.long),
+    })
+
+
+def make_match(num: int) -> MatchObs:
+    gmap = VisualMap()
+    return MatchObs.init({k: torch.zeros((num, *v.shape[1:]), dtype=v.dtype) for k, v in gmap.match.data.items()})
+
+
+def test_push_frame_transaction():
+    gmap = VisualMap()
+    gmap.enable_spatial_index(0.5)
+    gmap.frames.push(make_frame())
+    
+    inserted = gmap.push_frame(make_frame(), 0, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+    assert inserted.frame_idx.tolist() == [1] and inserted.match_idx.tolist() == list(range(10))
+    assert (gmap.get_frame2match(gmap.frames[torch.tensor([0])]).index == inserted.match_idx).all()
+    assert (gmap.get_match2point(gmap.match[inserted.match_idx]).index == inserted.point_idx).all()
+    assert (gmap.match2frame2.project(inserted.match_idx) == 1).all()
+    assert gmap.point_index is not None and len(gmap.point_index) == 10
+    
+    # Failed insertion (match without required fields) leaves the map unchanged.
+    before = gmap.serialize()
+    broken = MatchObs.init({"pixel1_uv": torch.zeros((5, 2))})
+    with pytest.raises(KeyError):
+        gmap.push_frame(make_frame(), 1, make_points(torch.rand((5, 3)), torch.ones(5)), broken)
+    after = gmap.serialize()
+    assert before.keys() == after.keys() and all((before[k] == after[k]).all() for k in before)
+    assert len(gmap.point_index) == 10
+    # Optional columns materialized by the failed insertion are discarded as well.
+    broken = make_match(5)
+    broken.data["pixel2_disp"] = torch.ones((5, 1))
+    del broken.data["pixel1_uv"]
+    with pytest.raises(KeyError):
+        gmap.push_frame(make_frame(), 1, make_points(torch.rand((5, 3)), torch.ones(5)), broken)
+    assert "pixel2_disp" not in gmap.match.data and gmap.serialize().keys() == before.keys()
+    
+    # Map points of an existing frame are associated afterwards.
+    map_idx = gmap.push_map_points(inserted.frame_idx, make_points(torch.rand((4, 3)), torch.ones(4)))
+    assert map_idx.tolist() == [0, 1, 2, 3]
+    assert (gmap.get_frame2map(gmap.frames[inserted.frame_idx]).index == map_idx).all()
+
+
+def test_field_projection():
+    gmap = VisualMap()
+    gmap.frames.push(make_frame())
+    inserted = gmap.push_frame(make_frame(), 0, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+    
+    obs = gmap.get_frame2match(gmap.frames[inserted.frame_idx], ("pixel2_uv", "pixel2_d"))
+    assert set(obs.data.keys()) == {"pixel2_uv", "pixel2_d"} and (obs.index == inserted.match_idx).all()
+    pts = gmap.get_match2point(obs, ("pos_Tw",))
+    assert set(pts.data.keys()) == {"pos_Tw"}
+    assert torch.equal(pts.data["pos_Tw"], gmap.points[inserted.point_idx].data["pos_Tw"])
+
+
+def test_optional_columns():
+    gmap = VisualMap()
+    gmap.match.push(make_match(4))
+    assert "pixel2_disp" not in gmap.match.data and "match//pixel2_disp" not in gmap.serialize()
+    # Explicitly selected absent column is filled with placeholder.
+    assert (gmap.match.select(torch.arange(4), ("pixel2_disp",)).data["pixel2_disp"] == -1).all()
+    assert gmap.match.select(2, ("pixel2_disp", "pixel2_uv")).data["pixel2_disp"].shape == (1,)
+    
+    with_disp = make_match(2)
+    with_disp.data["pixel2_disp"] = torch.ones((2, 1))
+    gmap.match.push(with_disp)
+    gmap.match.push(make_match(3))
+    assert gmap.match.data["pixel2_disp"].tensor.flatten().tolist() == [-1] * 4 + [1] * 2 + [-1] * 3
+    
+    restored = VisualMap.deserialize(gmap.serialize())
+    assert "pixel2_disp" in restored.match.data and "pixel1_disp" not in restored.match.data
+    assert "pixel1_disp" in restored.match.optional
+
+
+def test_packed_cov():
+    gmap = VisualMap()
+    gmap.enable_packed_cov(torch.float32)
+    cov = torch.tensor([[2., .5, .1], [.5, 3., .2], [.1, .2, 4.]], dtype=torch.float64).repeat(10, 1, 1)
+    points = make_points(torch.rand((10, 3)), torch.ones(10))
+    points.data["cov_Tw"] = cov
+    gmap.points.push(points)
+    
+    assert gmap.points.data["cov_Tw"].tensor.shape == (10, 6)
+    assert gmap.memory_usage()["points"]["cov_Tw"] == (10 * 6 * 4, gmap.init_size * 6 * 4)
+    # Consumers still see full (float64) symmetric matrices.
+    assert torch.allclose(gmap.points[torch.arange(10)].data["cov_Tw"], cov)
+    assert torch.allclose(gmap.points.column("cov_Tw"), cov)
+    view = gmap.points.view()
+    assert view.data.keys() == gmap.points[torch.arange(10)].data.keys() and torch.allclose(view.data["cov_Tw"], cov)
+    # Absent optional columns are filled as `select` does.
+    assert (gmap.match.view(("pixel1_disp",)).data["pixel1_disp"] == -1).all()
+    
+    restored = VisualMap.deserialize(gmap.serialize())
+    assert "cov_Tw" in restored.points.packed
+    assert torch.allclose(restored.points.select(torch.tensor([3]), ("cov_Tw",)).data["cov_Tw"], cov[3:4])
+
+
+def test_compact():
+    gmap = VisualMap()
+    gmap.enable_spatial_index(0.5)
+    gmap.frames.push(make_frame())
+    first  = gmap.push_frame(make_frame(), 0, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+    second = gmap.push_frame(make_frame(), 1, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+    kept_pos = gmap.points.data["pos_Tw"].tensor[second.point_idx].clone()
+    
+    gmap.drop_matches(first.match_idx[:4])
+    remap = gmap.compact()
+    assert len(gmap.frames) == 3 and len(gmap.match) == 16 and len(gmap.points) == 16
+    assert remap.match_idx[:4].tolist() == [-1] * 4 and remap.point_idx[4:].tolist() == list(range(16))
+    assert gmap.memory_usage()["points"]["pos_Tw"] == (16 * 3 * 4, 16 * 3 * 4)
+    
+    # Edges follow the remapped rows.
+    assert gmap.get_frame2match(gmap.frames[torch.tensor([1])]).index.tolist() == list(range(16))
+    assert gmap.get_frame2match(gmap.frames[torch.tensor([2])]).index.tolist() == list(range(6, 16))
+    new_match = remap.match_idx[second.match_idx]
+    assert torch.equal(gmap.get_match2point(gmap.match[new_match]).data["pos_Tw"], kept_pos)
+    assert (gmap.point2match.out_deg.tensor == 1).all()
+    assert gmap.point_index is not None and len(gmap.point_index) == 16
+    
+    # Leading rows marked as frozen keep their index.
+    gmap.drop_matches(torch.tensor([0, 15]))
+    layout = gmap.layout
+    remap  = gmap.compact(frozen={"match": 4, "points": 4})
+    assert len(gmap.match) == 15 and remap.match_idx[:15].tolist() == list(range(15))
+    assert gmap.layout == layout + 1
+    # Dropped match in the frozen prefix stays pending until it is no longer frozen.
+    gmap.compact(frozen={"match": 4, "points": 4})
+    assert len(gmap.match) == 15 and gmap.layout == layout + 1
+    gmap.compact()
+    assert len(gmap.match) == 14 and len(gmap.dropped_match) == 0
+
+
+def test_covisibility():
+    gmap = VisualMap()
+    gmap.frames.push(make_frame())
+    gmap.push_frame(make_frame(), 0, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+    gmap.push_frame(make_frame(), 1, make_points(torch.rand((6, 3)), torch.ones(6)), make_match(6))
+    last = gmap.push_frame(make_frame(), 0, make_points(torch.rand((3, 3)), torch.ones(3)), make_match(3))
+    # Point 0 and 1 (observed by frame 0, 1) are also observed by the matches between frame 0 and 3.
+    gmap.point2match.add(torch.tensor([0, 1]), last.match_idx[:2])
+    gmap._update_covisibility(torch.tensor([0, 1]), last.match_idx[:2], sign=1)
+    
+    frames, weight = gmap.covisibility.top_k(1, k=2)
+    assert frames.tolist() == [0, 2] and weight.tolist() == [10, 6]
+    assert gmap.covisibility.weight(0, 3) == 5 and gmap.covisibility.weight(1, 3) == 2
+    assert gmap.get_covisible_frames(1, k=1, fields=("pose",)).index.tolist() == [0]
+    
+    restored = VisualMap.deserialize(gmap.serialize())
+    assert restored.covisibility.neighbors == gmap.covisibility.neighbors
+    
+    # Removing an observation only removes the covisibility it contributed.
+    gmap.drop_matches(torch.tensor([0]))
+    gmap.compact()
+    assert gmap.covisibility.weight(0, 1) == 9 and gmap.covisibility.weight(1, 3) == 1
+    assert gmap.covisibility.weight(0, 3) == 5 and len(gmap.points) == 19
+
+
+def test_changes_since():
+    gmap = VisualMap()
+    gmap.frames.push(make_frame())
+    assert len(gmap.change_logs["frames"].records) == 0     # Nothing is recorded before a consumer subscribes
+    v0 = gmap.track_changes()
+    gmap.push_frame(make_frame(), 0, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+    gmap.frames.write_column("pose", torch.tensor([0]), torch.tensor([[1., 0., 0., 0., 0., 0., 1.]]))
+    
+    delta = gmap.changes_since(v0)
+    assert not delta.reset and delta.inserted["frames"].tolist() == [1] and delta.modified["frames"].tolist() == [0]
+    assert delta.inserted["points"].tolist() == list(range(10)) and delta.modified["points"].numel() == 0
+    assert delta.inserted["map_points"].numel() == 0
+    
+    # Rows both inserted and modified after the version are reported as inserted.
+    gmap.frames.write_column("pose", torch.tensor([1]), torch.tensor([[2., 0., 0., 0., 0., 0., 1.]]))
+    assert gmap.changes_since(v0).modified["frames"].tolist() == [0]
+    assert gmap.changes_since(delta.version).modified["frames"].tolist() == [1]
+    
+    gmap.trim_changes(delta.version)
+    assert gmap.changes_since(v0).reset and not gmap.changes_since(delta.version).reset
+    gmap.compact()      # Nothing removed, deltas are still valid
+    assert not gmap.changes_since(delta.version).reset
+    gmap.drop_matches(torch.tensor([0]))
+    gmap.compact()
+    assert gmap.changes_since(delta.version).reset
+
+
+def test_shared_memory():
+    gmap = VisualMap()
+    publisher = gmap.enable_shared_memory(f"macvo_test_{os.getpid()}")
+    reader    = SharedMapReader(publisher.name)
+    try:
+        gmap.frames.push(make_frame())
+        gmap.push_frame(make_frame(), 0, make_points(torch.rand((10, 3)), torch.ones(10)), make_match(10))
+        version, data = reader.snapshot(("points/pos_Tw", "frames/pose", "edge/match2point/mapping"))
+        assert version == gmap.version and torch.equal(data["points/pos_Tw"], gmap.points.data["pos_Tw"].tensor)
+        assert data["edge/match2point/mapping"].tolist() == list(range(10))
+        
+        # Mutations that keep the storage layout do not rewrite the descriptor.
+        generation = publisher.generation
+        gmap.frames.write_column("pose", torch.tensor([0]), torch.tensor([[1., 0., 0., 0., 0., 0., 1.]]))
+        version, data = reader.snapshot(("frames/pose",))
+        assert publisher.generation == generation and version == gmap.version and data["frames/pose"][0, 0] == 1.
+        
+        # Replaced (packed) columns release their segments.
+        num_segments = len(publisher.allocator.segments)
+        gmap.enable_packed_cov(torch.float32)
+        assert len(publisher.allocator.segments) == num_segments
+        _, data = reader.snapshot(("points/cov_Tw",))
+        assert data["points/cov_Tw"].shape == (10, 6) and "points/cov_Tw" in reader.packed
+        
+        # Storage is replaced on reallocation, readers follow the new segments.
+        gmap.points.push(make_points(torch.rand((3000, 3)), torch.ones(3000)))
+        _, views = reader.views(("points/pos_Tw",))
+        assert views["points/pos_Tw"].shape == (3010, 3)
+        assert torch.equal(views["points/pos_Tw"], gmap.points.data["pos_Tw"].tensor)
+        # Segments retired by the reallocation are no longer mapped by the reader.
+        reader.snapshot()
+        assert set(reader.segments) <= set(segment.name for segment in publisher.allocator.segments.values())
+    finally:
+        reader.close()
+        publisher.close()
@@ -0,0 +1,85 @@
+import queue
+import torch
+import threading
+import typing as T
+
+from Utility.PrettyPrint import Logger
+
+
+S = T.TypeVar("S")
+
+class AsyncHookExecutor(T.Generic[S]):
+    """
+    Run a (slow) consumer function on a background thread so the caller only pays for creating a snapshot.
+
+    * `consumer`    - function that receives snapshots submitted by `submit(...)`, called in submission order.
+    * `max_pending` - maximum number of snapshots waiting to be consumed.
+    * `policy`      - what to do when `max_pending` snapshots are already waiting.
+        * "block" - `submit` waits until there is a free slot (no snapshot is lost).
+        * "drop"  - `submit` drops the new snapshot and returns immediately.
+
+    NOTE: Snapshot must not be modified by the caller after submission. CUDA tensors in snapshot are read on
+    a side stream after all work queued on the caller's stream (at submission time) is finished.
+
+    Call `close()` to consume all remaining snapshots and stop the background thread.
+    """
+    def __init__(self, consumer: T.Callable[[S,], None], max_pending: int = 8, policy: T.Literal["block", "drop"] = "block") -> None:
+        assert policy in ("block", "drop"), f"Unknown policy {policy}, expect 'block' or 'drop'."
+        assert max_pending > 0
+        self.consumer    = consumer
+        self.policy      = policy
+        self.num_dropped = 0
+        self.num_failed  = 0
+
+        self.queue : queue.Queue[tuple[S, torch.cuda.Event | None] | None] = queue.Queue(maxsize=max_pending)
+        self.stream: torch.cuda.Stream | None = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.worker = threading.Thread(target=self.__worker_loop, daemon=True, name="AsyncHookExecutor")
+        self.worker.start()
+
+    def submit(self, snapshot: S) -> bool:
+        """
+        Returns false if the snapshot is dropped (under "drop" policy), true otherwise.
+        """
+        ready = None
+        if self.stream is not None:
+            ready = torch.cuda.Event()
+            ready.record()
+
+        if self.policy == "block":
+            self.queue.put((snapshot, ready))
+            return True
+
+        try:
+            self.queue.put_nowait((snapshot, ready))
+            return True
+        except queue.Full:
+            self.num_dropped += 1
+            return False
+
+    def close(self) -> None:
+        if not self.worker.is_alive(): return
+        self.queue.put(None)
+        self.worker.join()
+        if self.num_dropped > 0:
+            Logger.write("warn", f"AsyncHookExecutor dropped {self.num_dropped} snapshots since consumer falls behind.")
+        if self.num_failed > 0:
+            Logger.write("warn", f"AsyncHookExecutor failed to consume {self.num_failed} snapshots.")
+
+    def __worker_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            snapshot, ready = item
+            try:
+                if self.stream is None:
+                    self.consumer(snapshot)
+                else:
+                    with torch.cuda.stream(self.stream):
+                        if ready is not None: ready.wait()
+                        self.consumer(snapshot)
+                    # Tensors in snapshot must outlive the kernels reading them on side stream.
+                    self.stream.synchronize()
+            except Exception as e:
+                self.num_failed += 1
+                Logger.write("warn", f"Hook failed on snapshot - {e}")
+            del snapshot, item
@@ -29,8 +29,79 @@ Github Repo: https://github.com/MarkChenYutian/AutoScalingTensor
 
 import torch
 import math
+from abc import ABC, abstractmethod
 from typing import Sequence, TYPE_CHECKING
 
+
+class GrowthPolicy(ABC):
+    """
+    Decides the new capacity (along `grow_on` dimension) of an `AutoScalingTensor` when a push does not fit.
+    """
+    @abstractmethod
+    def next_size(self, current: int, required: int) -> int:
+        """
+        Returns new capacity >= `required`, given the `current` capacity (< `required`).
+        """
+        ...
+
+
+class GeometricGrowth(GrowthPolicy):
+    """
+    Multiply the capacity by `factor` until the required size fits. `factor=2` is the original behavior.
+    Smaller factor means less slack but more reallocation (and copy) on long runs.
+    """
+    def __init__(self, factor: float = 2.) -> None:
+        assert factor > 1., "Growth factor must be larger than 1."
+        self.factor = factor
+    
+    def next_size(self, current: int, required: int) -> int:
+        size = max(current, 1)
+        while size < required: size = max(size + 1, math.ceil(size * self.factor))
+        return size
+    
+    def __repr__(self) -> str: return f"GeometricGrowth(factor={self.factor})"
+
+
+class LinearGrowth(GrowthPolicy):
+    """
+    Grow the capacity by multiple of `chunk`, slack is bounded by `chunk` rows.
+    """
+    def __init__(self, chunk: int) -> None:
+        assert chunk > 0
+        self.chunk = chunk
+    
+    def next_size(self, current: int, required: int) -> int:
+        return current + math.ceil((required - current) / self.chunk) * self.chunk
+
+    def __repr__(self) -> str: return f"LinearGrowth(chunk={self.chunk})"
+
+
+def growth_from_config(config) -> GrowthPolicy:
+    """
+    Build growth policy from config namespace with `type` in {"geometric", "linear"} and its argument
+    (`factor` or `chunk` respectively).
+    """
+    match config.type:
+        case "geometric": return GeometricGrowth(getattr(config, "factor", 2.))
+        case "linear"   : return LinearGrowth(config.chunk)
+        case other      : raise ValueError(f"Unknown growth policy {other}, expect 'geometric' or 'linear'.")
+
+
+class TensorAllocator(ABC):
+    """
+    Provides the storage of an `AutoScalingTensor` (e.g. in shared memory) instead of the default torch allocator.
+    """
+    @abstractmethod
+    def allocate(self, shape: Sequence[int], dtype: torch.dtype) -> torch.Tensor: ...
+    
+    @abstractmethod
+    def release(self, tensor: torch.Tensor) -> None:
+        """
+        Called when `tensor` (returned by `allocate`) is replaced by a new storage.
+        """
+        ...
+
+
 if TYPE_CHECKING:
     # Since extending torch.Tensor class using __torch_function__ is not supported by 
     # static type checker like MyPy and Pyright, we use this dummy class to fool the 
@@ -38,7 +109,7 @@ if TYPE_CHECKING:
     # https://github.com/pytorch/pytorch/issues/75568
     # https://github.com/pytorch/pytorch/pull/75484
     # 
-    # Due to the auto attribute delegation to torch.Tensor in the AutoScalingTensor.__getattribute__(...)
+    # Due to the auto attribute delegation to torch.Tensor in the AutoScalingTensor.__getattr__(...)
     # this version visible to type hinting actually matches all valid usages of the AutoScalingTensor
     # so there is no significant discrepency between static analysis bahavior and actual runtime result.
     class AutoScalingTensor(torch.Tensor):
@@ -47,6 +118,9 @@ if TYPE_CHECKING:
                      grow_on: int, 
                      init_tensor: torch.Tensor | None = None,
                      init_val: int | float | None = None,
+                     growth: GrowthPolicy | None = None,
+                     allocator: TensorAllocator | None = None,
+                     init_size: int = 0,
                      **kwargs) -> None: ...
         def __new__(cls, *args, **kwargs) -> "AutoScalingTensor": ...
         def push(self, x: torch.Tensor) -> None: ...
@@ -56,6 +130,20 @@ if TYPE_CHECKING:
         def _curr_max_size(self) -> int: ...
         @property
         def tensor(self) -> torch.Tensor: ...
+        def memory_usage(self) -> tuple[int, int]: ...
+        def reserve(self, capacity: int) -> None: ...
+        def shrink_to_fit(self) -> None: ...
+        def release(self) -> None: ...
+        def ensure_capacity(self, size: int) -> None: ...
+        def extend(self, num: int) -> None: ...
+        def truncate(self, size: int) -> None: ...
+        def compact(self, keep: torch.Tensor) -> None: ...
+        def set_allocator(self, allocator: TensorAllocator | None) -> None: ...
+        allocator    : TensorAllocator | None
+        growth       : GrowthPolicy
+        num_realloc  : int
+        bytes_copied : int
+        peak_alloc   : int
 else:
     class AutoScalingTensor:
         def __init__(self, 
@@ -63,42 +151,148 @@ else:
                     grow_on: int, 
                     init_tensor: torch.Tensor | None = None,
                     init_val: int | float | None = None,
+                    growth: GrowthPolicy | None = None,
+                    allocator: TensorAllocator | None = None,
+                    init_size: int = 0,
                     **kwargs
                     ) -> None:
             self.device = "cpu"
             self.grow_on = grow_on
             self.init_val = init_val
+            self.growth = GeometricGrowth(2.) if growth is None else growth
+            self.allocator: TensorAllocator | None = allocator
             self.current_size = 0
+            # Reallocation statistics, #realloc, bytes copied from old to new storage and peak allocated bytes
+            self.num_realloc  = 0
+            self.bytes_copied = 0
+            # Allocator providing the current storage (None for torch allocator), see `set_allocator`
+            self._storage_owner: TensorAllocator | None = None
             if shape is not None:
                 self._tensor = self._alloc_new_tensor(shape, **kwargs)
+                self._storage_owner = allocator
                 self._curr_max_size = shape[grow_on]
             else:
-                assert init_tensor is not None
-                self._tensor = init_tensor
+                # `init_tensor` is used as the storage, only its first `init_size` elements hold data.
+                assert init_tensor is not None and 0 <= init_size <= init_tensor.size(grow_on)
+                if allocator is not None:
+                    self._tensor = allocator.allocate(init_tensor.shape, init_tensor.dtype)
+                    self._tensor.copy_(init_tensor)
+                    self._storage_owner = allocator
+                else:
+                    self._tensor = init_tensor
                 self._curr_max_size = self._tensor.size(grow_on)
+                self.current_size = init_size
+            self.peak_alloc = self._tensor.numel() * self._tensor.element_size()
+            self._refresh_view()
         
         def _alloc_new_tensor(self, shape, **kwargs):
+            if self.allocator is not None:
+                tensor = self.allocator.allocate(shape, kwargs.get("dtype", torch.get_default_dtype()))
+                if self.init_val is not None: tensor.fill_(self.init_val)
+                return tensor
             if self.init_val is None:
                 return torch.empty(shape, device=self.device, **kwargs)
             else:
                 return torch.full(shape, fill_value=self.init_val, device=self.device, **kwargs)
         
         def _scale_up_to(self, size: int):
-            grow_to = int(2 ** math.ceil(math.log2(size + 1)))
+            self._realloc(self.growth.next_size(self._curr_max_size, size))
+        
+        def _realloc(self, capacity: int):
             orig_shape = list(self._tensor.shape)
-            orig_shape[self.grow_on] = grow_to
+            orig_shape[self.grow_on] = capacity
             
             new_storage = self._alloc_new_tensor(orig_shape, dtype=self._tensor.dtype)
-            new_storage.narrow(dim=self.grow_on, start=0, length=self.current_size).copy_(
-                self._tensor.narrow(dim=self.grow_on, start=0, length=self.current_size)
-            )
+            new_storage.narrow(dim=self.grow_on, start=0, length=self.current_size).copy_(self.tensor)
+            
+            # Both storages are alive during the copy.
+            self.peak_alloc    = max(self.peak_alloc, (self._tensor.numel() + new_storage.numel()) * self._tensor.element_size())
+            self.bytes_copied += self.tensor.numel() * self._tensor.element_size()
+            self.num_realloc  += 1
             
-            self._tensor = new_storage
-            self._curr_max_size = grow_to
+            old_storage, old_owner = self._tensor, self._storage_owner
+            self._tensor, self._storage_owner = new_storage, self.allocator
+            self._curr_max_size = capacity
+            self._refresh_view()
+            if old_owner is not None: old_owner.release(old_storage)
         
-        @property
-        def tensor(self) -> torch.Tensor:
-            return self._tensor.narrow(dim=self.grow_on, start=0, length=self.current_size)
+        def set_allocator(self, allocator: TensorAllocator | None) -> None:
+            """
+            Use `allocator` for all following storage, current content is moved to a new storage from it.
+            """
+            self.allocator = allocator
+            if self._storage_owner is not allocator: self._realloc(self._curr_max_size)
+        
+        def release(self) -> None:
+            """
+            Hand the storage back to its allocator when the tensor is discarded (e.g. a column replaced by
+            another), the tensor must not be used afterwards.
+            """
+            if self._storage_owner is not None: self._storage_owner.release(self._tensor)
+            self._storage_owner = None
+        
+        def reserve(self, capacity: int) -> None:
+            """
+            Preallocate storage to hold at least `capacity` elements, avoids reallocation when final size is known.
+            """
+            if capacity > self._curr_max_size: self._realloc(capacity)
+        
+        def shrink_to_fit(self) -> None:
+            """
+            Release the capacity slack. Following push will grow the storage again with the growth policy.
+            """
+            if self._curr_max_size > self.current_size: self._realloc(max(self.current_size, 1))
+        
+        def ensure_capacity(self, size: int) -> None:
+            """
+            Grow the storage (with growth policy) so that `size` elements fit without further reallocation.
+            """
+            if size > self._curr_max_size: self._scale_up_to(size)
+        
+        def extend(self, num: int) -> None:
+            """
+            Append `num` elements filled with `init_val`, without creating a temporary tensor to push.
+            """
+            assert self.init_val is not None, "extend(...) requires init_val."
+            self.ensure_capacity(self.current_size + num)
+            self._tensor.narrow(dim=self.grow_on, start=self.current_size, length=num).fill_(self.init_val)
+            self.current_size += num
+            self._refresh_view()
+        
+        def truncate(self, size: int) -> None:
+            """
+            Drop all elements after the first `size` ones. Storage is kept for following push.
+            """
+            assert 0 <= size <= self.current_size
+            self.current_size = size
+            self._refresh_view()
+        
+        def compact(self, keep: torch.Tensor) -> None:
+            """
+            Keep only elements where boolean mask `keep` (of current size) is true, preserving their order.
+            Elements are moved in-place, so everything before the first removed element is left untouched.
+            """
+            assert keep.size(0) == self.current_size
+            removed = torch.nonzero(~keep).flatten()
+            if removed.numel() == 0: return
+            start = int(removed[0].item())
+            kept  = self.tensor.narrow(self.grow_on, start, self.current_size - start)\
+                               .index_select(self.grow_on, torch.nonzero(keep[start:]).flatten())
+            self._tensor.narrow(dim=self.grow_on, start=start, length=kept.size(self.grow_on)).copy_(kept)
+            self.current_size = start + kept.size(self.grow_on)
+            self._refresh_view()
+        
+        def _refresh_view(self) -> None:
+            # `tensor` is a plain attribute (instead of a property creating new view on every access) so reading
+            # it costs a dict lookup only. Must be refreshed whenever storage or current_size changes.
+            self.tensor: torch.Tensor = self._tensor.narrow(dim=self.grow_on, start=0, length=self.current_size)
+        
+        def memory_usage(self) -> tuple[int, int]:
+            """
+            Returns (used, allocated) bytes, the difference is the capacity slack reserved for future push.
+            """
+            element_size = self._tensor.element_size()
+            return self.tensor.numel() * element_size, self._tensor.numel() * element_size
         
         def __repr__(self) -> str:
             return f"AutoScalingTensor(alloc={self._curr_max_size}, actual={self.current_size}, \n\tdata={self.tensor}\n)"
@@ -106,12 +300,12 @@ else:
         def push(self, x: torch.Tensor) -> None:
             data_size = x.size(self.grow_on)
             
-            if self.current_size + data_size >= self._curr_max_size:
-                self._scale_up_to(self.current_size + data_size)
-            assert self.current_size < self._curr_max_size
+            self.ensure_capacity(self.current_size + data_size)
+            assert self.current_size + data_size <= self._curr_max_size
             
             self._tensor.narrow(dim=self.grow_on, start=self.current_size, length=data_size).copy_(x, non_blocking=True)
             self.current_size += data_size
+            self._refresh_view()
         
         @classmethod
         def __torch_function__(cls, func, types, args=(), kwargs=None):
@@ -121,15 +315,12 @@ else:
             return func(*args, **kwargs)
 
         # A further enhancement - we want AutoScale to behave exactly like the tensor it contains
-        def __getattribute__(self, name: str):
-            if name in {'_tensor', 'tensor', 'push', '__class__'}:
-                return object.__getattribute__(self, name)
-            try:
-                return object.__getattribute__(self, name)
-            except AttributeError:
-                # If it's not a class attribute, delegate to the tensor
-                tensor = object.__getattribute__(self, 'tensor')
-                return getattr(tensor, name)
+        # NOTE: __getattr__ is only called when normal lookup fails, so own attributes (tensor, push, ...) 
+        # are resolved without any Python-level dispatch and only tensor attributes pay for the delegation.
+        def __getattr__(self, name: str):
+            if name in {'_tensor', 'tensor'}:   # Not initialized yet (e.g. during copy / unpickle)
+                raise AttributeError(name)
+            return getattr(self.tensor, name)
 
         # Magic methods cannot be forwarded automatically, so has to do this
         def __getitem__(self, slice): return self.tensor.__getitem__(slice)
@@ -20,7 +20,12 @@ class ConfigTestable:
                               " Could not test if the config is valid or not (assume valid)")
 
     @staticmethod
-    def _enforce_config_spec(config: SimpleNamespace | T_ConfigValue, spec: T_ConfigSpec, allow_excessive_cfg: bool=False):
+    def _enforce_config_spec(config: SimpleNamespace | T_ConfigValue, spec: T_ConfigSpec, allow_excessive_cfg: bool=False,
+                             optional_spec: dict[str, T_ConfigSpec] | None = None):
+        """
+        Check `config` against `spec`. Keys in `optional_spec` may be omitted from the config, but are 
+        checked against their specification when present.
+        """
         if not isinstance(spec, dict):
             is_valid = spec(config)
             if not is_valid:
@@ -34,8 +39,13 @@ class ConfigTestable:
                 raise KeyError(f"Config does not match specification! (expect to have key {key} but did not found)")
             ConfigTestable._enforce_config_spec(config.__dict__[key], test_fn)
         
+        optional_spec = dict() if optional_spec is None else optional_spec
+        for key, test_fn in optional_spec.items():
+            if key not in config.__dict__: continue
+            ConfigTestable._enforce_config_spec(config.__dict__[key], test_fn)
+        
         if not allow_excessive_cfg:
-            spec_keys = spec.keys()
-            cfg_keys  = dict(**vars(config)).keys()
+            spec_keys = set(spec.keys()) | set(optional_spec.keys())
+            cfg_keys  = set(vars(config).keys())
             
-            if len(spec_keys) != len(cfg_keys): raise KeyError(f"Excessive Keys: {set(cfg_keys) - set(spec_keys)} from {list(spec_keys)}")
+            if not cfg_keys.issubset(spec_keys): raise KeyError(f"Excessive Keys: {cfg_keys - spec_keys} from {list(spec_keys)}")
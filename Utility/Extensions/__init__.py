@@ -1,10 +1,11 @@
 from types import SimpleNamespace
-from .TensorExtension import AutoScalingTensor, TensorQueue
+from .TensorExtension import AutoScalingTensor, TensorQueue, GrowthPolicy, GeometricGrowth, LinearGrowth, growth_from_config, TensorAllocator
 from .Testable import ConfigTestable
 from .SubclassRegistry import SubclassRegistry
 from .Chain import Chain
 from .OnCallCompiler import OnCallCompiler
 from .GridRecorder import GridRecorder
+from .AsyncHook import AsyncHookExecutor
 
 # A mixin class between two traits - SubclassRegistry (dynamic reflection) and ConfigTestable
 class ConfigTestableSubclass(SubclassRegistry, ConfigTestable):
@@ -159,3 +159,39 @@ def MahalanobisDist_Inv(x: torch.Tensor, mu: torch.Tensor, sigma_inv: torch.Tens
         dist     : torch.Tensor of shape N x 1
     """
     return torch.bmm(torch.bmm((x - mu).unsqueeze(1), sigma_inv), (x - mu).unsqueeze(2)).sqrt()
+
+
+def pack_symmetric(mat: torch.Tensor) -> torch.Tensor:
+    """
+    Argument
+        mat     : torch.Tensor of shape ... x D x D, symmetric
+    Returns
+        packed  : torch.Tensor of shape ... x D(D+1)/2, upper-triangular entries in row-major order
+                  (e.g. D=3 => [xx, xy, xz, yy, yz, zz])
+    """
+    rows, cols = torch.triu_indices(mat.size(-1), mat.size(-1), device=mat.device)
+    return mat[..., rows, cols]
+
+
+def unpack_symmetric(packed: torch.Tensor, dim: int) -> torch.Tensor:
+    """
+    Inverse of `pack_symmetric`.
+    Argument
+        packed  : torch.Tensor of shape ... x D(D+1)/2
+        dim     : D
+    Returns
+        mat     : torch.Tensor of shape ... x D x D
+    """
+    rows, cols = torch.triu_indices(dim, dim, device=packed.device)
+    mat = packed.new_empty((*packed.shape[:-1], dim, dim))
+    mat[..., rows, cols] = packed
+    mat[..., cols, rows] = packed
+    return mat
+
+
+def packed_diagonal(packed: torch.Tensor, dim: int) -> torch.Tensor:
+    """
+    Diagonal entries (... x D) of symmetric matrices packed by `pack_symmetric`, without unpacking.
+    """
+    rows, cols = torch.triu_indices(dim, dim, device=packed.device)
+    return packed[..., rows == cols]
@@ -1,178 +1,263 @@
 import torch
+import h5py
 import numpy as np
 import pandas as pd
-import os
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, Optional
 
 from DataLoader import StereoFrame
 from Module.Frontend.Matching import IMatcher
 from Module.Frontend.StereoDepth import IStereoDepth
 from Utility.PrettyPrint import Logger
+from Utility.Math import packed_diagonal
 
 
 class FrameMetricsCollector:
     """
     Collects per-frame metrics during MAC-VO execution and saves them to a CSV file.
-    
+
     This class records metrics related to:
     - Flow quality and uncertainty
     - Stereo matching quality and uncertainty
     - 3D point uncertainty
     - Point filtering statistics
+
+    To keep the overhead low on long runs
+    - All statistics of a frame are computed on device and moved to host in a single transfer.
+    - Only every `sample_every` frame (and optionally only keyframes) is recorded.
+    - Rows are buffered in a fixed-size array and appended to `frame_metrics.h5` (one dataset per column)
+      every `flush_every` rows, so memory stays constant. `frame_metrics.csv` is exported on `save_metrics`.
     """
-    
-    def __init__(self, output_dir: Path):
+    COLUMNS = (
+        "frame_idx", "timestamp",
+        "flow_magnitude_mean", "flow_magnitude_std", "flow_coverage",
+        "flow_uncertainty_mean", "flow_uncertainty_std",
+        "depth_mean", "depth_std", "depth_coverage",
+        "disparity_mean", "disparity_std",
+        "disparity_uncertainty_mean", "disparity_uncertainty_std", "disparity_uncertainty_min", "disparity_uncertainty_max",
+        "depth_uncertainty_mean", "depth_uncertainty_std",
+        "point3d_uncertainty_mean", "point3d_uncertainty_std",
+        "initial_point_count", "final_point_count", "rejection_rate",
+    )
+
+    def __init__(self, output_dir: Path, sample_every: int = 1, keyframe_only: bool = False, flush_every: int = 64,
+                 resume: bool = False):
         """
         Initialize the metrics collector.
-        
+
         Args:
             output_dir: Directory where metrics will be saved
+            sample_every: Record metrics every N frames
+            keyframe_only: Only record metrics on keyframes
+            flush_every: Number of rows buffered in memory before appending to file
+            resume: Append to the metrics of a run resumed from checkpoint. Rows recorded after the checkpoint
+                    (from the first frame recorded again onward) are dropped, otherwise an existing file is replaced.
         """
-        self.metrics: List[Dict[str, Any]] = []
-        self.output_dir = output_dir
-        self.output_path = output_dir / "frame_metrics.csv"
+        assert sample_every > 0 and flush_every > 0
+        self.output_dir    = output_dir
+        self.output_path   = output_dir / "frame_metrics.csv"
+        self.stream_path   = output_dir / "frame_metrics.h5"
+        self.sample_every  = sample_every
+        self.keyframe_only = keyframe_only
+
+        self.buffer     = np.full((flush_every, len(self.COLUMNS)), np.nan, dtype=np.float64)
+        self.num_buffer = 0
+        self.num_rows   = 0
+        self.column_idx = {name: idx for idx, name in enumerate(self.COLUMNS)}
+
+        # Running (count, mean, M2) of covariance trace over 3D points. Traces of points added on frames that
+        # are not recorded are reduced on device and kept until the next recorded frame.
+        self.point3d_agg    = (0, 0., 0.)
+        self.point3d_pending: list[torch.Tensor] = []
+
+        self.stream = h5py.File(self.stream_path, "a" if resume else "w")
+        for name in self.COLUMNS:
+            if name not in self.stream:
+                self.stream.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(1024,))
+        self.num_rows = self.stream[self.COLUMNS[0]].shape[0]   # Non-zero if appending to a resumed run.
+        # Rows of the resumed run at or after the first frame recorded again are truncated on that frame.
+        self.truncate_pending = resume
         Logger.write("info", f"Frame metrics will be saved to {self.output_path}")
-    
-    def record_frame_metrics(self, 
+
+    def record_frame_metrics(self,
                            frame_idx: int,
                            timestamp: float,
                            frame: StereoFrame,
                            flow_data: Optional[IMatcher.Output] = None,
                            stereo_data: Optional[IStereoDepth.Output] = None,
                            point3d_covs: Optional[torch.Tensor] = None,
-                           filtering_stats: Optional[Dict[str, int]] = None):
+                           filtering_stats: Optional[Dict[str, int]] = None,
+                           is_keyframe: bool = True,
+                           point3d_reset: bool = False):
         """
         Record metrics for a single frame.
-        
+
         Args:
             frame_idx: Index of the current frame
             timestamp: Timestamp of the current frame
             frame: The stereo frame being processed
             flow_data: Flow and uncertainty data from the frontend
             stereo_data: Stereo depth and uncertainty data from the frontend
-            point3d_covs: 3D covariance matrices for tracked points
+            point3d_covs: 3D covariance matrices (Nx3x3, or packed Nx6) of points added since the previous call
             filtering_stats: Statistics about point filtering
+            is_keyframe: Whether the current frame is a keyframe
+            point3d_reset: Points are renumbered (e.g. map compaction), `point3d_covs` covers all points and
+                           statistics of previous calls are discarded
         """
-        metrics = {
-            "frame_idx": frame_idx,
-            "timestamp": timestamp,
-        }
-        
-        # Flow metrics
-        if flow_data is not None and flow_data.flow is not None:
+        if self.truncate_pending: self.truncate(frame_idx)
+        if point3d_reset: self.point3d_agg, self.point3d_pending = (0, 0., 0.), []
+        if point3d_covs is not None and point3d_covs.size(0) > 0:
             with torch.no_grad():
-                flow = flow_data.flow
-                # Calculate flow magnitude (ignoring NaNs)
-                valid_flow = ~torch.isnan(flow)
-                if valid_flow.any():
-                    # Handle B x 2 x H x W format
-                    # Reshape to make it easier to process
-                    B, C, H, W = flow.shape
-                    flow_reshaped = flow.permute(0, 2, 3, 1).reshape(-1, 2)  # Reshape to (B*H*W, 2)
-                    valid_mask = valid_flow.permute(0, 2, 3, 1).reshape(-1, 2).all(dim=1)  # Reshape to (B*H*W)
-                    
-                    if valid_mask.any():
-                        flow_magnitude = torch.norm(flow_reshaped[valid_mask], dim=1)
-                        metrics.update({
-                            "flow_magnitude_mean": float(flow_magnitude.mean().item()),
-                            "flow_magnitude_std": float(flow_magnitude.std().item()),
-                            "flow_coverage": float(valid_mask.float().mean().item()),
-                        })
-                
-                # Flow uncertainty
+                if point3d_covs.dim() == 2:     # Packed upper-triangular storage (see VisualMap.enable_packed_cov)
+                    self.point3d_pending.append(packed_diagonal(point3d_covs, 3).double().sum(dim=1))
+                else:
+                    self.point3d_pending.append(torch.diagonal(point3d_covs, dim1=1, dim2=2).double().sum(dim=1))
+        if frame_idx % self.sample_every != 0: return
+        if self.keyframe_only and not is_keyframe: return
+
+        row = np.full((len(self.COLUMNS),), np.nan, dtype=np.float64)
+        row[self.column_idx["frame_idx"]] = frame_idx
+        row[self.column_idx["timestamp"]] = timestamp
+
+        # Reductions of each source are collected as device tensors, then transfered together.
+        names : list[str] = []
+        values: list[torch.Tensor] = []
+        def collect(prefix: str, x: torch.Tensor, valid: torch.Tensor, fields: tuple[str, ...]):
+            stats = self._masked_stats(x, valid)
+            for field in fields:
+                names.append(f"{prefix}_{field}" if prefix else field)
+                values.append(stats[field])
+
+        with torch.no_grad():
+            if flow_data is not None and flow_data.flow is not None:
+                flow  = flow_data.flow
+                valid = ~torch.isnan(flow).any(dim=1)       # B x H x W
+                collect("flow_magnitude", torch.nan_to_num(flow).norm(dim=1), valid, ("mean", "std"))
+                names.append("flow_coverage")
+                values.append(valid.double().mean())
+
                 if flow_data.cov is not None:
-                    cov = flow_data.cov
-                    valid_cov = ~torch.isnan(cov)
-                    if valid_cov.any():
-                        # Handle B x 3 x H x W format
-                        B, C, H, W = cov.shape
-                        cov_reshaped = cov.reshape(B, C, -1)  # Reshape to (B, 3, H*W)
-                        valid_mask = valid_cov.reshape(B, C, -1).any(dim=1)  # Reshape to (B, H*W)
-                        
-                        if valid_mask.any():
-                            metrics.update({
-                                "flow_uncertainty_mean": float(cov_reshaped[valid_cov.reshape(B, C, -1)].mean().item()),
-                                "flow_uncertainty_std": float(cov_reshaped[valid_cov.reshape(B, C, -1)].std().item()),
-                            })
-        
-        # Stereo metrics
-        if stereo_data is not None:
-            with torch.no_grad():
-                # Depth metrics
+                    collect("flow_uncertainty", flow_data.cov, ~torch.isnan(flow_data.cov), ("mean", "std"))
+
+            if stereo_data is not None:
                 if stereo_data.depth is not None:
-                    depth = stereo_data.depth
-                    valid_depth = ~torch.isnan(depth)
-                    if valid_depth.any():
-                        metrics.update({
-                            "depth_mean": float(depth[valid_depth].mean().item()),
-                            "depth_std": float(depth[valid_depth].std().item()),
-                            "depth_coverage": float(valid_depth.float().mean().item()),
-                        })
-                
-                # Disparity metrics
+                    valid = ~torch.isnan(stereo_data.depth)
+                    collect("depth", stereo_data.depth, valid, ("mean", "std"))
+                    names.append("depth_coverage")
+                    values.append(valid.double().mean())
                 if stereo_data.disparity is not None:
-                    disparity = stereo_data.disparity
-                    valid_disp = ~torch.isnan(disparity)
-                    if valid_disp.any():
-                        metrics.update({
-                            "disparity_mean": float(disparity[valid_disp].mean().item()),
-                            "disparity_std": float(disparity[valid_disp].std().item()),
-                        })
-                
-                # Disparity uncertainty
-                if hasattr(stereo_data, 'disparity_uncertainty') and stereo_data.disparity_uncertainty is not None:
-                    disp_uncertainty = stereo_data.disparity_uncertainty
-                    valid_uncertainty = ~torch.isnan(disp_uncertainty)
-                    if valid_uncertainty.any():
-                        metrics.update({
-                            "disparity_uncertainty_mean": float(disp_uncertainty[valid_uncertainty].mean().item()),
-                            "disparity_uncertainty_std": float(disp_uncertainty[valid_uncertainty].std().item()),
-                            "disparity_uncertainty_min": float(disp_uncertainty[valid_uncertainty].min().item()),
-                            "disparity_uncertainty_max": float(disp_uncertainty[valid_uncertainty].max().item()),
-                        })
-                
-                # Depth uncertainty
+                    collect("disparity", stereo_data.disparity, ~torch.isnan(stereo_data.disparity), ("mean", "std"))
+                if getattr(stereo_data, "disparity_uncertainty", None) is not None:
+                    disp_unc = stereo_data.disparity_uncertainty
+                    collect("disparity_uncertainty", disp_unc, ~torch.isnan(disp_unc), ("mean", "std", "min", "max"))
                 if stereo_data.cov is not None:
-                    depth_cov = stereo_data.cov
-                    valid_cov = ~torch.isnan(depth_cov)
-                    if valid_cov.any():
-                        metrics.update({
-                            "depth_uncertainty_mean": float(depth_cov[valid_cov].mean().item()),
-                            "depth_uncertainty_std": float(depth_cov[valid_cov].std().item()),
-                        })
-        
-        # 3D point uncertainty
-        if point3d_covs is not None:
-            with torch.no_grad():
-                valid_covs = ~torch.isnan(point3d_covs).any(dim=(1, 2))
-                if valid_covs.any():
-                    # Calculate trace of covariance matrices (sum of diagonal elements)
-                    cov_traces = torch.diagonal(point3d_covs[valid_covs], dim1=1, dim2=2).sum(dim=1)
-                    metrics.update({
-                        "point3d_uncertainty_mean": float(cov_traces.mean().item()),
-                        "point3d_uncertainty_std": float(cov_traces.std().item()),
-                    })
-        
+                    collect("depth_uncertainty", stereo_data.cov, ~torch.isnan(stereo_data.cov), ("mean", "std"))
+
+            has_new_point3d = len(self.point3d_pending) > 0
+            if has_new_point3d:
+                traces = torch.cat(self.point3d_pending)
+                self.point3d_pending = []
+                collect("point3d", traces, ~torch.isnan(traces), ("count", "mean", "m2"))
+
+            # Single host transfer (tensors on host are moved to the device first, which does not synchronize)
+            if len(values) > 0:
+                device = next((v.device for v in values if v.device.type != "cpu"), torch.device("cpu"))
+                host   = torch.stack([v.to(device) for v in values]).cpu().numpy()
+            else:
+                host   = np.zeros((0,))
+
+        result = dict(zip(names, host.tolist()))
+        if has_new_point3d:
+            self.point3d_agg = self._combine(self.point3d_agg, (result.pop("point3d_count"), result.pop("point3d_mean"), result.pop("point3d_m2")))
+        count, mean, m2 = self.point3d_agg
+        if count > 0:
+            row[self.column_idx["point3d_uncertainty_mean"]] = mean
+            row[self.column_idx["point3d_uncertainty_std"]]  = np.sqrt(m2 / (count - 1)) if count > 1 else np.nan
+
+        for name, value in result.items():
+            row[self.column_idx[name]] = value
+
         # Filtering statistics
         if filtering_stats is not None:
-            metrics.update({
-                "initial_point_count": filtering_stats.get("initial_count", 0),
-                "final_point_count": filtering_stats.get("final_count", 0),
-                "rejection_rate": 1.0 - (filtering_stats.get("final_count", 0) / max(filtering_stats.get("initial_count", 1), 1)),
-            })
-        
-        self.metrics.append(metrics)
-    
+            initial_count = filtering_stats.get("initial_count", 0)
+            final_count   = filtering_stats.get("final_count", 0)
+            row[self.column_idx["initial_point_count"]] = initial_count
+            row[self.column_idx["final_point_count"]]   = final_count
+            row[self.column_idx["rejection_rate"]]      = 1.0 - (final_count / max(initial_count, 1))
+
+        self.buffer[self.num_buffer] = row
+        self.num_buffer += 1
+        if self.num_buffer == self.buffer.shape[0]: self.flush()
+
+    def truncate(self, frame_idx: int):
+        """Drop stored rows of frame `frame_idx` and later (e.g. recorded after the checkpoint of a resumed run)."""
+        self.truncate_pending = False
+        self.flush()
+        keep = int(np.searchsorted(self.stream["frame_idx"][:], frame_idx, side="left"))
+        if keep == self.num_rows: return
+        for name in self.COLUMNS: self.stream[name].resize((keep,))
+        self.stream.flush()
+        self.num_rows = keep
+
+    def flush(self):
+        """Append buffered rows to the columnar file."""
+        if self.num_buffer == 0: return
+        start, end = self.num_rows, self.num_rows + self.num_buffer
+        for idx, name in enumerate(self.COLUMNS):
+            dataset = self.stream[name]
+            dataset.resize((end,))
+            dataset[start:end] = self.buffer[:self.num_buffer, idx]
+        self.stream.flush()
+        self.num_rows   = end
+        self.num_buffer = 0
+
     def save_metrics(self):
-        """Save collected metrics to a CSV file."""
-        if not self.metrics:
+        """Flush remaining rows and export all collected metrics to a CSV file."""
+        self.flush()
+        if self.num_rows == 0:
             Logger.write("warn", "No metrics to save")
             return
-        
+
         try:
-            df = pd.DataFrame(self.metrics)
+            df = pd.DataFrame({name: self.stream[name][:] for name in self.COLUMNS})
+            df = df.astype({"frame_idx": np.int64}).dropna(axis=1, how="all")
             df.to_csv(self.output_path, index=False)
-            Logger.write("info", f"Saved {len(self.metrics)} frame metrics to {self.output_path}")
+            Logger.write("info", f"Saved {self.num_rows} frame metrics to {self.output_path}")
         except Exception as e:
             Logger.write("error", f"Failed to save metrics: {e}")
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+    @staticmethod
+    def _masked_stats(x: torch.Tensor, valid: torch.Tensor) -> dict[str, torch.Tensor]:
+        """
+        Mean, (unbiased) std, min, max, count and M2 (sum of squared deviation) of x[valid], all as 0-dim
+        tensors on the device of x (NaN if there is no valid element). Does not synchronize with host.
+        """
+        x       = x.double()
+        count   = valid.sum().double()
+        zeroed  = torch.where(valid, x, torch.zeros_like(x))
+        mean    = zeroed.sum() / count
+        m2      = torch.where(valid, (x - mean).square(), torch.zeros_like(x)).sum()
+        inf     = torch.tensor(torch.inf, dtype=x.dtype, device=x.device)
+        return {
+            "count": count,
+            "mean" : mean,
+            "m2"   : m2,
+            "std"  : (m2 / (count - 1)).sqrt(),
+            "min"  : torch.where(valid, x, inf).min().where(count > 0, torch.nan),
+            "max"  : torch.where(valid, x, -inf).max().where(count > 0, torch.nan),
+        }
+
+    @staticmethod
+    def _combine(agg_a: tuple[float, float, float], agg_b: tuple[float, float, float]) -> tuple[float, float, float]:
+        """Combine two (count, mean, M2) aggregates (Chan et al. parallel variance)."""
+        n_a, mean_a, m2_a = agg_a
+        n_b, mean_b, m2_b = agg_b
+        if n_b == 0: return agg_a
+        if n_a == 0: return agg_b
+        n     = n_a + n_b
+        delta = mean_b - mean_a
+        return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
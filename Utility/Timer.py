@@ -1,24 +1,142 @@
+import os
 import math
-import torch
+import json
 import time
+import torch
+import threading
+import numpy as np
 from pathlib import Path
 from typing import ClassVar
 from functools import wraps
+from collections import deque
 from contextlib import contextmanager
 
 from Utility.PrettyPrint import Logger
 
 T_CUDAEvent = torch._C._CudaEventBase
 
+
+class SpanRecorder:
+    """
+    Records (possibly nested) CPU spans into a preallocated ring buffer. When the buffer is full, the
+    oldest spans are overwritten, so memory stays constant on long runs while the call count of each
+    span name is kept exactly.
+    
+    Time is measured by `time.perf_counter_ns` (monotonic clock shared by all processes on the machine),
+    so spans recorded in child processes can be merged into the same timeline.
+    """
+    def __init__(self, capacity: int) -> None:
+        self.capacity  = capacity
+        self.start_ns  = np.zeros((capacity,), dtype=np.int64)
+        self.end_ns    = np.zeros((capacity,), dtype=np.int64)
+        self.name_id   = np.zeros((capacity,), dtype=np.int32)
+        self.depth     = np.zeros((capacity,), dtype=np.int16)
+        self.thread    = np.zeros((capacity,), dtype=np.int64)
+        self.pid       = np.zeros((capacity,), dtype=np.int32)
+        
+        self.names     : list[str]      = []
+        self.name_index: dict[str, int] = dict()
+        self.num_calls : list[int]      = []
+        self.num_total = 0      # Total number of spans ever recorded (including overwritten ones)
+        self.num_drain = 0      # Spans before this are already returned by `drain`
+        
+        self.lock  = threading.Lock()
+        self.local = threading.local()
+    
+    def __intern(self, name: str) -> int:
+        name_id = self.name_index.get(name)
+        if name_id is None:
+            name_id = self.name_index[name] = len(self.names)
+            self.names.append(name)
+            self.num_calls.append(0)
+        return name_id
+    
+    def begin(self) -> int:
+        """
+        Enter a span on current thread, returns the nesting depth of the span.
+        """
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        return depth
+    
+    def end(self, name: str, start_ns: int, end_ns: int, depth: int) -> None:
+        self.local.depth = depth
+        self.record(name, start_ns, end_ns, depth, threading.get_ident(), os.getpid())
+    
+    def record(self, name: str, start_ns: int, end_ns: int, depth: int, thread: int, pid: int) -> None:
+        with self.lock:
+            name_id = self.__intern(name)
+            slot    = self.num_total % self.capacity
+            self.start_ns[slot], self.end_ns[slot] = start_ns, end_ns
+            self.name_id[slot], self.depth[slot]   = name_id, depth
+            self.thread[slot], self.pid[slot]      = thread, pid
+            self.num_calls[name_id] += 1
+            self.num_total += 1
+    
+    def spans(self, since: int = 0) -> dict[str, np.ndarray]:
+        """
+        Returns spans still in the buffer (recorded after the `since`-th span) in recording order.
+        """
+        with self.lock:
+            begin = max(since, self.num_total - self.capacity)
+            slots = np.arange(begin, self.num_total) % self.capacity
+            return {
+                "name"    : np.array([self.names[i] for i in self.name_id[slots]], dtype=object),
+                "start_ns": self.start_ns[slots].copy(),
+                "end_ns"  : self.end_ns[slots].copy(),
+                "depth"   : self.depth[slots].copy(),
+                "thread"  : self.thread[slots].copy(),
+                "pid"     : self.pid[slots].copy(),
+            }
+    
+    def drain(self) -> dict[str, np.ndarray]:
+        """
+        Returns spans recorded since last drain, used to ship spans from a child process to the main process.
+        """
+        result = self.spans(since=self.num_drain)
+        self.num_drain = self.num_total
+        return result
+    
+    def merge(self, spans: dict[str, np.ndarray]) -> None:
+        for name, start, end, depth, thread, pid in zip(*(spans[k] for k in ("name", "start_ns", "end_ns", "depth", "thread", "pid"))):
+            self.record(str(name), int(start), int(end), int(depth), int(thread), int(pid))
+    
+    def elapsed_ms(self) -> dict[str, np.ndarray]:
+        spans   = self.spans()
+        elapsed = (spans["end_ns"] - spans["start_ns"]) / 1e6
+        return {name: elapsed[spans["name"] == name] for name in self.names}
+
+
+class EventRing:
+    """
+    (start, end) CUDA events of the most recent `capacity` spans of a name, the oldest pair is dropped when
+    the ring is full while the call count is kept exactly (same policy as `SpanRecorder`).
+    """
+    def __init__(self, capacity: int) -> None:
+        self.events   : deque[tuple[T_CUDAEvent, T_CUDAEvent]] = deque(maxlen=capacity)
+        self.num_calls = 0
+    
+    def append(self, start: T_CUDAEvent, end: T_CUDAEvent) -> None:
+        self.events.append((start, end))
+        self.num_calls += 1
+
+
 class Timer:
     ACTIVE: ClassVar[bool] = False
-    CPU_TIME_STREAM: ClassVar[dict[str, tuple[list[float], list[float]]]] = dict()
-    GPU_TIME_STREAM: ClassVar[dict[str, tuple[list[T_CUDAEvent], list[T_CUDAEvent]]]] = dict()
+    SPANS : ClassVar[SpanRecorder] = SpanRecorder(1 << 16)
+    GPU_TIME_STREAM: ClassVar[dict[str, EventRing]] = dict()
     GPU_STREAMS: ClassVar[set[torch.cuda.Stream]] = set()
 
     @classmethod
-    def setup(cls, active: bool):
+    def setup(cls, active: bool, capacity: int | None = None):
+        """
+        * `capacity` - number of most recent CPU spans (and GPU spans of each name) kept for percentile report
+                       and trace export.
+        """
         cls.ACTIVE = active
+        if capacity is not None:
+            cls.SPANS = SpanRecorder(capacity)
+            cls.GPU_TIME_STREAM.clear()
         if active: Logger.write("info", "Timer is set to active.")
 
     @classmethod
@@ -27,14 +145,12 @@ class Timer:
             @wraps(func)
             def wrapped(*args, **kwargs):
                 if not cls.ACTIVE: return func(*args, **kwargs)
-                time_stream = cls.CPU_TIME_STREAM.get(name, ([], []))
-                
-                time_stream[0].append(time.time() * 1000)
-                result = func(*args, **kwargs)
-                time_stream[1].append(time.time() * 1000)
-                
-                cls.CPU_TIME_STREAM[name] = time_stream
-                return result
+                depth = cls.SPANS.begin()
+                start = time.perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    cls.SPANS.end(name, start, time.perf_counter_ns(), depth)
             return wrapped
         return decorator
 
@@ -45,13 +161,10 @@ class Timer:
             def wrapped(*args, **kwargs):
                 if not cls.ACTIVE: return func(*args, **kwargs)
                 stream = torch.cuda.current_stream()
-                time_stream = cls.GPU_TIME_STREAM.get(name, ([], []))
                 start_event = torch.cuda.Event(enable_timing=True, blocking=False, interprocess=False)
                 end_event   = torch.cuda.Event(enable_timing=True, blocking=False, interprocess=False)
-                time_stream[0].append(start_event)
-                time_stream[1].append(end_event)
+                cls.gpu_ring(name).append(start_event, end_event)
                 cls.GPU_STREAMS.add(stream)
-                cls.GPU_TIME_STREAM[name] = time_stream
                 
                 start_event.record(stream)
                 result = func(*args, **kwargs)
@@ -67,11 +180,12 @@ class Timer:
         if not cls.ACTIVE:
             yield
             return
-        time_stream = cls.CPU_TIME_STREAM.get(name, ([], []))
-        time_stream[0].append(time.time())
-        yield
-        time_stream[1].append(time.time())
-        cls.CPU_TIME_STREAM[name] = time_stream
+        depth = cls.SPANS.begin()
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            cls.SPANS.end(name, start, time.perf_counter_ns(), depth)
 
     @classmethod
     @contextmanager
@@ -80,14 +194,43 @@ class Timer:
             yield
             return
         cls.GPU_STREAMS.add(stream)
-        time_stream = cls.GPU_TIME_STREAM.get(name, ([], []))
-        time_stream[0].append(start_event := torch.cuda.Event(enable_timing=True))
-        time_stream[1].append(end_event   := torch.cuda.Event(enable_timing=True))
+        start_event, end_event = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        cls.gpu_ring(name).append(start_event, end_event)
         
         start_event.record(stream)
         yield
         end_event.record(stream)
-        cls.GPU_TIME_STREAM[name] = time_stream
+
+    @classmethod
+    def gpu_ring(cls, name: str) -> EventRing:
+        ring = cls.GPU_TIME_STREAM.get(name)
+        if ring is None: ring = cls.GPU_TIME_STREAM[name] = EventRing(cls.SPANS.capacity)
+        return ring
+
+    @classmethod
+    def drain_spans(cls) -> dict[str, np.ndarray] | None:
+        """
+        Spans recorded (in this process) since last call, to be merged into main process by `merge_spans`.
+        """
+        if not cls.ACTIVE: return None
+        return cls.SPANS.drain()
+
+    @classmethod
+    def merge_spans(cls, spans: dict[str, np.ndarray] | None) -> None:
+        if spans is None: return
+        cls.SPANS.merge(spans)
+
+    @staticmethod
+    def _format_stat(name: str, num_call: int, elapsed: list[float] | np.ndarray) -> str:
+        if len(elapsed) == 0:
+            return f"\t{name}".ljust(24) + f" | #Call= {num_call}".ljust(14) + " | AvgTime=N/A\n"
+        p50, p95, p99 = np.percentile(np.asarray(elapsed), [50, 95, 99])
+        return f"\t{name}".ljust(24) + \
+            f" | #Call={num_call}".ljust(14) + \
+            f" | AvgTime={np.mean(elapsed) : .3f} ms".ljust(22) + \
+            f" | p50={p50 : .3f} ms".ljust(18) + \
+            f" | p95={p95 : .3f} ms".ljust(18) + \
+            f" | p99={p99 : .3f} ms\n"
 
     @classmethod
     def report(cls):
@@ -96,64 +239,66 @@ class Timer:
         
         # CPU Side timing
         report_str += "CPU Timers:\n"
-        for name, (starts, ends) in cls.CPU_TIME_STREAM.items():
-            elapsed = list(map(lambda pair: pair[1] - pair[0], zip(starts, ends)))
-            
-            if len(starts) == 0:
-                report_str += f"\t{name}".ljust(20) +  \
-                    f" | #Call= 0".ljust(20) + \
-                    f" | AvgTime=N/A".ljust(20) + \
-                    f" | MedianTime=N/A\n"
-            else:
-                median_elapsed = torch.tensor(elapsed).median().item()
-                report_str += f"\t{name}".ljust(20) + \
-                    f" | #Call={len(starts)}".ljust(20) + \
-                    f" | AvgTime={(sum(elapsed) / len(starts)) : 3f} ms".ljust(20) + \
-                    f" | MedianTime={median_elapsed : 3f} ms\n"
+        for name, elapsed in cls.SPANS.elapsed_ms().items():
+            report_str += cls._format_stat(name, cls.SPANS.num_calls[cls.SPANS.name_index[name]], elapsed)
 
         # GPU Side timing
         
         # Ensure everything is finished
         report_str += "GPU Timers:\n"
         for stream in cls.GPU_STREAMS: stream.synchronize()
-        for name, (starts, ends) in cls.GPU_TIME_STREAM.items():
+        for name, ring in cls.GPU_TIME_STREAM.items():
             elapsed = list(filter(
                 lambda elapse: not math.isnan(elapse),
-                map(lambda pair: cls.cuda_event_elapsed(*pair), zip(starts, ends))
+                map(lambda pair: cls.cuda_event_elapsed(*pair), ring.events)
             ))
-            if len(starts) == 0:
-                report_str += f"\t{name}".ljust(20) +  \
-                    f" | #Call= 0".ljust(20) + \
-                    f" | AvgTime=N/A".ljust(20) + \
-                    f" | MedianTime=N/A\n"
-            else:
-                median_elapsed = torch.tensor(elapsed).median().item()
-                report_str += f"\t{name}".ljust(20) + \
-                    f" | #Call={len(starts)}".ljust(20) + \
-                    f" | AvgTime={(sum(elapsed) / len(starts)) : 3f} ms".ljust(20) + \
-                    f" | MedianTime={median_elapsed : 3f} ms\n"
+            report_str += cls._format_stat(name, ring.num_calls, elapsed)
         
         # Logger.write("info", report_str)
         print(report_str)
 
     @classmethod
     def save_elapsed(cls, json_file: str | Path):
+        """
+        Write elapsed time (in ms) of all recorded spans to a json file.
+        """
         if not cls.ACTIVE: return
-        import json
         for stream in cls.GPU_STREAMS: stream.synchronize()
         with open(json_file, "w") as f:
             json.dump({
                 "CPU_ElapsedTime": {
-                    name : [end - start for start, end in zip(*cls.CPU_TIME_STREAM[name])]
-                    for name in cls.CPU_TIME_STREAM
+                    name : elapsed.tolist()
+                    for name, elapsed in cls.SPANS.elapsed_ms().items()
                 },
                 "GPU_ElapsedTime": {
-                    name : [start.elapsed_time(end) for start, end in zip(*cls.GPU_TIME_STREAM[name])]
-                    for name in cls.GPU_TIME_STREAM
+                    name : [start.elapsed_time(end) for start, end in ring.events]
+                    for name, ring in cls.GPU_TIME_STREAM.items()
                 }
             }, f)
             Logger.write("info", f"Elapsed time information write to {json_file}")
 
+    @classmethod
+    def export_chrome_trace(cls, json_file: str | Path):
+        """
+        Export recorded CPU spans (of main process and merged child processes) in Chrome trace event format, 
+        can be opened in chrome://tracing or https://ui.perfetto.dev
+        """
+        if not cls.ACTIVE: return
+        spans    = cls.SPANS.spans()
+        main_pid = os.getpid()
+        events: list[dict] = [
+            {"ph": "M", "name": "process_name", "pid": int(pid), "args": {"name": "main" if pid == main_pid else f"worker-{pid}"}}
+            for pid in np.unique(spans["pid"])
+        ]
+        for name, start, end, depth, thread, pid in zip(*(spans[k] for k in ("name", "start_ns", "end_ns", "depth", "thread", "pid"))):
+            events.append({
+                "name": str(name), "ph": "X", "pid": int(pid), "tid": int(thread),
+                "ts"  : start / 1e3, "dur": (end - start) / 1e3, "args": {"depth": int(depth)}
+            })
+        with open(json_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        Logger.write("info", f"Timer trace write to {json_file}")
+
     @staticmethod
     def cuda_event_elapsed(from_event: T_CUDAEvent, to_event: T_CUDAEvent) -> float:
         try:
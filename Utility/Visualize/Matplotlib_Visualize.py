@@ -296,8 +296,8 @@ class Matplotlib_Visualizer:
             # Plot left camera at frame 1, with keypoints overlayed on it
             Plot.plot_whiten_image(frame1.stereo.imageL[0].permute(1, 2, 0), whiten=0.75)
                 >> Plot.plot_no_border()
-                >> Plot.plot_flow_cov(obs.data["pixel2_uv"], obs.data["pixel2_uv_cov"])
-                >> Plot.plot_keypoints(obs.data["pixel2_uv"], obs.data["pixel2_d_cov"], s=2, marker='.')
+                >> Plot.plot_flow_cov(obs.data["pixel2_uv"], obs.data.get("pixel2_uv_cov"))
+                >> Plot.plot_keypoints(obs.data["pixel2_uv"], obs.data.get("pixel2_d_cov"), s=2, marker='.')
                 >> Chain.side_effect(lambda ax: ax.set_title(f"Frame {frame1.frame_idx} Left", loc="left")),
             
             # Plot depth cov estimation